@@ -0,0 +1,201 @@
+'''
+hw0_kdtree.py
+
+Summary
+-------
+Exact k-nearest neighbor search with a KD-tree.
+
+Best suited to data with few features (say F <= 16), where each query
+only needs to visit a handful of leaves, so query time grows roughly
+like log(N) rather than N.
+
+Results match hw0_knn.calc_k_nearest_neighbor_ids exactly, including
+breaking ties between equally close rows by their order in data_NF.
+
+Examples
+--------
+>>> prng = np.random.RandomState(0)
+>>> data_NF = prng.randint(-3, 4, size=(1000, 3)).astype(np.float64)
+>>> query_QF = prng.randint(-3, 4, size=(50, 3)).astype(np.float64)
+>>> tree = KDTree(data_NF, leaf_size=8)
+>>> ids_QK = tree.query(query_QF, K=20)
+>>> dist_QN = np.sum(np.square(data_NF[None] - query_QF[:, None]), axis=2)
+>>> np.array_equal(ids_QK, np.argsort(dist_QN, axis=1, kind='stable')[:, :20])
+True
+'''
+
+import numpy as np
+
+# Default maximum number of rows stored in one leaf of the tree
+DEFAULT_LEAF_SIZE = 32
+
+
+class KDTree(object):
+    ''' Binary space-partitioning tree over the rows of a dataset
+
+    Each internal node splits its rows at the median of the feature with
+    the widest range. Each node stores the bounding box of its rows, used
+    to skip whole subtrees that cannot hold any of the K nearest rows.
+
+    Attributes
+    ----------
+    * self.data_NF : 2D numpy array, shape (N, F)
+        Copy of the data as float64, rows reordered so each node is a slice
+    * self.ids_N : 1D numpy array of int, size N
+        Original row id of each row of self.data_NF
+    * self.start_V, self.stop_V : 1D numpy arrays of int, size n_nodes
+        Node v holds rows start_V[v]:stop_V[v] of self.data_NF
+    * self.left_V, self.right_V : 1D numpy arrays of int, size n_nodes
+        Child node ids, or -1 for leaves
+    * self.lo_VF, self.hi_VF : 2D numpy arrays, shape (n_nodes, F)
+        Bounding box of each node's rows
+    '''
+
+    def __init__(self, data_NF, leaf_size=DEFAULT_LEAF_SIZE):
+        ''' Build the tree for provided data
+
+        Args
+        ----
+        data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
+            Each row is a feature vector for one example in dataset
+        leaf_size : int
+            Maximum number of rows in a leaf
+        '''
+        data_NF = np.asarray(data_NF, dtype=np.float64)
+        N, F = data_NF.shape
+        leaf_size = max(1, int(leaf_size))
+
+        ids_N = np.arange(N)
+        start_list, stop_list = [0], [N]
+        left_list, right_list = [-1], [-1]
+        lo_list, hi_list = [None], [None]
+        stack = [0]
+        while stack:
+            v = stack.pop()
+            start, stop = start_list[v], stop_list[v]
+            rows_MF = data_NF[ids_N[start:stop]]
+            lo_F = rows_MF.min(axis=0)
+            hi_F = rows_MF.max(axis=0)
+            lo_list[v] = lo_F
+            hi_list[v] = hi_F
+            if stop - start <= leaf_size or np.all(hi_F == lo_F):
+                continue
+
+            # Median split along the widest feature
+            f = int(np.argmax(hi_F - lo_F))
+            half = (stop - start) // 2
+            order_M = np.argpartition(rows_MF[:, f], half)
+            ids_N[start:stop] = ids_N[start:stop][order_M]
+            for child_start, child_stop in [
+                    (start, start + half), (start + half, stop)]:
+                start_list.append(child_start)
+                stop_list.append(child_stop)
+                left_list.append(-1)
+                right_list.append(-1)
+                lo_list.append(None)
+                hi_list.append(None)
+                stack.append(len(start_list) - 1)
+            left_list[v] = len(start_list) - 2
+            right_list[v] = len(start_list) - 1
+
+        self.lo_VF = np.vstack(lo_list)
+        self.hi_VF = np.vstack(hi_list)
+        self.start_V = np.asarray(start_list)
+        self.stop_V = np.asarray(stop_list)
+        self.left_V = np.asarray(left_list)
+        self.right_V = np.asarray(right_list)
+        self.ids_N = ids_N
+        self.data_NF = data_NF[ids_N]
+
+    def query(self, query_QF, K=1, return_distance=False):
+        ''' Find row ids of the K nearest rows for each query
+
+        Args
+        ----
+        query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
+            Each row is a feature vector whose neighbors we want to find
+        K : int, must satisfy K >= 1 and K <= n_examples aka N
+            Number of neighbors to find per query vector
+        return_distance : bool
+            If True, also return squared distance to each neighbor
+
+        Returns
+        -------
+        ids_QK : 2D np.array of int, shape = (n_queries, n_neighbors) == (Q, K)
+            Entry q,k is row id in data_NF of k-th nearest neighbor of query q
+            If two vectors are equally close, then we break ties by taking the one
+            appearing first in row order in the original data_NF array
+        sqdist_QK : 2D np.array, shape = (n_queries, n_neighbors) == (Q, K)
+            Only returned if return_distance is True.
+            Entry q,k is squared Euclidean distance to that neighbor.
+        '''
+        query_QF = np.asarray(query_QF, dtype=np.float64)
+        N, F = self.data_NF.shape
+        K = int(K)
+        if K < 1:
+            raise ValueError("Invalid number of neighbors (K). Too small.")
+        if K > N:
+            raise ValueError("Invalid number of neighbors (K). Too large.")
+
+        ids_QK = np.zeros((query_QF.shape[0], K), dtype=np.intp)
+        sqdist_QK = np.zeros((query_QF.shape[0], K))
+        for q, query_F in enumerate(query_QF):
+            ids_QK[q], sqdist_QK[q] = self._query_one(query_F, K)
+        if return_distance:
+            return ids_QK, sqdist_QK
+        return ids_QK
+
+    def _query_one(self, query_F, K):
+        ''' Depth-first search for the K nearest rows of one query
+
+        A subtree is skipped only when its box lower bound is *strictly*
+        larger than the current K-th best distance, so rows tied with
+        the K-th best are always visited and compared by row id.
+
+        Returns
+        -------
+        ids_K : 1D np.array of int, size K
+        sqdist_K : 1D np.array, size K
+        '''
+        N, F = self.data_NF.shape
+        # Shrink box bounds a hair so roundoff can never over-prune
+        slack = 1.0 - 4.0 * (F + 2) * np.finfo(np.float64).eps
+
+        best_dist_K = np.full(K, np.inf)
+        best_ids_K = np.full(K, N, dtype=np.intp)
+        stack = [(0, 0.0)]
+        while stack:
+            v, lower_bound = stack.pop()
+            if lower_bound > best_dist_K[-1]:
+                continue
+            left = self.left_V[v]
+            if left < 0:
+                start, stop = self.start_V[v], self.stop_V[v]
+                dist_M = np.sum(
+                    np.square(self.data_NF[start:stop] - query_F), axis=1)
+                keep_M = dist_M <= best_dist_K[-1]
+                if not np.any(keep_M):
+                    continue
+                all_dist_L = np.hstack([best_dist_K, dist_M[keep_M]])
+                all_ids_L = np.hstack([
+                    best_ids_K, self.ids_N[start:stop][keep_M]])
+                order_K = np.lexsort((all_ids_L, all_dist_L))[:K]
+                best_dist_K = all_dist_L[order_K]
+                best_ids_K = all_ids_L[order_K]
+                continue
+
+            # Visit the child with the smaller lower bound first
+            right = self.right_V[v]
+            bounds = []
+            for child in (left, right):
+                gap_F = (
+                    np.maximum(self.lo_VF[child] - query_F, 0.0)
+                    + np.maximum(query_F - self.hi_VF[child], 0.0))
+                bounds.append(slack * np.dot(gap_F, gap_F))
+            if bounds[0] <= bounds[1]:
+                stack.append((right, bounds[1]))
+                stack.append((left, bounds[0]))
+            else:
+                stack.append((left, bounds[0]))
+                stack.append((right, bounds[1]))
+        return best_ids_K, best_dist_K
@@ -43,20 +43,159 @@ array([[ 1.,  0.],
 array([[ 0., -1.],
        [ 1.,  0.],
        [-1.,  0.]])
+
+Example Test Memory Budget
+--------------------------
+# A tiny budget forces one query and a few data rows per block,
+# but the answer (and its tie-breaking) does not change
+>>> calc_k_nearest_neighbor_ids(data_NF, query_QF, K=3, max_bytes=64)
+array([[0, 1, 3],
+       [3, 0, 2]])
+>>> np.all(calc_k_nearest_neighbors(data_NF, query_QF, K=3, max_bytes=64)
+...        == neighb_QKF)
+True
+
+# Exact ties are broken by row order
+>>> calc_k_nearest_neighbor_ids(data_NF, np.zeros((1, 2)), K=4, max_bytes=64)
+array([[0, 1, 2, 3]])
+
+Example Test Ids and Distances Only
+-----------------------------------
+>>> ids_QK, dist_QK = calc_k_nearest_neighbor_ids(
+...     data_NF, query_QF, K=2, return_distance=True)
+>>> ids_QK
+array([[0, 1],
+       [3, 0]])
+>>> print(np.round(dist_QK, 4))
+[[0.1    1.3454]
+ [0.1    1.3454]]
+
+Example Test Other Metrics
+--------------------------
+>>> mdata_NF = np.asarray([[10., 0.], [1., 1.], [0.5, 0.]])
+>>> mquery_QF = np.asarray([[1., 0.]])
+>>> calc_k_nearest_neighbor_ids(mdata_NF, mquery_QF, K=3, metric='euclidean')
+array([[2, 1, 0]])
+
+# Rows 0 and 2 point the same way as the query, so tie under cosine
+>>> calc_k_nearest_neighbor_ids(mdata_NF, mquery_QF, K=3, metric='cosine')
+array([[0, 2, 1]])
+>>> calc_k_nearest_neighbor_ids(mdata_NF, mquery_QF, K=3, metric='inner_product')
+array([[0, 1, 2]])
+
+# A prepared dataset caches row norms (and unit-length rows for cosine),
+# so that work is done once and reused across many batches of queries
+>>> prepared = PreparedDataset(mdata_NF)
+>>> for q_QF in [mquery_QF, -mquery_QF]:
+...     print(calc_k_nearest_neighbor_ids(prepared, q_QF, K=3, metric='cosine'))
+[[0 2 1]]
+[[1 0 2]]
+
+Regression Test Against Stable Argsort
+--------------------------------------
+# Points on a small integer grid, with many duplicates, give many exact ties
+>>> prng = np.random.RandomState(42)
+>>> grid_NF = prng.randint(-2, 3, size=(300, 3)).astype(np.float64)
+>>> gridq_QF = prng.randint(-2, 3, size=(40, 3)).astype(np.float64)
+>>> dist_QN = np.sum(np.square(grid_NF[None] - gridq_QF[:, None]), axis=2)
+>>> for K in [1, 7, 50, 300]:
+...     expected_QK = np.argsort(dist_QN, axis=1, kind='stable')[:, :K]
+...     for max_bytes in [64, 2**14, DEFAULT_MAX_BYTES]:
+...         ids_QK = calc_k_nearest_neighbor_ids(
+...             grid_NF, gridq_QF, K=K, max_bytes=max_bytes)
+...         assert np.array_equal(ids_QK, expected_QK), (K, max_bytes)
+...     ids_QK = calc_k_nearest_neighbor_ids(
+...         grid_NF, gridq_QF, K=K, algorithm='kd_tree')
+...     assert np.array_equal(ids_QK, expected_QK), K
+...     ids_QK = calc_k_nearest_neighbor_ids(
+...         grid_NF, gridq_QF, K=K, algorithm='brute', n_jobs=4)
+...     assert np.array_equal(ids_QK, expected_QK), K
 '''
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-def calc_k_nearest_neighbors(data_NF, query_QF, K=1):
-    ''' Compute and return k-nearest neighbors under Euclidean distance
+from hw0_kdtree import KDTree
+
+# Default cap on the scratch memory (in bytes) used while processing one
+# block of queries against one block of data rows
+DEFAULT_MAX_BYTES = 64 * 2**20
+
+# Supported ways to measure how close a data row is to a query
+METRIC_NAMES = ('euclidean', 'sqeuclidean', 'cosine', 'inner_product')
+
+
+class PreparedDataset(object):
+    ''' Dataset wrapped with per-row quantities that k-NN search reuses
+
+    Pass an instance anywhere a data_NF array is accepted below. Computing
+    squared row norms (and, for cosine, unit-length rows) costs O(N * F);
+    a prepared dataset pays that once instead of on every call.
+
+    Attributes
+    ----------
+    * self.data_NF : 2D numpy array, shape (N, F)
+        The original data, not copied
+    * self.sqnorm_N : 1D numpy array, size N
+        Squared Euclidean norm of each row, as float64
+    '''
+
+    def __init__(self, data_NF):
+        self.data_NF = np.asarray(data_NF)
+        N = self.data_NF.shape[0]
+        self.sqnorm_N = np.zeros(N)
+        chunk = max(1, DEFAULT_MAX_BYTES // (8 * self.data_NF.shape[1] + 8))
+        for start in range(0, N, chunk):
+            rows_CF = np.asarray(
+                self.data_NF[start:start + chunk], dtype=np.float64)
+            self.sqnorm_N[start:start + chunk] = np.einsum(
+                'cf,cf->c', rows_CF, rows_CF)
+        self._unit_data_NF = None
+        self._kdtree = None
+
+    def get_unit_data_NF(self):
+        ''' Get float64 copy of data with each row scaled to unit length
+
+        Rows of all zeros stay all zeros. Computed on first call only.
+        '''
+        if self._unit_data_NF is None:
+            self._unit_data_NF = (
+                np.asarray(self.data_NF, dtype=np.float64)
+                / _safe_norm(self.sqnorm_N)[:, None])
+        return self._unit_data_NF
+
+    def get_kdtree(self):
+        ''' Get a KDTree over the data. Built on first call only.
+        '''
+        if self._kdtree is None:
+            self._kdtree = KDTree(self.data_NF)
+        return self._kdtree
+
+
+def calc_k_nearest_neighbors(
+        data_NF, query_QF, K=1, max_bytes=DEFAULT_MAX_BYTES, algorithm='auto',
+        metric='euclidean', n_jobs=1):
+    ''' Compute and return k-nearest neighbors under a chosen metric
 
     Args
     ----
     data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
         Each row is a feature vector for one example in dataset
+        May also be a PreparedDataset wrapping such an array.
     query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
         Each row is a feature vector whose neighbors we want to find
     K : int, must satisfy K >= 1 and K <= n_examples aka N
         Number of neighbors to find per query vector
+    max_bytes : int
+        Approximate budget for scratch memory used at any one time.
+        See calc_k_nearest_neighbor_ids.
+    algorithm : str, one of 'auto', 'brute', 'kd_tree'
+        Search method. See calc_k_nearest_neighbor_ids.
+    metric : str, one of METRIC_NAMES
+        Notion of closeness. See calc_k_nearest_neighbor_ids.
+    n_jobs : int or None
+        Number of worker threads. See calc_k_nearest_neighbor_ids.
 
     Returns
     -------
@@ -65,13 +204,317 @@ def calc_k_nearest_neighbors(data_NF, query_QF, K=1):
         If two vectors are equally close, then we break ties by taking the one
         appearing first in row order in the original data_NF array
     '''
+    if not isinstance(data_NF, PreparedDataset):
+        data_NF = PreparedDataset(data_NF)
+    ids_QK = calc_k_nearest_neighbor_ids(
+        data_NF, query_QF, K=K, max_bytes=max_bytes, algorithm=algorithm,
+        metric=metric, n_jobs=n_jobs)
+    return data_NF.data_NF[ids_QK]
+
+
+def calc_k_nearest_neighbor_ids(
+        data_NF, query_QF, K=1, max_bytes=DEFAULT_MAX_BYTES, algorithm='auto',
+        metric='euclidean', n_jobs=1, return_distance=False):
+    ''' Compute row ids of k-nearest neighbors under a chosen metric
+
+    Never forms the (Q, N, F) array of all pairwise differences.
+    Instead, queries and data rows are processed in blocks, sized so the
+    scratch arrays of one (query block, data block) pair fit in max_bytes.
+
+    Within a block, squared distances come from the expansion
+    ||a||^2 - 2 a.b + ||b||^2, so the bulk of the work is one matrix product.
+    That expansion has roundoff error, so any row whose expanded distance
+    is within a roundoff bound of the current K-th best is re-scored with
+    the direct formula sum_f (a_f - b_f)^2 before the final ranking.
+    Results therefore match a stable argsort of the direct distances.
+
+    For data with few features and many rows, a KD-tree (see hw0_kdtree.py)
+    gives the same answer while only visiting a small part of the data.
+
+    The similarity metrics ('cosine' and 'inner_product') rank rows by the
+    computed dot product itself, so ties there mean equal computed values.
+
+    Args
+    ----
+    data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
+        Each row is a feature vector for one example in dataset
+        May also be a PreparedDataset wrapping such an array, which
+        avoids recomputing row norms on every call.
+    query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
+        Each row is a feature vector whose neighbors we want to find
+    K : int, must satisfy K >= 1 and K <= n_examples aka N
+        Number of neighbors to find per query vector
+    max_bytes : int
+        Approximate budget for scratch memory used at any one time.
+        Blocks never shrink below one query row and K data rows, so
+        very small budgets may be exceeded.
+    algorithm : str, one of 'auto', 'brute', 'kd_tree'
+        'brute' scans all rows in blocks. 'kd_tree' builds a KD-tree.
+        'auto' picks whichever is expected to be faster given N, F and Q.
+        The KD-tree only supports the Euclidean metrics.
+    metric : str, one of METRIC_NAMES
+        'euclidean' and 'sqeuclidean' rank by distance (same order).
+        'cosine' ranks by cosine distance 1 - a.b / (||a|| ||b||).
+        'inner_product' ranks by largest dot product a.b first.
+    n_jobs : int or None
+        Number of threads that brute-force search spreads query blocks over.
+        None or 1 means no threading, -1 means one thread per CPU core.
+        NumPy releases the GIL inside matrix products and sorts, so threads
+        run in parallel. The max_bytes budget is shared among the threads.
+    return_distance : bool
+        If True, also return the distance to each neighbor.
+        Only ids and distances are produced, never a (Q, K, F) array.
+
+    Returns
+    -------
+    ids_QK : 2D np.array of int, shape = (n_queries, n_neighbors) == (Q, K)
+        Entry q,k is row id in data_NF of k-th nearest neighbor of query q
+        If two vectors are equally close, then we break ties by taking the one
+        appearing first in row order in the original data_NF array
+    dist_QK : 2D np.array, shape = (n_queries, n_neighbors) == (Q, K)
+        Only returned if return_distance is True.
+        Entry q,k is distance from query q to its k-th nearest neighbor:
+        Euclidean or squared Euclidean distance, cosine distance, or the
+        negated dot product for 'inner_product' (so smaller is closer).
+    '''
+    if isinstance(data_NF, PreparedDataset):
+        prepared = data_NF
+    else:
+        prepared = PreparedDataset(data_NF)
+    query_QF = np.asarray(query_QF)
+    N, F = prepared.data_NF.shape
+    Q, F2 = query_QF.shape
+    assert F == F2
+
+    K = int(K)
+    if K < 1:
+        raise ValueError("Invalid number of neighbors (K). Too small.")
+    if K > N:
+        raise ValueError("Invalid number of neighbors (K). Too large.")
+    if metric not in METRIC_NAMES:
+        raise ValueError("Unrecognized metric: %s" % metric)
+    is_euclidean = metric in ('euclidean', 'sqeuclidean')
+
+    if algorithm == 'auto':
+        algorithm = _choose_algorithm(N, F, Q) if is_euclidean else 'brute'
+    if algorithm == 'kd_tree':
+        if not is_euclidean:
+            raise ValueError("kd_tree only supports Euclidean metrics")
+        ids_QK, sqdist_QK = prepared.get_kdtree().query(
+            query_QF, K=K, return_distance=True)
+        if return_distance:
+            return ids_QK, _convert_distance(sqdist_QK, metric)
+        return ids_QK
+    elif algorithm != 'brute':
+        raise ValueError("Unrecognized algorithm: %s" % algorithm)
+
+    n_jobs = _resolve_n_jobs(n_jobs)
+    job_max_bytes = max_bytes // n_jobs
+    B, T = _calc_block_sizes(N, F, K, job_max_bytes)
+    # Make sure every thread gets at least one block
+    B = max(1, min(B, -(-Q // n_jobs)))
+    if metric == 'cosine':
+        # Build shared cache once, before any threads start
+        prepared.get_unit_data_NF()
+
+    ids_QK = np.zeros((Q, K), dtype=np.intp)
+    dist_QK = np.zeros((Q, K))
+
+    def fill_block(q_start):
+        q_stop = min(Q, q_start + B)
+        ids_QK[q_start:q_stop], dist_QK[q_start:q_stop] = (
+            _calc_k_nearest_neighbor_ids_for_block(
+                prepared, query_QF[q_start:q_stop], K, T, metric,
+                job_max_bytes))
+
+    if n_jobs == 1:
+        for q_start in range(0, Q, B):
+            fill_block(q_start)
+    else:
+        # Each block writes its own rows of ids_QK, so order is preserved
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(fill_block, range(0, Q, B)))
+    if return_distance:
+        return ids_QK, _convert_distance(dist_QK, metric)
+    return ids_QK
+
+
+def _convert_distance(dist_QK, metric):
+    ''' Convert internal ranking distances into the metric's own distance
+
+    Internally, Euclidean metrics rank by squared distance, and similarity
+    metrics rank by the negated dot product.
+    '''
+    if metric == 'euclidean':
+        return np.sqrt(dist_QK)
+    elif metric == 'cosine':
+        # Rounding can leave a same-direction match just below zero
+        return np.maximum(1.0 + dist_QK, 0.0)
+    return dist_QK
+
+
+def _resolve_n_jobs(n_jobs):
+    ''' Convert an n_jobs argument into a positive number of workers
+
+    Follows the sklearn convention: None means 1, negative values count
+    back from the number of CPU cores (-1 means all cores).
+    '''
+    if n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    return max(1, n_jobs)
+
 
-    # Get euclidian distances
-    dist = np.linalg.norm(data_NF[None, :, :] - query_QF[:, None, :], axis=2)
+def _choose_algorithm(N, F, Q):
+    ''' Pick 'kd_tree' or 'brute' by comparing rough run time estimates
 
-    # Sort distances, get indices of kth smallest
-    indices = np.argsort(dist, axis = 1)[:, :K]
+    Estimates use per-operation costs measured on a typical laptop:
+    brute force spends ~5e-8 sec per (query, row) pair, while a KD-tree
+    spends ~4e-6 sec per row to build plus ~2e-4 * 1.65^F sec per query.
+
+    Returns
+    -------
+    algorithm : str, either 'kd_tree' or 'brute'
+    '''
+    if F > 16:
+        return 'brute'
+    brute_sec = 5e-8 * Q * N
+    tree_sec = 4e-6 * N + 2e-4 * (1.65 ** F) * Q
+    return 'kd_tree' if tree_sec < brute_sec else 'brute'
+
+
+def _calc_block_sizes(N, F, K, max_bytes):
+    ''' Choose query block size B and data block size T for a memory budget
+
+    Data blocks take at most a quarter of the budget. The rest goes to the
+    per-pair scratch: a B x T distance matrix plus its sort indices, and
+    the B x K x F candidate differences used for re-scoring.
+
+    Returns
+    -------
+    B : int
+        Number of queries per block, at least 1
+    T : int
+        Number of data rows per block, at least min(N, K)
+    '''
+    row_bytes = 8 * (F + 1)
+    T = int(min(N, max(K, max_bytes // (4 * row_bytes))))
+    pair_bytes = 24 * T + 16 * K * F
+    B = int(max(1, (max_bytes - T * row_bytes) // pair_bytes))
+    return B, T
 
-    neigbors = data_NF[indices]
-    
-    return neigbors
+
+def _calc_k_nearest_neighbor_ids_for_block(
+        prepared, query_BF, K, T, metric, max_bytes):
+    ''' Find K nearest row ids for one block of queries, scanning data in T-row blocks
+
+    Keeps a running (distance, id) top-K list per query. For Euclidean
+    metrics, distances are always the direct sum_f (a_f - b_f)^2. For
+    similarity metrics, the distance is the negated dot product. Each data
+    block only contributes rows that could possibly beat the running K-th best.
+
+    Returns
+    -------
+    ids_BK : 2D np.array of int, shape (B, K)
+    dist_BK : 2D np.array, shape (B, K)
+        Squared distance, or negated dot product, for each neighbor
+    '''
+    N, F = prepared.data_NF.shape
+    query_BF = np.asarray(query_BF, dtype=np.float64)
+    B = query_BF.shape[0]
+    sqnorm_B = np.einsum('bf,bf->b', query_BF, query_BF)
+    is_euclidean = metric in ('euclidean', 'sqeuclidean')
+    if metric == 'cosine':
+        data_NF = prepared.get_unit_data_NF()
+        query_BF = query_BF / _safe_norm(sqnorm_B)[:, None]
+    else:
+        data_NF = prepared.data_NF
+
+    # Bound on |expanded - direct| squared distance, per unit of norm^2
+    roundoff_scale = 4.0 * (F + 4) * np.finfo(np.float64).eps
+
+    best_dist_BK = np.zeros((B, 0))
+    best_ids_BK = np.zeros((B, 0), dtype=np.intp)
+    for n_start in range(0, N, T):
+        n_stop = min(N, n_start + T)
+        data_TF = np.asarray(data_NF[n_start:n_stop], dtype=np.float64)
+        if is_euclidean:
+            sqnorm_T = prepared.sqnorm_N[n_start:n_stop]
+            approx_dist_BT = (
+                sqnorm_B[:, None] - 2.0 * np.dot(query_BF, data_TF.T)
+                + sqnorm_T[None, :])
+            tol_B = roundoff_scale * (sqnorm_B + sqnorm_T.max())
+        else:
+            # Similarities are ranked by the computed value itself
+            approx_dist_BT = -np.dot(query_BF, data_TF.T)
+            tol_B = np.zeros(B)
+
+        # Only rows that could rank in the top K need the direct distance:
+        # they must be near-top-K within this block, and no worse than the
+        # K-th best found so far.
+        cur_T = n_stop - n_start
+        thresh_B = np.full(B, np.inf)
+        if cur_T > K:
+            kth_B = np.partition(approx_dist_BT, K - 1, axis=1)[:, K - 1]
+            thresh_B = kth_B + 2.0 * tol_B
+        if best_dist_BK.shape[1] == K:
+            thresh_B = np.minimum(thresh_B, best_dist_BK[:, K - 1] + tol_B)
+        M = int(np.max(np.sum(approx_dist_BT <= thresh_B[:, None], axis=1)))
+        if M == 0:
+            continue
+
+        # Any M smallest will do, merge below puts them in final order
+        if M < cur_T:
+            cand_ids_BM = np.argpartition(approx_dist_BT, M - 1, axis=1)[:, :M]
+        else:
+            cand_ids_BM = np.tile(np.arange(cur_T), (B, 1))
+        if is_euclidean:
+            cand_dist_BM = _calc_sq_dist_to_rows(
+                data_TF, query_BF, cand_ids_BM, max_bytes)
+        else:
+            cand_dist_BM = np.take_along_axis(
+                approx_dist_BT, cand_ids_BM, axis=1)
+
+        # Merge with running top K, ordering by distance then row id
+        all_dist_BL = np.hstack([best_dist_BK, cand_dist_BM])
+        all_ids_BL = np.hstack([best_ids_BK, cand_ids_BM + n_start])
+        order_BL = np.lexsort((all_ids_BL, all_dist_BL), axis=1)[:, :K]
+        best_dist_BK = np.take_along_axis(all_dist_BL, order_BL, axis=1)
+        best_ids_BK = np.take_along_axis(all_ids_BL, order_BL, axis=1)
+    return best_ids_BK, best_dist_BK
+
+
+def _calc_sq_dist_to_rows(data_TF, query_BF, ids_BM, max_bytes):
+    ''' Compute direct squared distance from each query to selected rows
+
+    Works through queries in chunks so the B x M x F difference array
+    stays within max_bytes.
+
+    Returns
+    -------
+    dist_BM : 2D np.array, shape (B, M)
+        Entry b,m is sum_f (query_BF[b,f] - data_TF[ids_BM[b,m],f])^2
+    '''
+    B, M = ids_BM.shape
+    F = data_TF.shape[1]
+    chunk = int(max(1, max_bytes // (8 * M * F + 1)))
+    dist_BM = np.zeros((B, M))
+    for b_start in range(0, B, chunk):
+        b_stop = min(B, b_start + chunk)
+        diff_CMF = (
+            data_TF[ids_BM[b_start:b_stop]]
+            - query_BF[b_start:b_stop, None, :])
+        dist_BM[b_start:b_stop] = np.sum(np.square(diff_CMF), axis=2)
+    return dist_BM
+
+
+def _safe_norm(sqnorm_N):
+    ''' Compute norms from squared norms, replacing zeros by one
+
+    Dividing by the result leaves all-zero rows unchanged.
+    '''
+    norm_N = np.sqrt(sqnorm_N)
+    norm_N[norm_N == 0] = 1.0
+    return norm_N
@@ -0,0 +1,151 @@
+'''
+hw0_knn_benchmark.py
+
+Summary
+-------
+Benchmarks for the k-nearest neighbor engine in hw0_knn.py.
+
+Memory measurements each run in a fresh subprocess so that its peak
+resident set size (RSS) is not polluted by earlier runs.
+
+Usage
+-----
+$ python hw0_knn_benchmark.py memory
+$ python hw0_knn_benchmark.py algorithms
+$ OMP_NUM_THREADS=1 python hw0_knn_benchmark.py scaling
+
+For the scaling benchmark, limiting BLAS to one thread per call (as above)
+shows the speedup that comes from n_jobs alone.
+'''
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from hw0_kdtree import KDTree
+from hw0_knn import calc_k_nearest_neighbor_ids, _choose_algorithm
+
+
+def measure_one_run(N, F, Q, K, max_bytes, seed=0):
+    ''' Run one k-NN search and report time and peak RSS of this process
+
+    Returns
+    -------
+    info : dict
+        Keys 'elapsed_sec' and 'peak_rss_mb'
+    '''
+    prng = np.random.RandomState(seed)
+    data_NF = prng.randn(N, F)
+    query_QF = prng.randn(Q, F)
+    start = time.perf_counter()
+    calc_k_nearest_neighbor_ids(data_NF, query_QF, K=K, max_bytes=max_bytes)
+    elapsed_sec = time.perf_counter() - start
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return dict(elapsed_sec=elapsed_sec, peak_rss_mb=peak_rss_mb)
+
+
+def run_in_subprocess(N, F, Q, K, max_bytes):
+    ''' Call measure_one_run in a fresh interpreter, return its info dict
+    '''
+    cmd = [sys.executable, __file__, 'one',
+           '--N', str(N), '--F', str(F), '--Q', str(Q), '--K', str(K),
+           '--max_bytes', str(max_bytes)]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    elapsed_sec, peak_rss_mb = map(float, out.stdout.split())
+    return dict(elapsed_sec=elapsed_sec, peak_rss_mb=peak_rss_mb)
+
+
+def benchmark_memory(N=20000, F=64, K=10, max_bytes=16 * 2**20,
+                     Q_list=(500, 1000, 2000, 4000, 8000)):
+    ''' Show that peak RSS stays flat as the number of queries Q grows
+
+    Alongside each measurement we print the size of the (Q, N, F)
+    temporary that a fully broadcast implementation would need.
+    '''
+    print("N=%d F=%d K=%d max_bytes=%.1f MB" % (N, F, K, max_bytes / 2**20))
+    print("%8s %12s %16s %16s" % (
+        'Q', 'time (s)', 'peak RSS (MB)', 'Q*N*F*8 (MB)'))
+    for Q in Q_list:
+        info = run_in_subprocess(N, F, Q, K, max_bytes)
+        print("%8d %12.3f %16.1f %16.1f" % (
+            Q, info['elapsed_sec'], info['peak_rss_mb'],
+            Q * N * F * 8 / 2**20))
+
+
+def benchmark_algorithms(F=3, Q=200, K=10,
+                         N_list=(10**3, 10**4, 10**5, 10**6)):
+    ''' Compare brute force and KD-tree search times as N grows
+
+    Tree time is split into build and query, to show query time growing
+    much slower than N. Also reports which method 'auto' would choose.
+    '''
+    print("F=%d Q=%d K=%d" % (F, Q, K))
+    print("%10s %12s %12s %12s %10s" % (
+        'N', 'brute (s)', 'build (s)', 'query (s)', 'auto'))
+    prng = np.random.RandomState(0)
+    for N in N_list:
+        data_NF = prng.randn(N, F)
+        query_QF = prng.randn(Q, F)
+        start = time.perf_counter()
+        calc_k_nearest_neighbor_ids(data_NF, query_QF, K=K, algorithm='brute')
+        brute_sec = time.perf_counter() - start
+        start = time.perf_counter()
+        tree = KDTree(data_NF)
+        build_sec = time.perf_counter() - start
+        start = time.perf_counter()
+        tree.query(query_QF, K=K)
+        query_sec = time.perf_counter() - start
+        print("%10d %12.3f %12.3f %12.3f %10s" % (
+            N, brute_sec, build_sec, query_sec, _choose_algorithm(N, F, Q)))
+
+
+def benchmark_scaling(N=20000, F=64, Q=4000, K=10, n_jobs_list=None):
+    ''' Show speedup of brute-force search as n_jobs grows from 1 to all cores
+    '''
+    if n_jobs_list is None:
+        n_cores = os.cpu_count() or 1
+        n_jobs_list = sorted(set(
+            [2 ** p for p in range(n_cores.bit_length()) if 2 ** p <= n_cores]
+            + [n_cores]))
+    prng = np.random.RandomState(0)
+    data_NF = prng.randn(N, F)
+    query_QF = prng.randn(Q, F)
+    print("N=%d F=%d Q=%d K=%d cores=%d" % (N, F, Q, K, os.cpu_count() or 1))
+    print("%8s %12s %10s" % ('n_jobs', 'time (s)', 'speedup'))
+    base_sec = None
+    for n_jobs in n_jobs_list:
+        start = time.perf_counter()
+        calc_k_nearest_neighbor_ids(
+            data_NF, query_QF, K=K, algorithm='brute', n_jobs=n_jobs)
+        elapsed_sec = time.perf_counter() - start
+        if base_sec is None:
+            base_sec = elapsed_sec
+        print("%8d %12.3f %10.2f" % (n_jobs, elapsed_sec, base_sec / elapsed_sec))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'benchmark', choices=['memory', 'algorithms', 'scaling', 'one'])
+    parser.add_argument('--N', type=int, default=20000)
+    parser.add_argument('--F', type=int, default=64)
+    parser.add_argument('--Q', type=int, default=1000)
+    parser.add_argument('--K', type=int, default=10)
+    parser.add_argument('--max_bytes', type=int, default=16 * 2**20)
+    args = parser.parse_args()
+
+    if args.benchmark == 'one':
+        info = measure_one_run(args.N, args.F, args.Q, args.K, args.max_bytes)
+        print("%.6f %.3f" % (info['elapsed_sec'], info['peak_rss_mb']))
+    elif args.benchmark == 'algorithms':
+        benchmark_algorithms(K=args.K)
+    elif args.benchmark == 'scaling':
+        benchmark_scaling(N=args.N, F=args.F, Q=args.Q, K=args.K)
+    else:
+        benchmark_memory(N=args.N, F=args.F, K=args.K, max_bytes=args.max_bytes)
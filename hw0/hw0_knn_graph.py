@@ -0,0 +1,301 @@
+'''
+hw0_knn_graph.py
+
+Summary
+-------
+K-nearest neighbor graph of a dataset against itself (a "self-join").
+
+Calling calc_k_nearest_neighbor_ids(data_NF, data_NF, K + 1) and dropping
+each row's own match does twice the needed work, since the distance from
+row a to row b equals the distance from b to a. Here the N x N distance
+matrix is visited one (T x T) tile at a time, only for tiles on or above
+the diagonal. Each tile updates the running top-K of both its row block
+and (transposed) its column block. Scratch memory stays within max_bytes.
+
+Each row's own match is excluded, but other rows with identical features
+are kept, so exact duplicates show up as neighbors at distance zero.
+
+Results match calc_k_nearest_neighbor_ids exactly, including breaking
+ties between equally close rows by row order.
+
+The graph comes back in compressed sparse row (CSR) form, which can be
+saved to disk and loaded back.
+
+Examples
+--------
+>>> data_NF = np.asarray([[0., 0.], [0., 1.], [5., 5.], [0., 0.], [5., 6.]])
+>>> graph = calc_k_nearest_neighbor_graph(data_NF, K=2)
+>>> graph.get_ids_NK()
+array([[3, 1],
+       [0, 3],
+       [4, 1],
+       [0, 1],
+       [2, 1]])
+>>> graph.indptr_N1
+array([ 0,  2,  4,  6,  8, 10])
+>>> ids_K, dist_K = graph.get_neighbors(0)
+>>> print(ids_K, dist_K)
+[3 1] [0. 1.]
+
+Regression Test Against Querying With The Data Itself
+-----------------------------------------------------
+>>> prng = np.random.RandomState(0)
+>>> grid_NF = prng.randint(-2, 3, size=(300, 3)).astype(np.float64)
+>>> dist_NN = np.sum(np.square(grid_NF[None] - grid_NF[:, None]), axis=2)
+>>> np.fill_diagonal(dist_NN, np.inf)
+>>> for K in [1, 7, 50, 299]:
+...     expected_NK = np.argsort(dist_NN, axis=1, kind='stable')[:, :K]
+...     for max_bytes in [64, 10000, DEFAULT_MAX_BYTES]:
+...         graph = calc_k_nearest_neighbor_graph(
+...             grid_NF, K=K, max_bytes=max_bytes)
+...         assert np.array_equal(graph.get_ids_NK(), expected_NK), (K, max_bytes)
+
+# Other metrics agree with querying the data against itself
+>>> for metric in ['cosine', 'inner_product']:
+...     ids_NK = calc_k_nearest_neighbor_ids(
+...         grid_NF, grid_NF, K=300, metric=metric)
+...     is_self_NK = ids_NK == np.arange(300)[:, None]
+...     expected_NK = ids_NK[~is_self_NK].reshape(300, 299)[:, :5]
+...     graph = calc_k_nearest_neighbor_graph(grid_NF, K=5, metric=metric)
+...     print(metric, np.array_equal(graph.get_ids_NK(), expected_NK))
+cosine True
+inner_product True
+
+Example Test Save and Load
+--------------------------
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'graph.npz')
+>>> graph.save(path)
+>>> loaded_graph = load_knn_graph(path)
+>>> np.array_equal(loaded_graph.get_ids_NK(), graph.get_ids_NK())
+True
+>>> np.array_equal(loaded_graph.dist_L, graph.dist_L)
+True
+'''
+
+import numpy as np
+
+from hw0_knn import (
+    DEFAULT_MAX_BYTES, METRIC_NAMES, PreparedDataset,
+    calc_k_nearest_neighbor_ids, _calc_sq_dist_to_rows, _convert_distance)
+
+
+class KNNGraph(object):
+    ''' Sparse neighbor graph in compressed sparse row (CSR) form
+
+    Same layout as scipy.sparse.csr_matrix, so
+    csr_matrix((graph.dist_L, graph.indices_L, graph.indptr_N1)) converts it.
+
+    Attributes
+    ----------
+    * self.indptr_N1 : 1D numpy array of int, size N + 1
+        Neighbors of row n are entries indptr_N1[n]:indptr_N1[n+1]
+        of self.indices_L and self.dist_L
+    * self.indices_L : 1D numpy array of int, size L (total edges)
+        Row id of each neighbor, nearest first within each row
+    * self.dist_L : 1D numpy array, size L
+        Distance to each neighbor, as returned by calc_k_nearest_neighbor_ids
+    * self.metric : str
+    '''
+
+    def __init__(self, indptr_N1, indices_L, dist_L, metric='euclidean'):
+        self.indptr_N1 = np.asarray(indptr_N1)
+        self.indices_L = np.asarray(indices_L)
+        self.dist_L = np.asarray(dist_L)
+        self.metric = str(metric)
+
+    def get_neighbors(self, n):
+        ''' Get neighbor ids and distances of one row
+
+        Returns
+        -------
+        ids_K : 1D np.array of int
+        dist_K : 1D np.array
+        '''
+        start, stop = self.indptr_N1[n], self.indptr_N1[n + 1]
+        return self.indices_L[start:stop], self.dist_L[start:stop]
+
+    def get_ids_NK(self):
+        ''' Get neighbor ids as a dense (N, K) array
+
+        Only valid when every row has the same number of neighbors K.
+        '''
+        N = self.indptr_N1.size - 1
+        return self.indices_L.reshape(N, -1)
+
+    def save(self, path):
+        ''' Save graph to a .npz file, readable by load_knn_graph
+
+        Returns
+        -------
+        Nothing.
+        '''
+        np.savez(
+            path, indptr_N1=self.indptr_N1, indices_L=self.indices_L,
+            dist_L=self.dist_L, metric=np.asarray(self.metric))
+
+
+def load_knn_graph(path):
+    ''' Load a graph previously written by KNNGraph.save
+
+    Returns
+    -------
+    graph : KNNGraph
+    '''
+    with np.load(path) as npz:
+        return KNNGraph(
+            npz['indptr_N1'], npz['indices_L'], npz['dist_L'],
+            metric=str(npz['metric']))
+
+
+def calc_k_nearest_neighbor_graph(
+        data_NF, K=1, max_bytes=DEFAULT_MAX_BYTES, metric='euclidean'):
+    ''' Compute K nearest other rows for every row of a dataset
+
+    Args
+    ----
+    data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
+        Each row is a feature vector for one example in dataset
+        May also be a PreparedDataset wrapping such an array.
+    K : int, must satisfy K >= 1 and K <= N - 1
+        Number of neighbors to find per row
+    max_bytes : int
+        Approximate budget for scratch memory used at any one time,
+        not counting the (N, K) output.
+    metric : str, one of METRIC_NAMES
+
+    Returns
+    -------
+    graph : KNNGraph
+        Row n lists the K nearest rows other than n itself.
+        If two rows are equally close, the one appearing first wins.
+    '''
+    if isinstance(data_NF, PreparedDataset):
+        prepared = data_NF
+    else:
+        prepared = PreparedDataset(data_NF)
+    N, F = prepared.data_NF.shape
+    K = int(K)
+    if K < 1:
+        raise ValueError("Invalid number of neighbors (K). Too small.")
+    if K > N - 1:
+        raise ValueError("Invalid number of neighbors (K). Too large.")
+    if metric not in METRIC_NAMES:
+        raise ValueError("Unrecognized metric: %s" % metric)
+    is_euclidean = metric in ('euclidean', 'sqeuclidean')
+    if metric == 'cosine':
+        data_NF = prepared.get_unit_data_NF()
+    else:
+        data_NF = prepared.data_NF
+    T = _calc_tile_size(N, F, K, max_bytes)
+
+    # Running top K of each row block, as lists of (T, <=K) arrays
+    starts = list(range(0, N, T))
+    best_ids_list = [np.zeros((min(T, N - s), 0), dtype=np.intp) for s in starts]
+    best_dist_list = [np.zeros((min(T, N - s), 0)) for s in starts]
+    for i, i_start in enumerate(starts):
+        i_stop = min(N, i_start + T)
+        data_IF = np.asarray(data_NF[i_start:i_stop], dtype=np.float64)
+        sqnorm_I = prepared.sqnorm_N[i_start:i_stop]
+        # Tiles below the diagonal are the transposes of tiles above it
+        for j in range(i, len(starts)):
+            j_start = starts[j]
+            j_stop = min(N, j_start + T)
+            data_JF = np.asarray(data_NF[j_start:j_stop], dtype=np.float64)
+            sqnorm_J = prepared.sqnorm_N[j_start:j_stop]
+            if is_euclidean:
+                approx_dist_IJ = (
+                    sqnorm_I[:, None] - 2.0 * np.dot(data_IF, data_JF.T)
+                    + sqnorm_J[None, :])
+            else:
+                approx_dist_IJ = -np.dot(data_IF, data_JF.T)
+            if i == j:
+                np.fill_diagonal(approx_dist_IJ, np.inf)
+
+            best_ids_list[i], best_dist_list[i] = _merge_tile_into_top_k(
+                best_ids_list[i], best_dist_list[i], approx_dist_IJ,
+                data_IF, sqnorm_I, i_start, data_JF, sqnorm_J, j_start,
+                K, is_euclidean, max_bytes)
+            if i != j:
+                best_ids_list[j], best_dist_list[j] = _merge_tile_into_top_k(
+                    best_ids_list[j], best_dist_list[j], approx_dist_IJ.T,
+                    data_JF, sqnorm_J, j_start, data_IF, sqnorm_I, i_start,
+                    K, is_euclidean, max_bytes)
+
+    ids_NK = np.vstack(best_ids_list)
+    dist_NK = _convert_distance(np.vstack(best_dist_list), metric)
+    return KNNGraph(
+        np.arange(0, N * K + 1, K), ids_NK.ravel(), dist_NK.ravel(),
+        metric=metric)
+
+
+def _calc_tile_size(N, F, K, max_bytes):
+    ''' Choose tile size T so one tile's scratch arrays fit in max_bytes
+
+    Per tile we hold two T-row data blocks plus a T x T distance matrix,
+    its partitioned copy and sort indices, and the T x K x F candidate
+    differences used for re-scoring.
+
+    Returns
+    -------
+    T : int
+        Number of rows per tile, at least min(N, K + 1)
+    '''
+    # Solve 24 T^2 + (16 F + 16 K F) T <= max_bytes for T
+    b = 16.0 * F * (K + 1)
+    T = int((-b + np.sqrt(b * b + 96.0 * max_bytes)) / 48.0)
+    return int(min(N, max(K + 1, T)))
+
+
+def _merge_tile_into_top_k(
+        best_ids_BK, best_dist_BK, approx_dist_BT,
+        query_BF, sqnorm_B, b_start, data_TF, sqnorm_T, t_start,
+        K, is_euclidean, max_bytes):
+    ''' Merge one tile of distances into the running top K of its rows
+
+    As in hw0_knn._calc_k_nearest_neighbor_ids_for_block, only entries
+    within a roundoff bound of the K-th best are re-scored with the direct
+    distance, then merged ordering by distance and then row id.
+    Each row's own match (infinite in approx_dist_BT) is never kept.
+
+    Returns
+    -------
+    best_ids_BK : 2D np.array of int, shape (B, <=K)
+    best_dist_BK : 2D np.array, shape (B, <=K)
+    '''
+    B, cur_T = approx_dist_BT.shape
+    if is_euclidean:
+        tol_B = 4.0 * (query_BF.shape[1] + 4) * np.finfo(np.float64).eps * (
+            sqnorm_B + sqnorm_T.max())
+    else:
+        tol_B = np.zeros(B)
+
+    thresh_B = np.full(B, np.inf)
+    if cur_T > K:
+        kth_B = np.partition(approx_dist_BT, K - 1, axis=1)[:, K - 1]
+        thresh_B = kth_B + 2.0 * tol_B
+    if best_dist_BK.shape[1] == K:
+        thresh_B = np.minimum(thresh_B, best_dist_BK[:, K - 1] + tol_B)
+    M = int(np.max(np.sum(approx_dist_BT <= thresh_B[:, None], axis=1)))
+    if M == 0:
+        return best_ids_BK, best_dist_BK
+
+    if M < cur_T:
+        cand_ids_BM = np.argpartition(approx_dist_BT, M - 1, axis=1)[:, :M]
+    else:
+        cand_ids_BM = np.tile(np.arange(cur_T), (B, 1))
+    if is_euclidean:
+        cand_dist_BM = _calc_sq_dist_to_rows(
+            data_TF, query_BF, cand_ids_BM, max_bytes)
+    else:
+        cand_dist_BM = np.take_along_axis(approx_dist_BT, cand_ids_BM, axis=1)
+    cand_ids_BM = cand_ids_BM + t_start
+    is_self_BM = cand_ids_BM == np.arange(b_start, b_start + B)[:, None]
+    cand_dist_BM[is_self_BM] = np.inf
+
+    all_dist_BL = np.hstack([best_dist_BK, cand_dist_BM])
+    all_ids_BL = np.hstack([best_ids_BK, cand_ids_BM])
+    order_BL = np.lexsort((all_ids_BL, all_dist_BL), axis=1)[:, :K]
+    return (
+        np.take_along_axis(all_ids_BL, order_BL, axis=1),
+        np.take_along_axis(all_dist_BL, order_BL, axis=1))
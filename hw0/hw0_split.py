@@ -38,6 +38,60 @@ Examples
 >>> np.allclose(x_LF, xcopy_LF)
 True
 
+Example Test Preallocated Output
+--------------------------------
+# Outputs can be written into buffers the caller allocated once
+>>> out = (np.zeros((4, 2), dtype=x_LF.dtype), np.zeros((2, 2), dtype=x_LF.dtype))
+>>> train_MF, test_NF = split_into_train_and_test(
+...     x_LF, frac_test=2/6, random_state=np.random.RandomState(0), out=out)
+>>> train_MF is out[0], test_NF is out[1]
+(True, True)
+>>> print(test_NF)
+[[ 0 11]
+ [-2 55]]
+
+# Many splits of the same array, all written into the same two buffers.
+# Each split matches one call of split_into_train_and_test in sequence.
+>>> prng = np.random.RandomState(0)
+>>> for train_MF, test_NF in iterate_train_and_test_splits(
+...         x_LF, n_splits=3, frac_test=2/6, random_state=np.random.RandomState(0)):
+...     expected_MF, expected_NF = split_into_train_and_test(
+...         x_LF, frac_test=2/6, random_state=prng)
+...     print(np.array_equal(train_MF, expected_MF),
+...           np.array_equal(test_NF, expected_NF),
+...           np.shares_memory(train_MF, x_LF))
+True True False
+True True False
+True True False
+
+Example Test Stratified and Grouped
+-----------------------------------
+# Stratified splits keep each class in the same proportion
+>>> y_L = np.asarray([0] * 60 + [1] * 30 + [2] * 10)
+>>> xy_LF = np.hstack([np.arange(100)[:, None], y_L[:, None]])
+>>> train_MF, test_NF = split_into_train_and_test(
+...     xy_LF, frac_test=0.2, random_state=0, stratify=y_L)
+>>> np.bincount(test_NF[:, 1]), np.bincount(train_MF[:, 1])
+(array([12,  6,  2]), array([48, 24,  8]))
+
+# Grouped splits never put members of the same group on both sides
+>>> g_L = np.arange(100) // 7
+>>> train_MF, test_NF = split_into_train_and_test(
+...     xy_LF, frac_test=0.2, random_state=0, groups=g_L)
+>>> np.intersect1d(g_L[train_MF[:, 0]], g_L[test_NF[:, 0]]).size
+0
+>>> test_NF.shape[0] >= 20, train_MF.shape[0] + test_NF.shape[0]
+(True, 100)
+
+Example Test Generator
+----------------------
+# The modern np.random.Generator works anywhere RandomState does
+>>> train_MF, test_NF = split_into_train_and_test(
+...     x_LF, frac_test=2/6, random_state=np.random.default_rng(0))
+>>> print(test_NF)
+[[ 0 11]
+ [ 0 22]]
+
 References
 ----------
 For more about RandomState, see:
@@ -46,7 +100,10 @@ https://stackoverflow.com/questions/28064634/random-state-pseudo-random-numberin
 
 import numpy as np
 
-def split_into_train_and_test(x_all_LF, frac_test=0.5, random_state=None):
+
+def split_into_train_and_test(
+        x_all_LF, frac_test=0.5, random_state=None, out=None,
+        stratify=None, groups=None):
     ''' Divide provided array into train and test sets along first dimension
 
     User can provide random number generator object to ensure reproducibility.
@@ -59,9 +116,23 @@ def split_into_train_and_test(x_all_LF, frac_test=0.5, random_state=None):
         Indicates fraction of all L examples to allocate to the "test" set
         Returned test set will round UP if frac_test * L is not an integer.
         e.g. if L = 10 and frac_test = 0.31, then test set has N=4 examples
-    random_state : np.random.RandomState instance or integer or None
+    random_state : np.random.RandomState or np.random.Generator instance,
+        or integer or None
         If int, will create RandomState instance with provided value as seed
         If None, defaults to current numpy random number generator np.random.
+        A Generator (e.g. np.random.default_rng(seed)) is faster, but gives
+        different splits than a RandomState with the same seed.
+    out : tuple of two 2D np.arrays, or None
+        If provided, buffers of shape (M, F) and (N, F), with the same dtype
+        as x_all_LF, into which the train and test rows are written.
+        Must not share memory with x_all_LF.
+    stratify : 1D np.array, shape = (n_total_examples,) (L,), or None
+        If provided, class label of each example. Each class is split in
+        (nearly) the same proportion as the whole, see calc_stratified_n_test.
+    groups : 1D np.array, shape = (n_total_examples,) (L,), or None
+        If provided, group label of each example. All examples of a group
+        land on the same side. Whole groups are added to the test set until
+        it holds at least ceil(frac_test * L) examples, so it may hold more.
 
     Returns
     -------
@@ -78,28 +149,474 @@ def split_into_train_and_test(x_all_LF, frac_test=0.5, random_state=None):
     This function should be side-effect free. Provided input array x_all_LF
     should not change at all (not be shuffled, etc.)
     '''
+    random_state = _resolve_random_state(random_state)
+    L = x_all_LF.shape[0]
+    train_ids_M, test_ids_N = _calc_train_and_test_row_ids(
+        L, frac_test, random_state, stratify=stratify, groups=groups)
+    return _gather_split(x_all_LF, train_ids_M, test_ids_N, out)
+
+
+def _gather_split(x_all_LF, train_ids_M, test_ids_N, out=None):
+    ''' Copy train and test rows into new arrays, or into buffers out
+
+    Returns
+    -------
+    x_train_MF, x_test_NF : 2D np.arrays
+    '''
+    F = x_all_LF.shape[1]
+    M, N = train_ids_M.size, test_ids_N.size
+    if out is None:
+        out = (
+            np.empty((M, F), dtype=x_all_LF.dtype),
+            np.empty((N, F), dtype=x_all_LF.dtype))
+    x_train_MF, x_test_NF = _check_out_buffers(x_all_LF, M, N, out)
+
+    # Ids are always in range, so mode='clip' lets take write straight
+    # into the output instead of through a temporary buffer.
+    np.take(x_all_LF, train_ids_M, axis=0, out=x_train_MF, mode='clip')
+    np.take(x_all_LF, test_ids_N, axis=0, out=x_test_NF, mode='clip')
+    return x_train_MF, x_test_NF
+
+
+def iterate_train_and_test_splits(
+        x_all_LF, n_splits, frac_test=0.5, random_state=None, out=None,
+        stratify=None, groups=None):
+    ''' Generate many random train/test splits of the same array
+
+    Split i is the same as the i-th of n_splits calls in a row to
+    split_into_train_and_test with the same random_state. Every split is
+    written into the same pair of output buffers, and row ids are shuffled
+    in one buffer, all allocated once, so no memory is allocated per split. Copy a split if you need to keep it
+    past the next iteration.
+
+    With groups, split sizes vary, so each split gets fresh arrays
+    unless out is provided.
+
+    Args
+    ----
+    x_all_LF, frac_test, random_state, out, stratify, groups
+        See split_into_train_and_test.
+    n_splits : int
+        Number of splits to generate
+
+    Returns
+    -------
+    split_iterator : generator of (x_train_MF, x_test_NF) tuples
+        Outputs never share memory with x_all_LF.
+    '''
+    random_state = _resolve_random_state(random_state)
+    L, F = x_all_LF.shape
+    N = int(np.ceil(L * float(frac_test)))
+    M = L - N
+    if out is None and groups is None:
+        out = (
+            np.empty((M, F), dtype=x_all_LF.dtype),
+            np.empty((N, F), dtype=x_all_LF.dtype))
+    arange_L = np.arange(L)
+    ids_L = np.empty_like(arange_L)
+    for _ in range(int(n_splits)):
+        train_ids_M, test_ids_N = _calc_train_and_test_row_ids(
+            L, frac_test, random_state, stratify=stratify, groups=groups,
+            ids_buffers=(arange_L, ids_L))
+        yield _gather_split(x_all_LF, train_ids_M, test_ids_N, out)
+
+
+def make_train_and_test_row_ids(
+        n_total_examples, frac_test=0.5, random_state=None,
+        stratify=None, groups=None, n_test=None):
+    ''' Draw row ids of a random train/test split, without copying any data
+
+    Uses random numbers exactly as split_into_train_and_test does, so
+    for the same random_state, x_all_LF[train_ids_M] and
+    x_all_LF[test_ids_N] equal that function's outputs.
+
+    Args
+    ----
+    n_total_examples : int
+        Number of examples L to split
+    frac_test, random_state, stratify, groups
+        See split_into_train_and_test.
+    n_test : int or None
+        If set, the exact number of test examples N (at least, with
+        groups), used in place of ceil(frac_test * L).
+
+    Returns
+    -------
+    train_ids_M : 1D np.array of int, size M
+        Row ids of training examples, in random order
+    test_ids_N : 1D np.array of int, size N
+        Row ids of test examples, in random order
+
+    Examples
+    --------
+    >>> x_LF = np.arange(12).reshape(6, 2)
+    >>> train_ids_M, test_ids_N = make_train_and_test_row_ids(
+    ...     6, frac_test=2/6, random_state=0)
+    >>> train_ids_M, test_ids_N
+    (array([5, 2, 1, 3]), array([0, 4]))
+    >>> x_train_MF, x_test_NF = split_into_train_and_test(
+    ...     x_LF, frac_test=2/6, random_state=0)
+    >>> np.array_equal(x_LF[train_ids_M], x_train_MF)
+    True
+
+    # Ask for a test set size directly, here 3 of each class
+    >>> y_L = np.asarray([0, 1] * 50)
+    >>> train_ids_M, test_ids_N = make_train_and_test_row_ids(
+    ...     100, random_state=0, stratify=y_L, n_test=6)
+    >>> np.bincount(y_L[test_ids_N])
+    array([3, 3])
+    '''
+    random_state = _resolve_random_state(random_state)
+    train_ids_M, test_ids_N = _calc_train_and_test_row_ids(
+        int(n_total_examples), frac_test, random_state,
+        stratify=stratify, groups=groups, n_test=n_test)
+    return train_ids_M, test_ids_N
+
+
+def make_train_and_test_views(
+        x_all_LF, frac_test=0.5, random_state=None,
+        stratify=None, groups=None):
+    ''' Split provided array lazily, gathering rows only when asked
+
+    Same split as split_into_train_and_test for the same random_state,
+    but only row ids are stored. Peak memory stays at the size of the
+    batches requested, which matters when x_all_LF is a large np.memmap.
+
+    Returns
+    -------
+    train_view : SplitView
+    test_view : SplitView
+
+    Examples
+    --------
+    >>> x_LF = np.arange(12).reshape(6, 2)
+    >>> train_view, test_view = make_train_and_test_views(
+    ...     x_LF, frac_test=2/6, random_state=0)
+    >>> len(train_view), test_view.shape
+    (4, (2, 2))
+    >>> for x_BF in train_view.iterate_batches(batch_size=3):
+    ...     print(x_BF.tolist())
+    [[10, 11], [4, 5], [2, 3]]
+    [[6, 7]]
+    >>> np.array_equal(
+    ...     train_view.to_array(),
+    ...     split_into_train_and_test(x_LF, frac_test=2/6, random_state=0)[0])
+    True
+    '''
+    train_ids_M, test_ids_N = make_train_and_test_row_ids(
+        x_all_LF.shape[0], frac_test=frac_test, random_state=random_state,
+        stratify=stratify, groups=groups)
+    return SplitView(x_all_LF, train_ids_M), SplitView(x_all_LF, test_ids_N)
+
+
+class SplitView(object):
+    ''' Lazy subset of the rows of an array
+
+    Holds a reference to the full array plus the selected row ids.
+    Rows are copied out only by indexing, iterate_batches or to_array,
+    and those copies never share memory with the full array.
+
+    Attributes
+    ----------
+    * self.x_all_LF : 2D np.array or np.memmap, shape (L, F)
+        The full array, not copied
+    * self.row_ids_M : 1D np.array of int, size M
+        Rows of x_all_LF in this subset, in order
+    '''
+
+    def __init__(self, x_all_LF, row_ids_M):
+        self.x_all_LF = x_all_LF
+        self.row_ids_M = np.asarray(row_ids_M)
+
+    def __len__(self):
+        return self.row_ids_M.size
+
+    @property
+    def shape(self):
+        return (self.row_ids_M.size,) + tuple(self.x_all_LF.shape[1:])
+
+    def __getitem__(self, key):
+        ''' Gather the rows at positions key (an int, slice or int array)
+        '''
+        row_ids = self.row_ids_M[key]
+        if np.ndim(row_ids) == 0:
+            return np.array(self.x_all_LF[row_ids])
+        return _gather_rows(self.x_all_LF, row_ids)
+
+    def iterate_batches(self, batch_size=256):
+        ''' Generate consecutive batches of rows, each freshly gathered
+
+        Returns
+        -------
+        batch_iterator : generator of 2D np.arrays, shape (<=batch_size, F)
+        '''
+        batch_size = max(1, int(batch_size))
+        for start in range(0, len(self), batch_size):
+            yield self[start:start + batch_size]
+
+    def to_array(self, out=None):
+        ''' Gather all rows into one array, or into provided buffer out
+        '''
+        if out is None:
+            return _gather_rows(self.x_all_LF, self.row_ids_M)
+        if np.shares_memory(out, self.x_all_LF):
+            raise ValueError("Output buffer must not share memory with input")
+        return np.take(
+            self.x_all_LF, self.row_ids_M, axis=0, out=out, mode='clip')
+
+
+def _gather_rows(x_all_LF, row_ids_B):
+    ''' Copy selected rows, reading them in ascending row order
+
+    Ascending reads are much faster than random ones when x_all_LF is a
+    memory-mapped file. Rows are put back into the requested order after.
+    '''
+    order_B = np.argsort(row_ids_B, kind='stable')
+    rows_BF = np.empty(
+        (row_ids_B.size,) + tuple(x_all_LF.shape[1:]), dtype=x_all_LF.dtype)
+    rows_BF[order_B] = x_all_LF[row_ids_B[order_B]]
+    return rows_BF
+
+
+def calc_stratified_n_test(count_C, n_test):
+    ''' Divide a test set size among classes in proportion to class sizes
+
+    Class c gets floor(n_test * count_C[c] / L) examples, then the few left
+    over go one each to the classes with the largest remainders (earlier
+    classes first among equal remainders).
+
+    Args
+    ----
+    count_C : 1D np.array of int, size C
+        Number of examples of each class, summing to L
+    n_test : int
+        Total test set size, at most L
+
+    Returns
+    -------
+    n_test_C : 1D np.array of int, size C
+        Test examples per class. Sums to n_test, never exceeds count_C.
+
+    Examples
+    --------
+    >>> calc_stratified_n_test(np.asarray([6, 3, 1]), 4)
+    array([3, 1, 0])
+    >>> calc_stratified_n_test(np.asarray([5, 5, 0]), 3)
+    array([2, 1, 0])
+    '''
+    count_C = np.asarray(count_C)
+    L = int(np.sum(count_C))
+    exact_C = count_C * (float(n_test) / max(L, 1))
+    n_test_C = np.floor(exact_C).astype(count_C.dtype)
+    n_left = int(n_test - np.sum(n_test_C))
+    if n_left > 0:
+        order_C = np.argsort(-(exact_C - n_test_C), kind='stable')
+        n_test_C[order_C[:n_left]] += 1
+    return n_test_C
+
+
+def _calc_train_and_test_row_ids(
+        L, frac_test, random_state, stratify=None, groups=None, n_test=None,
+        ids_buffers=None):
+    ''' Draw random row ids for train and test sets
+
+    Every mode takes time linear in L: class and group sizes come from
+    counting (np.bincount), and rows are grouped by class with a stable
+    sort of small integer codes, which NumPy does by radix sort.
+
+    If ids_buffers = (arange_L, ids_L) is provided, row ids are shuffled
+    inside ids_L, which the next call with the same buffers overwrites.
+    This gives the same order as random_state.permutation(L), since that
+    shuffles a fresh arange in place, exactly as done here.
+
+    Returns
+    -------
+    train_ids_M : 1D np.array of int, size M
+    test_ids_N : 1D np.array of int, size N
+        Both in random order
+    '''
+    if stratify is not None and groups is not None:
+        raise ValueError("Cannot use both stratify and groups")
+    # Random shuffle of row ids corresponding to all L provided examples
+    if ids_buffers is None:
+        shuffled_ids_L = random_state.permutation(L)
+    else:
+        arange_L, shuffled_ids_L = ids_buffers
+        shuffled_ids_L[:] = arange_L
+        random_state.shuffle(shuffled_ids_L)
+
+    # Determine the number of test examples N
+    if n_test is None:
+        N = int(np.ceil(L * float(frac_test)))
+    else:
+        N = int(n_test)
+        if N < 0 or N > L:
+            raise ValueError("Need n_test between 0 and %d, got %d" % (L, N))
+    if stratify is None and groups is None:
+        # Keep first M examples as training, remaining N as test
+        M = L - N
+        return shuffled_ids_L[:M], shuffled_ids_L[M:]
+
+    if stratify is not None:
+        code_L, C = _encode_labels(stratify, L)
+        count_C = np.bincount(code_L, minlength=C)
+        n_test_C = calc_stratified_n_test(count_C, N)
+        # Group shuffled rows by class. Stable sort keeps shuffled order
+        # within each class, so the first n_test_C[c] of class c are
+        # a uniformly random subset.
+        code_in_order_L = code_L[shuffled_ids_L]
+        by_class_L = np.argsort(code_in_order_L, kind='stable')
+        start_C = np.cumsum(count_C) - count_C
+        rank_L = np.arange(L) - np.repeat(start_C, count_C)
+        is_test_in_order_L = np.empty(L, dtype=bool)
+        is_test_in_order_L[by_class_L] = (
+            rank_L < np.repeat(n_test_C, count_C))
+    else:
+        code_L, G = _encode_labels(groups, L)
+        count_G = np.bincount(code_L, minlength=G)
+        # Add whole groups, in random order, until the test set is big enough
+        shuffled_groups_G = random_state.permutation(G)
+        n_test_groups = int(np.searchsorted(
+            np.cumsum(count_G[shuffled_groups_G]), N)) + int(N > 0)
+        is_test_G = np.zeros(G, dtype=bool)
+        is_test_G[shuffled_groups_G[:n_test_groups]] = True
+        is_test_in_order_L = is_test_G[code_L[shuffled_ids_L]]
+    return (
+        shuffled_ids_L[~is_test_in_order_L],
+        shuffled_ids_L[is_test_in_order_L])
+
+
+def _encode_labels(label_L, L):
+    ''' Map arbitrary labels onto small integer codes 0, 1, ... C-1
+
+    Integer labels spanning a range no wider than L are just shifted,
+    in linear time. Other labels are mapped via np.unique.
+    Codes use the smallest unsigned integer type that holds them,
+    so NumPy's stable sort on them is a linear-time radix sort.
+
+    Returns
+    -------
+    code_L : 1D np.array of unsigned int, size L
+    C : int
+        Number of codes. Some codes may be unused.
+    '''
+    label_L = np.asarray(label_L)
+    if label_L.shape != (L,):
+        raise ValueError("Expected labels of shape %s, got %s" % (
+            (L,), label_L.shape))
+    is_narrow_int = False
+    if L > 0 and np.issubdtype(label_L.dtype, np.integer):
+        lo, hi = int(label_L.min()), int(label_L.max())
+        is_narrow_int = hi - lo < L
+    if is_narrow_int:
+        code_L = label_L.astype(np.intp) - lo
+        C = hi - lo + 1
+    else:
+        _, code_L = np.unique(label_L, return_inverse=True)
+        C = int(code_L.max()) + 1 if L > 0 else 0
+    for dtype in (np.uint8, np.uint16):
+        if C <= np.iinfo(dtype).max + 1:
+            return code_L.astype(dtype), C
+    return code_L.astype(np.intp), C
+
+
+def spawn_random_states(random_state, n_children, bit_generator_class=None):
+    ''' Make independent random number generators, e.g. one per worker
+
+    Children come from np.random.SeedSequence.spawn, so their streams are
+    statistically independent and do not depend on the order in which
+    workers use them. Split i is reproducible from (random_state, i) alone.
+
+    Args
+    ----
+    random_state : integer, np.random.Generator, np.random.RandomState or None
+        Parent seed or generator. A Generator spawns from its own seed
+        sequence (so repeated calls give new children). A RandomState, or
+        np.random if None, provides the child seed by drawing from its stream.
+    n_children : int
+        Number of generators to make
+    bit_generator_class : class or None
+        Bit generator for children, e.g. np.random.PCG64 or the
+        counter-based np.random.Philox. If None, same as the parent
+        Generator, or PCG64 otherwise.
+
+    Returns
+    -------
+    child_list : list of np.random.Generator, length n_children
+
+    Examples
+    --------
+    >>> def split_for_worker(child):
+    ...     return make_train_and_test_row_ids(10, 0.3, random_state=child)[1]
+    >>> test_ids_list = [split_for_worker(child)
+    ...     for child in spawn_random_states(42, 3)]
+    >>> [ids.tolist() for ids in test_ids_list]
+    [[0, 8, 6], [9, 5, 7], [0, 4, 6]]
+
+    # Same seed gives the same children, here using counter-based Philox
+    >>> children = spawn_random_states(42, 3, np.random.Philox)
+    >>> type(children[0].bit_generator).__name__
+    'Philox'
+    >>> [np.array_equal(split_for_worker(a), split_for_worker(b)) for a, b in zip(
+    ...     children, spawn_random_states(42, 3, np.random.Philox))]
+    [True, True, True]
+    '''
+    if isinstance(random_state, np.random.Generator):
+        bit_generator = random_state.bit_generator
+        seed_seq = getattr(bit_generator, 'seed_seq', None)
+        if seed_seq is None:
+            # Older NumPy keeps the seed sequence under a private name
+            seed_seq = bit_generator._seed_seq
+        if bit_generator_class is None:
+            bit_generator_class = type(bit_generator)
+    else:
+        if random_state is None or hasattr(random_state, 'randint'):
+            random_state = _resolve_random_state(random_state)
+            random_state = random_state.randint(0, 2**32, size=4)
+        seed_seq = np.random.SeedSequence(random_state)
+    if bit_generator_class is None:
+        bit_generator_class = np.random.PCG64
+    return [
+        np.random.Generator(bit_generator_class(child_seed_seq))
+        for child_seed_seq in seed_seq.spawn(int(n_children))]
+
+
+def _resolve_random_state(random_state):
+    ''' Convert a random_state argument into a random number generator
+
+    Returns
+    -------
+    random_state : np.random.RandomState, np.random.Generator or np.random
+        Anything with shuffle and permutation methods
+    '''
     if random_state is None:
         random_state = np.random
-    elif isinstance(random_state, int):
+    elif isinstance(random_state, (int, np.integer)):
         random_state = np.random.RandomState(int(random_state))
-    if not hasattr(random_state, 'rand'):
+    if not (hasattr(random_state, 'shuffle')
+            and hasattr(random_state, 'permutation')):
         raise ValueError("Not a valid random number generator")
+    return random_state
 
-    # Random shuffle of row ids corresponding to all L provided examples
-    L, F = x_all_LF.shape
-    shuffled_ids_L = random_state.permutation(np.arange(L))
-
-    # Determine the number of test examples N
-    N = int(np.ceil(L * float(frac_test)))
-    # Keep remaining M examples as training
-    M = L - N
 
-    # TODO use the first M row ids in shuffled_ids_L to make x_train_MF
-    
-    x_train_MF = x_all_LF[(shuffled_ids_L[:M])]
-    # TODO use the remaining N row ids to make x_test_NF
-    x_test_NF = x_all_LF[(shuffled_ids_L[M:])]
-    # HINT Use integer indexing
+def _check_out_buffers(x_all_LF, M, N, out):
+    ''' Verify provided output buffers can hold a split of x_all_LF
 
-    # TODO return both x_train_MF and x_test_NF
+    Returns
+    -------
+    x_train_MF, x_test_NF : 2D np.arrays
+    '''
+    x_train_MF, x_test_NF = out
+    F = x_all_LF.shape[1]
+    for name, buf, shape in [
+            ('train', x_train_MF, (M, F)), ('test', x_test_NF, (N, F))]:
+        if buf.shape != shape:
+            raise ValueError("Expected %s buffer of shape %s, got %s" % (
+                name, shape, buf.shape))
+        if buf.dtype != x_all_LF.dtype:
+            raise ValueError("Expected %s buffer of dtype %s, got %s" % (
+                name, x_all_LF.dtype, buf.dtype))
+        if np.shares_memory(buf, x_all_LF):
+            raise ValueError(
+                "Output %s buffer must not share memory with input" % name)
     return x_train_MF, x_test_NF
@@ -0,0 +1,246 @@
+'''
+hw0_split_csv.py
+
+Summary
+-------
+Split a CSV file into train, validation and test files in one streaming pass.
+
+The input is read in chunks of chunk_size rows, so memory use does not
+grow with the size of the file. Fields are copied as text, exactly as
+they appear in the input.
+
+Each chunk gets a fixed number of rows of each split, chosen so that
+after every chunk, each split's running row count is within one row of
+its target fraction of all rows read so far. Which rows of the chunk go
+where is decided by a seeded random shuffle. So the final split sizes
+are exact (up to rounding a single row), without knowing the file length
+in advance, and the same seed always gives the same split.
+
+Rows keep their original order within each output file.
+
+Usage
+-----
+$ python hw0_split_csv.py dca.csv out_dir/ --x_col_names age famhistory marker --y_col_names cancer
+
+Examples
+--------
+>>> import os, tempfile
+>>> tmp_dir = tempfile.mkdtemp()
+>>> csv_path = os.path.join(tmp_dir, 'raw.csv')
+>>> with open(csv_path, 'w') as f:
+...     _ = f.write('id,age,score,label\\n')
+...     for n in range(1000):
+...         _ = f.write('%d,%d,%.2f,%d\\n' % (n, 20 + n % 50, n / 7.0, n % 2))
+>>> n_rows_by_split = split_csv_into_train_valid_and_test(
+...     csv_path, tmp_dir, x_col_names=['id', 'age', 'score'],
+...     y_col_names=['label'], frac_valid=0.2, frac_test=0.15,
+...     chunk_size=64, random_state=0)
+>>> n_rows_by_split
+{'train': 650, 'valid': 200, 'test': 150}
+>>> sorted(name for name in os.listdir(tmp_dir) if name != 'raw.csv')
+['x_test.csv', 'x_train.csv', 'x_valid.csv', 'y_test.csv', 'y_train.csv', 'y_valid.csv']
+>>> with open(os.path.join(tmp_dir, 'x_test.csv')) as f:
+...     print(''.join(f.readlines()[:3]), end='')
+id,age,score
+3,23,0.43
+9,29,1.29
+
+# Every input row lands in exactly one split, with x and y still aligned
+>>> all_ids = []
+>>> for split_name in ['train', 'valid', 'test']:
+...     x_LF = np.loadtxt(os.path.join(tmp_dir, 'x_%s.csv' % split_name),
+...         delimiter=',', skiprows=1)
+...     y_L = np.loadtxt(os.path.join(tmp_dir, 'y_%s.csv' % split_name),
+...         delimiter=',', skiprows=1)
+...     assert np.all(x_LF[:, 0] % 2 == y_L)
+...     all_ids.extend(x_LF[:, 0])
+>>> np.array_equal(np.sort(all_ids), np.arange(1000))
+True
+
+# With frac_valid=0, only train and test files are written
+>>> n_rows_by_split = split_csv_into_train_valid_and_test(
+...     csv_path, tmp_dir, x_col_names=['id'], y_col_names=['label'],
+...     frac_valid=0.0, frac_test=0.3, chunk_size=1000, random_state=0)
+>>> n_rows_by_split
+{'train': 700, 'test': 300}
+
+# Likewise, with frac_test=0 only train and valid files are written
+>>> n_rows_by_split = split_csv_into_train_valid_and_test(
+...     csv_path, tmp_dir, x_col_names=['id'], y_col_names=['label'],
+...     frac_valid=0.25, frac_test=0.0, chunk_size=1000, random_state=0)
+>>> n_rows_by_split
+{'train': 750, 'valid': 250}
+'''
+
+import argparse
+import csv
+import os
+
+import numpy as np
+
+from hw0_split import _resolve_random_state
+
+# Default number of rows held in memory at once
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def split_csv_into_train_valid_and_test(
+        csv_path, output_dir, x_col_names, y_col_names,
+        frac_valid=0.0, frac_test=0.5, chunk_size=DEFAULT_CHUNK_SIZE,
+        random_state=None):
+    ''' Stream a CSV file into x_{split}.csv and y_{split}.csv files
+
+    Args
+    ----
+    csv_path : str
+        Path to input CSV file, with a header row of column names
+    output_dir : str
+        Directory where output files are written (overwritten if present)
+    x_col_names : list of str
+        Columns written, in this order, to each x_{split}.csv file
+    y_col_names : list of str
+        Columns written, in this order, to each y_{split}.csv file
+    frac_valid : float, between 0 and 1
+        Fraction of rows for the "valid" split. If 0, no valid files.
+    frac_test : float, between 0 and 1
+        Fraction of rows for the "test" split. If 0, no test files.
+        The rest go to "train".
+    chunk_size : int
+        Number of rows read, shuffled and written together
+    random_state : np.random.RandomState instance or integer or None
+        See hw0_split.split_into_train_and_test.
+
+    Returns
+    -------
+    n_rows_by_split : dict
+        Number of rows written to each split, keyed by split name
+    '''
+    random_state = _resolve_random_state(random_state)
+    split_names = ['train', 'valid', 'test']
+    frac_S = np.asarray(
+        [1.0 - frac_valid - frac_test, frac_valid, frac_test])
+    if np.any(frac_S < 0):
+        raise ValueError("Need frac_valid and frac_test in [0, 1], sum <= 1")
+    # Train files are always written, valid and test ones only if used
+    keep_S = np.asarray([True, frac_valid > 0, frac_test > 0])
+    split_names = [name for name, keep in zip(split_names, keep_S) if keep]
+    frac_S = frac_S[keep_S]
+    chunk_size = max(1, int(chunk_size))
+
+    count_S = np.zeros(len(split_names), dtype=np.int64)
+    with open(csv_path, newline='') as in_file:
+        reader = csv.reader(in_file)
+        header = next(reader)
+        x_cols = [header.index(name) for name in x_col_names]
+        y_cols = [header.index(name) for name in y_col_names]
+
+        out_files = []
+        writer_pairs = []
+        try:
+            for name in split_names:
+                x_file = open(
+                    os.path.join(output_dir, 'x_%s.csv' % name), 'w', newline='')
+                y_file = open(
+                    os.path.join(output_dir, 'y_%s.csv' % name), 'w', newline='')
+                out_files.extend([x_file, y_file])
+                x_writer, y_writer = csv.writer(x_file), csv.writer(y_file)
+                x_writer.writerow(x_col_names)
+                y_writer.writerow(y_col_names)
+                writer_pairs.append((x_writer, y_writer))
+
+            chunk = []
+            for row in reader:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    _write_chunk(chunk, x_cols, y_cols, writer_pairs,
+                                 frac_S, count_S, random_state)
+                    chunk = []
+            if chunk:
+                _write_chunk(chunk, x_cols, y_cols, writer_pairs,
+                             frac_S, count_S, random_state)
+        finally:
+            for f in out_files:
+                f.close()
+    return dict(zip(split_names, (int(c) for c in count_S)))
+
+
+def calc_split_counts_for_chunk(frac_S, count_S, n_rows):
+    ''' Decide how many rows of the next chunk go to each split
+
+    Each split gets the whole rows it is short of its target share
+    frac_S[s] * (rows so far, including this chunk). The few rows left
+    over go one each to the splits with the largest remaining shortfall,
+    so every split's running count stays within one row of its target.
+
+    Args
+    ----
+    frac_S : 1D np.array, size S, sums to one
+        Target fraction of rows for each split
+    count_S : 1D np.array of int, size S
+        Rows given to each split so far. Updated in place.
+    n_rows : int
+        Number of rows in next chunk
+
+    Returns
+    -------
+    n_rows_S : 1D np.array of int, size S
+        Rows of the chunk for each split, summing to n_rows
+
+    Examples
+    --------
+    >>> count_S = np.zeros(3, dtype=np.int64)
+    >>> calc_split_counts_for_chunk(np.asarray([0.6, 0.2, 0.2]), count_S, 7)
+    array([4, 2, 1])
+    >>> calc_split_counts_for_chunk(np.asarray([0.6, 0.2, 0.2]), count_S, 3)
+    array([2, 0, 1])
+    >>> count_S
+    array([6, 2, 2])
+    '''
+    n_rows = int(n_rows)
+    deficit_S = frac_S * (np.sum(count_S) + n_rows) - count_S
+    n_rows_S = np.floor(np.maximum(deficit_S, 0.0)).astype(np.int64)
+    # Fewer than S rows are left over (or, rarely, handed out too many)
+    n_left = n_rows - int(np.sum(n_rows_S))
+    remain_S = deficit_S - n_rows_S
+    if n_left > 0:
+        order = np.argsort(-remain_S, kind='stable')
+        n_rows_S[order[:n_left]] += 1
+    elif n_left < 0:
+        order = np.argsort(np.where(n_rows_S > 0, remain_S, np.inf),
+                           kind='stable')
+        n_rows_S[order[:-n_left]] -= 1
+    count_S += n_rows_S
+    return n_rows_S
+
+
+def _write_chunk(chunk, x_cols, y_cols, writer_pairs, frac_S, count_S,
+                 random_state):
+    ''' Assign rows of one chunk to splits at random and write them out
+    '''
+    n_rows_S = calc_split_counts_for_chunk(frac_S, count_S, len(chunk))
+    split_R = random_state.permutation(
+        np.repeat(np.arange(n_rows_S.size), n_rows_S))
+    for row, s in zip(chunk, split_R):
+        x_writer, y_writer = writer_pairs[s]
+        x_writer.writerow([row[c] for c in x_cols])
+        y_writer.writerow([row[c] for c in y_cols])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv_path')
+    parser.add_argument('output_dir')
+    parser.add_argument('--x_col_names', nargs='+', required=True)
+    parser.add_argument('--y_col_names', nargs='+', required=True)
+    parser.add_argument('--frac_valid', type=float, default=0.0)
+    parser.add_argument('--frac_test', type=float, default=0.5)
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--random_state', type=int, default=42)
+    args = parser.parse_args()
+
+    n_rows_by_split = split_csv_into_train_valid_and_test(
+        args.csv_path, args.output_dir, args.x_col_names, args.y_col_names,
+        frac_valid=args.frac_valid, frac_test=args.frac_test,
+        chunk_size=args.chunk_size, random_state=args.random_state)
+    for name, n_rows in n_rows_by_split.items():
+        print("%-6s %10d rows" % (name, n_rows))
@@ -0,0 +1,156 @@
+'''
+Test Case
+---------
+>>> prng = np.random.RandomState(0)
+>>> N = 100
+
+>>> true_w_F = np.asarray([1.1, -2.2, 3.3])
+>>> true_b = 0.0
+>>> x_NF = prng.randn(N, 3)
+>>> y_N = true_b + np.dot(x_NF, true_w_F) + 0.03 * prng.randn(N)
+
+>>> ridge_path = RidgePathLinearRegressor(alpha_list=[0.0, 10.0, 1000.0])
+>>> ridge_path.fit(x_NF, y_N)
+>>> print(np.round(ridge_path.w_AF, 3))
+[[ 1.099 -2.202  3.301]
+ [ 1.046 -2.005  2.997]
+ [ 0.148 -0.206  0.301]]
+
+# Each row matches a separate fit, by least squares or by sklearn's Ridge
+>>> from LeastSquaresLinearRegression import LeastSquaresLinearRegressor
+>>> linear_regr = LeastSquaresLinearRegressor()
+>>> linear_regr.fit(x_NF, y_N)
+>>> np.allclose(ridge_path.w_AF[0], linear_regr.w_F)
+True
+>>> import sklearn.linear_model
+>>> sk_ridge = sklearn.linear_model.Ridge(alpha=10.0).fit(x_NF, y_N)
+>>> np.allclose(ridge_path.w_AF[1], sk_ridge.coef_)
+True
+>>> np.allclose(ridge_path.b_A[1], sk_ridge.intercept_)
+True
+>>> ridge_path.predict(x_NF[:4]).shape
+(4, 3)
+'''
+
+import numpy as np
+
+
+class RidgePathLinearRegressor(object):
+    ''' Ridge regression fit for a whole list of penalties at once
+
+    For each alpha in alpha_list, solves
+
+    .. math:
+        \\min_{w \\in \\mathbb{R}^F, b \\in \\mathbb{R}}
+            \\sum_{n=1}^N (y_n - b - \\sum_f x_{nf} w_f)^2 + \\alpha \\sum_f w_f^2
+
+    The bias b is not penalized, as in sklearn's Ridge.
+
+    One SVD of the centered features, U diag(s) V', costs O(N F^2). After
+    that, each alpha's weights are V diag(s / (s^2 + alpha)) U' y, which
+    costs only O(F^2) more per alpha.
+
+    Attributes
+    ----------
+    * self.w_AF : 2D numpy array, shape (n_alphas, n_features) = (A, F)
+        Row a holds the weights for alpha_list[a]
+    * self.b_A : 1D numpy array, size A
+        Bias for each alpha
+    '''
+
+    def __init__(self, alpha_list=(1.0,)):
+        ''' Constructor of an sklearn-like regressor
+
+        Args
+        ----
+        alpha_list : 1D array-like of non-negative float
+            Penalty strengths. An alpha of 0 gives least squares
+            (the minimum-norm solution, if features are collinear).
+        '''
+        self.alpha_list = alpha_list
+
+    def fit(self, x_NF, y_N):
+        ''' Compute and store weights and bias for every alpha
+
+        Returns
+        -------
+        Nothing.
+        '''
+        decomp = calc_ridge_path_decomposition(x_NF, y_N)
+        self.w_AF, self.b_A = calc_ridge_path_weights(decomp, self.alpha_list)
+
+    def predict(self, x_MF):
+        ''' Make predictions with every alpha's weights
+
+        Returns
+        -------
+        yhat_MA : 2D numpy array, shape (M, A)
+            Column a holds predictions made with alpha_list[a]
+        '''
+        return np.dot(x_MF, self.w_AF.T) + self.b_A
+
+
+def calc_ridge_path_decomposition(x_NF, y_N):
+    ''' Compute the alpha-independent part of a ridge regression fit
+
+    Returns
+    -------
+    decomp : dict, with keys
+        * 'xmean_F', 'ymean' : means used to center x and y
+        * 's_R', 'V_FR' : nonzero singular values and right singular vectors
+            of the centered x, for rank R <= min(N, F)
+        * 'uty_R' : centered y projected on the left singular vectors
+        * 'yc_sqnorm' : squared norm of the centered y
+    '''
+    x_NF = np.asarray(x_NF, dtype=np.float64)
+    y_N = np.asarray(y_N, dtype=np.float64)
+    xmean_F = np.mean(x_NF, axis=0)
+    ymean = np.mean(y_N)
+    yc_N = y_N - ymean
+    U_NR, s_R, Vt_RF = np.linalg.svd(x_NF - xmean_F, full_matrices=False)
+    # Drop directions with no variance, as np.linalg.lstsq would
+    keep_R = s_R > s_R[:1].max(initial=0.0) * max(x_NF.shape) \
+        * np.finfo(np.float64).eps
+    return dict(
+        xmean_F=xmean_F, ymean=ymean,
+        s_R=s_R[keep_R], V_FR=Vt_RF[keep_R].T,
+        uty_R=np.dot(U_NR[:, keep_R].T, yc_N),
+        yc_sqnorm=np.dot(yc_N, yc_N))
+
+
+def calc_ridge_path_weights(decomp, alpha_list):
+    ''' Compute weights and bias for each alpha from a decomposition
+
+    Returns
+    -------
+    w_AF : 2D numpy array, shape (A, F)
+    b_A : 1D numpy array, size A
+    '''
+    alpha_A = np.asarray(alpha_list, dtype=np.float64).reshape(-1)
+    if np.any(alpha_A < 0):
+        raise ValueError("Need non-negative alpha values")
+    s_R = decomp['s_R']
+    shrink_AR = s_R / (np.square(s_R) + alpha_A[:, None])
+    w_AF = np.dot(shrink_AR * decomp['uty_R'], decomp['V_FR'].T)
+    b_A = decomp['ymean'] - np.dot(w_AF, decomp['xmean_F'])
+    return w_AF, b_A
+
+
+def calc_ridge_path_train_sse(decomp, alpha_list):
+    ''' Compute each alpha's sum of squared errors on the training data
+
+    The centered residual is y_c - U diag(s^2 / (s^2 + alpha)) U' y_c,
+    whose squared norm needs only the R projections U' y_c.
+
+    Returns
+    -------
+    sse_A : 1D numpy array, size A
+    '''
+    alpha_A = np.asarray(alpha_list, dtype=np.float64).reshape(-1)
+    sqs_R = np.square(decomp['s_R'])
+    uty_R = decomp['uty_R']
+    keep_AR = alpha_A[:, None] / (sqs_R + alpha_A[:, None])
+    # Part of y_c outside the span of U is never fit
+    sse_A = (decomp['yc_sqnorm'] - np.dot(uty_R, uty_R)) \
+        + np.dot(np.square(keep_AR), np.square(uty_R))
+    return np.maximum(sse_A, 0.0)
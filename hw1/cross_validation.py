@@ -1,16 +1,39 @@
+import contextlib
+import copy
+import mmap
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 from performance_metrics import calc_root_mean_squared_error
+from LeastSquaresLinearRegression import LeastSquaresLinearRegressor
+from RidgePathLinearRegression import (
+    RidgePathLinearRegressor, calc_ridge_path_decomposition,
+    calc_ridge_path_train_sse, calc_ridge_path_weights)
+from transform_cache import calc_data_fingerprint, make_transform_key
+
+
+# Closed form CV refuses systems whose (unit diagonal) condition number is
+# above this, keeping roughly 8 significant digits of every fold's weights
+MAX_CLOSED_FORM_CONDITION = 1e8
+# ... and, for LOO, examples with leverage this close to one
+MIN_CLOSED_FORM_LEVERAGE_GAP = 1e-8
 
 
 def train_models_and_calc_scores_for_n_fold_cv(
-        estimator, x_NF, y_N, n_folds=3, random_state=0):
+        estimator, x_NF, y_N, n_folds=3, random_state=0, n_jobs=1,
+        use_closed_form=True, transform_cache=None):
     ''' Perform n-fold cross validation for a specific sklearn estimator object
 
     Args
     ----
     estimator : any regressor object with sklearn-like API
         Supports 'fit' and 'predict' methods.
+        A RidgePathLinearRegressor is scored for all its alphas at once,
+        see calc_ridge_path_scores_for_n_fold_cv.
     x_NF : 2D numpy array, shape (n_examples, n_features) = (N, F)
         Input measurements ("features") for all examples of interest.
         Each row is a feature vector for one example.
@@ -19,8 +42,34 @@ def train_models_and_calc_scores_for_n_fold_cv(
         Each row is a scalar response for one example.
     n_folds : int
         Number of folds to divide provided dataset into.
-    random_state : int or numpy.RandomState instance
+    random_state : int or numpy RandomState or Generator instance
         Allows reproducible random splits.
+    n_jobs : int or None
+        Number of worker processes that fit folds concurrently.
+        None or 1 means fit folds one after another in this process,
+        refitting the provided estimator each time. Otherwise, each fold
+        fits its own copy of the estimator (the provided one is untouched),
+        and -1 means one process per CPU core. Workers map x_NF and y_N
+        from memory-mapped files (x_NF's own file, if it is an np.memmap),
+        so the data is never pickled per worker.
+    use_closed_form : bool
+        If True and estimator is a least-squares linear regression
+        (LeastSquaresLinearRegressor, or sklearn's LinearRegression or Ridge
+        with an intercept), compute all folds' errors from one pass over
+        the data instead of fitting once per fold.
+        See calc_linear_regression_scores_for_n_fold_cv.
+        The provided estimator is then left untouched.
+        If the closed form is singular or ill-conditioned (e.g. collinear
+        or high-degree polynomial features), folds are refit as usual.
+    transform_cache : transform_cache.TransformCache or None
+        If provided and estimator is an sklearn Pipeline, outputs of its
+        transform steps are looked up in (and added to) this cache, so
+        calls that share a cache never repeat the same transform of the
+        same rows. Leading row-wise stateless steps (e.g. PolynomialFeatures)
+        are applied once to all N rows and then sliced per fold. Later steps
+        (e.g. MinMaxScaler) are fit per fold as usual, and cached per fold.
+        Only the pipeline's final step is fit in place. Folds then run
+        in this process, whatever n_jobs is.
 
     Returns
     -------
@@ -30,6 +79,8 @@ def train_models_and_calc_scores_for_n_fold_cv(
     test_error_per_fold : 1D numpy array, size n_folds
         One entry per fold
         Entry f gives the error computed for test set for fold f
+        For a RidgePathLinearRegressor, both are instead 2D arrays
+        of shape (n_alphas, n_folds).
 
     Examples
     --------
@@ -54,38 +105,614 @@ def train_models_and_calc_scores_for_n_fold_cv(
     # Testing error should be indistinguishable from zero
     >>> np.array2string(te_K, precision=8, suppress_small=True)
     '[0. 0. 0. 0. 0. 0. 0.]'
+
+    # Folds can run in parallel processes, with the same results in fold order
+    >>> noisy_y_N = y_N + np.random.RandomState(1).randn(N)
+    >>> tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...     my_regr, x_N3, noisy_y_N, n_folds=n_folds, random_state=0,
+    ...     use_closed_form=False)
+    >>> par_tr_K, par_te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...     my_regr, x_N3, noisy_y_N, n_folds=n_folds, random_state=0, n_jobs=3,
+    ...     use_closed_form=False)
+    >>> np.array_equal(tr_K, par_tr_K), np.array_equal(te_K, par_te_K)
+    (True, True)
+
+    # With a transform cache, a grid over the final step's hyperparameters
+    # reuses each fold's rescaled, expanded features, with the same results
+    >>> import sklearn.pipeline, sklearn.preprocessing
+    >>> from transform_cache import TransformCache
+    >>> def make_pipeline(alpha):
+    ...     return sklearn.pipeline.Pipeline([
+    ...         ('rescaler', sklearn.preprocessing.MinMaxScaler()),
+    ...         ('poly', sklearn.preprocessing.PolynomialFeatures(degree=3)),
+    ...         ('ridge', sklearn.linear_model.Ridge(alpha=alpha))])
+    >>> cache = TransformCache()
+    >>> for alpha in [0.1, 1.0, 10.0]:
+    ...     tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...         make_pipeline(alpha), x_N3, noisy_y_N, n_folds=n_folds)
+    ...     cached_tr_K, cached_te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...         make_pipeline(alpha), x_N3, noisy_y_N, n_folds=n_folds,
+    ...         transform_cache=cache)
+    ...     assert np.allclose(tr_K, cached_tr_K) and np.allclose(te_K, cached_te_K)
+    >>> cache.n_misses, cache.n_hits
+    (14, 28)
     '''
     train_error_per_fold = np.zeros(n_folds, dtype=np.float32)
     test_error_per_fold = np.zeros(n_folds, dtype=np.float32)
 
-    # define the folds here by calling your function
-    train_ids_per_fold, test_ids_per_fold = make_train_and_test_row_ids_for_n_fold_cv(
+    if isinstance(estimator, RidgePathLinearRegressor):
+        return calc_ridge_path_scores_for_n_fold_cv(
+            x_NF, y_N, estimator.alpha_list, n_folds=n_folds,
+            random_state=random_state)
+
+    alpha = _get_closed_form_alpha(estimator) if use_closed_form else None
+    if alpha is not None:
+        # The closed form draws its folds before it can fail, which advances
+        # a RandomState or Generator. Refits must start from the same state.
+        fold_random_state = copy.deepcopy(random_state)
+        try:
+            return calc_linear_regression_scores_for_n_fold_cv(
+                x_NF, y_N, n_folds=n_folds, random_state=random_state,
+                alpha=alpha)
+        except np.linalg.LinAlgError:
+            # Singular or ill-conditioned: refit each fold instead
+            random_state = fold_random_state
+
+    if transform_cache is not None and _is_pipeline(estimator):
+        return _train_models_and_calc_scores_with_cache(
+            estimator, x_NF, y_N, n_folds, random_state, transform_cache)
+
+    n_jobs = _resolve_n_jobs(n_jobs)
+    if n_jobs > 1:
+        return _train_models_and_calc_scores_in_parallel(
+            estimator, x_NF, y_N, n_folds, random_state, n_jobs)
+
+    # define the folds here, built one at a time to save memory
+    fold_iterator = iterate_train_and_test_row_ids_for_n_fold_cv(
         x_NF.shape[0], n_folds, random_state)
 
-    # print(test_ids_per_fold)
     # loop over folds and compute the train and test error
+    for fold, (train_ids, test_ids) in enumerate(fold_iterator):
+        train_error_per_fold[fold], test_error_per_fold[fold] = (
+            _fit_and_score_one_fold(estimator, x_NF, y_N, train_ids, test_ids))
+
+    return train_error_per_fold, test_error_per_fold
+
+
+def calc_linear_regression_scores_for_n_fold_cv(
+        x_NF, y_N, n_folds=3, random_state=0, alpha=0.0):
+    ''' Compute n-fold CV errors of (ridge) linear regression without refitting
+
+    Same folds and same errors as train_models_and_calc_scores_for_n_fold_cv
+    with a LeastSquaresLinearRegressor (alpha=0) or a ridge regression with
+    an unpenalized intercept (alpha > 0), up to floating-point roundoff.
+
+    With G = F + 1 coefficients (weights plus intercept), let A be the
+    G x G matrix xtilde' xtilde + alpha * I (no penalty on the intercept),
+    where xtilde is x with a column of ones. Then:
+
+    * K-fold: each fold's own xtilde_T' xtilde_T is gathered in one pass.
+      Leaving fold T out is the rank-|T| downdate A - xtilde_T' xtilde_T,
+      a G x G solve. Train error comes from the full-data residuals plus
+      a G-dimensional correction, so no fold refits or re-predicts all N.
+    * Leave-one-out (n_folds == N): from the hat matrix diagonal
+      h_n = xtilde_n' A^-1 xtilde_n, the held-out residual of example n is
+      r_n / (1 - h_n), where r_n is its full-data residual.
+
+    Args
+    ----
+    x_NF, y_N, n_folds, random_state
+        See train_models_and_calc_scores_for_n_fold_cv.
+    alpha : float
+        L2 penalty on the weights (not the intercept). 0 means least squares.
+
+    Returns
+    -------
+    train_error_per_fold : 1D numpy array, size n_folds
+    test_error_per_fold : 1D numpy array, size n_folds
+        Root mean squared error of each fold's train and test sets
+
+    Raises
+    ------
+    np.linalg.LinAlgError
+        If any fold's system is singular or its condition number (after
+        scaling to unit diagonal) exceeds MAX_CLOSED_FORM_CONDITION, or,
+        for LOO, if any example has leverage within
+        MIN_CLOSED_FORM_LEVERAGE_GAP of one. Normal equations square the
+        condition number of the data, so these systems are where the
+        closed form would silently lose accuracy.
+
+    Examples
+    --------
+    >>> prng = np.random.RandomState(0)
+    >>> x_N3 = prng.rand(60, 3)
+    >>> y_N = np.dot(x_N3, [1., -2., 3.]) + 0.1 * prng.randn(60)
+
+    # Equal to refitting LeastSquaresLinearRegressor on every fold
+    >>> for n_folds in [2, 7, 60]:
+    ...     fast_tr_K, fast_te_K = calc_linear_regression_scores_for_n_fold_cv(
+    ...         x_N3, y_N, n_folds=n_folds, random_state=0)
+    ...     tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...         LeastSquaresLinearRegressor(), x_N3, y_N, n_folds=n_folds,
+    ...         random_state=0, use_closed_form=False)
+    ...     print(n_folds, np.allclose(fast_tr_K, tr_K, rtol=1e-5),
+    ...           np.allclose(fast_te_K, te_K, rtol=1e-5))
+    2 True True
+    7 True True
+    60 True True
+
+    # Equal to refitting sklearn's Ridge on every fold
+    >>> import sklearn.linear_model
+    >>> for n_folds in [7, 60]:
+    ...     fast_tr_K, fast_te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...         sklearn.linear_model.Ridge(alpha=0.5), x_N3, y_N,
+    ...         n_folds=n_folds, random_state=0)
+    ...     tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...         sklearn.linear_model.Ridge(alpha=0.5), x_N3, y_N,
+    ...         n_folds=n_folds, random_state=0, use_closed_form=False)
+    ...     print(n_folds, np.allclose(fast_tr_K, tr_K, rtol=1e-5),
+    ...           np.allclose(fast_te_K, te_K, rtol=1e-5))
+    7 True True
+    60 True True
+
+    # Collinear or ill-conditioned features are refused, and the generic
+    # CV function then refits each fold, same as without the closed form
+    >>> x_N4 = np.hstack([x_N3, x_N3[:, :1] * 2.0])
+    >>> calc_linear_regression_scores_for_n_fold_cv(x_N4, y_N, n_folds=7)
+    Traceback (most recent call last):
+    ...
+    numpy.linalg.LinAlgError: Closed form CV is singular or ill-conditioned
+    >>> import sklearn.preprocessing
+    >>> x_NP = sklearn.preprocessing.PolynomialFeatures(
+    ...     degree=7, include_bias=False).fit_transform(x_N3)
+    >>> for x_NG in [x_N4, x_NP]:
+    ...     for n_folds in [7, 60]:
+    ...         tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...             sklearn.linear_model.LinearRegression(), x_NG, y_N,
+    ...             n_folds=n_folds)
+    ...         loop_tr_K, loop_te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...             sklearn.linear_model.LinearRegression(), x_NG, y_N,
+    ...             n_folds=n_folds, use_closed_form=False)
+    ...         print(np.array_equal(tr_K, loop_tr_K),
+    ...               np.array_equal(te_K, loop_te_K))
+    True True
+    True True
+    True True
+    True True
+
+    # A RandomState or Generator object gives the fallback the same folds too
+    >>> y_N = y_N + 0.1 * np.random.RandomState(2).randn(y_N.size)
+    >>> tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...     sklearn.linear_model.LinearRegression(), x_N4, y_N, n_folds=5,
+    ...     random_state=np.random.default_rng(7))
+    >>> loop_tr_K, loop_te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...     sklearn.linear_model.LinearRegression(), x_N4, y_N, n_folds=5,
+    ...     random_state=np.random.default_rng(7), use_closed_form=False)
+    >>> np.array_equal(tr_K, loop_tr_K), np.array_equal(te_K, loop_te_K)
+    (True, True)
+    '''
+    N, F = x_NF.shape
+    G = F + 1
+    shuffled_ids_N, _, fold_starts = _make_shuffled_ids_and_folds(
+        N, n_folds, random_state)
+    penalty_G = np.hstack([np.full(F, float(alpha)), 0.0])
+    y_N = np.asarray(y_N, dtype=np.float64)
+
+    if n_folds == N:
+        # Leave-one-out, from the hat matrix diagonal
+        xtilde_NG = _add_bias_column(x_NF)
+        gram_GG = np.dot(xtilde_NG.T, xtilde_NG)
+        theta_G = _solve_well_conditioned(
+            gram_GG + np.diag(penalty_G), np.dot(xtilde_NG.T, y_N))
+        z_NG = _solve_well_conditioned(
+            gram_GG + np.diag(penalty_G), xtilde_NG.T).T
+        h_N = np.einsum('ng,ng->n', z_NG, xtilde_NG)
+        # A row with leverage near one is nearly all its own fit,
+        # so its held-out residual cannot be recovered from the full fit
+        if np.any(1.0 - h_N < MIN_CLOSED_FORM_LEVERAGE_GAP):
+            raise np.linalg.LinAlgError(
+                "Leverage too close to one for closed form LOO")
+        resid_N = y_N - np.dot(xtilde_NG, theta_G)
+        loo_resid_N = resid_N / (1.0 - h_N)
+        # Leaving out n shifts every residual m by H[m, n] * loo_resid_N[n].
+        # Sum of squares over m != n then needs only (H r)_n and sum_m H[m,n]^2.
+        hr_N = np.dot(z_NG, penalty_G * theta_G)
+        sum_sq_h_N = np.einsum('ng,ng->n', np.dot(z_NG, gram_GG), z_NG)
+        train_sse_N = (
+            np.dot(resid_N, resid_N) + 2.0 * loo_resid_N * hr_N
+            + np.square(loo_resid_N) * (sum_sq_h_N - 1.0))
+        train_error_per_fold = np.sqrt(
+            np.maximum(train_sse_N, 0.0) / max(N - 1, 1))[shuffled_ids_N]
+        test_error_per_fold = np.abs(loo_resid_N)[shuffled_ids_N]
+        return (
+            train_error_per_fold.astype(np.float32),
+            test_error_per_fold.astype(np.float32))
+
+    # One pass over the data for each fold's sufficient statistics
+    gram_KGG = np.zeros((n_folds, G, G))
+    xy_KG = np.zeros((n_folds, G))
     for fold in range(n_folds):
-        train_ids = train_ids_per_fold[fold]
-        test_ids = test_ids_per_fold[fold]
+        test_ids = shuffled_ids_N[fold_starts[fold]:fold_starts[fold + 1]]
+        xtilde_TG = _add_bias_column(x_NF[test_ids])
+        gram_KGG[fold] = np.dot(xtilde_TG.T, xtilde_TG)
+        xy_KG[fold] = np.dot(xtilde_TG.T, y_N[test_ids])
+    gram_GG = np.sum(gram_KGG, axis=0)
+    xy_G = np.sum(xy_KG, axis=0)
+    A_GG = gram_GG + np.diag(penalty_G)
+    theta_G = _solve_well_conditioned(A_GG, xy_G)
+    resid_N = y_N - _predict_with_bias(x_NF, theta_G)
+    rss = np.dot(resid_N, resid_N)
+    # xtilde' resid = penalty * theta, which is zero for least squares
+    xr_G = penalty_G * theta_G
+
+    train_error_per_fold = np.zeros(n_folds, dtype=np.float32)
+    test_error_per_fold = np.zeros(n_folds, dtype=np.float32)
+    for fold in range(n_folds):
+        test_ids = shuffled_ids_N[fold_starts[fold]:fold_starts[fold + 1]]
+        theta_fold_G = _solve_well_conditioned(
+            A_GG - gram_KGG[fold], xy_G - xy_KG[fold])
+        test_resid_T = y_N[test_ids] - _predict_with_bias(
+            x_NF[test_ids], theta_fold_G)
+        test_sse = np.dot(test_resid_T, test_resid_T)
+        # Residuals of the fold's fit on all N rows are resid_N + xtilde delta
+        delta_G = theta_G - theta_fold_G
+        all_sse = (
+            rss + 2.0 * np.dot(delta_G, xr_G)
+            + np.dot(delta_G, np.dot(gram_GG, delta_G)))
+        n_train = N - test_ids.size
+        train_error_per_fold[fold] = np.sqrt(
+            max(all_sse - test_sse, 0.0) / max(n_train, 1))
+        test_error_per_fold[fold] = np.sqrt(test_sse / max(test_ids.size, 1))
+    return train_error_per_fold, test_error_per_fold
+
 
-        # Split data into train and test sets
-        x_train, y_train = x_NF[train_ids], y_N[train_ids]
-        x_test, y_test = x_NF[test_ids], y_N[test_ids]
+def calc_ridge_path_scores_for_n_fold_cv(
+        x_NF, y_N, alpha_list, n_folds=3, random_state=0):
+    ''' Compute n-fold CV errors of ridge regression for a whole grid of alphas
 
-        # Train the estimator
-        estimator.fit(x_train, y_train)
+    Each fold's training set is decomposed once (one SVD, see
+    RidgePathLinearRegression), which then gives the weights, train error
+    and test predictions for every alpha at little extra cost.
+    Folds are the same as in train_models_and_calc_scores_for_n_fold_cv.
 
-        # Predict and calculate train/test errors
-        y_train_pred = estimator.predict(x_train)
-        y_test_pred = estimator.predict(x_test)
+    Args
+    ----
+    x_NF, y_N, n_folds, random_state
+        See train_models_and_calc_scores_for_n_fold_cv.
+    alpha_list : 1D array-like of non-negative float, size A
+        Penalty strengths on the weights. The bias is not penalized.
+
+    Returns
+    -------
+    train_error_AK : 2D numpy array, shape (n_alphas, n_folds)
+    test_error_AK : 2D numpy array, shape (n_alphas, n_folds)
+        Entry a,f is the root mean squared error on fold f's train or
+        test set, of the model fit with alpha_list[a]
+
+    Examples
+    --------
+    >>> import sklearn.linear_model
+    >>> prng = np.random.RandomState(0)
+    >>> x_N3 = prng.rand(60, 3)
+    >>> y_N = np.dot(x_N3, [1., -2., 3.]) + 0.1 * prng.randn(60)
+    >>> alpha_list = [0.0, 0.01, 1.0, 100.0]
+    >>> tr_AK, te_AK = calc_ridge_path_scores_for_n_fold_cv(
+    ...     x_N3, y_N, alpha_list, n_folds=5, random_state=0)
+    >>> te_AK.shape
+    (4, 5)
+
+    # Same as refitting sklearn's Ridge for every alpha and fold
+    >>> for a, alpha in enumerate(alpha_list):
+    ...     tr_K, te_K = train_models_and_calc_scores_for_n_fold_cv(
+    ...         sklearn.linear_model.Ridge(alpha=alpha), x_N3, y_N,
+    ...         n_folds=5, random_state=0, use_closed_form=False)
+    ...     assert np.allclose(tr_AK[a], tr_K, rtol=1e-5)
+    ...     assert np.allclose(te_AK[a], te_K, rtol=1e-5)
+
+    # A RidgePathLinearRegressor passed to the generic CV function gets this
+    >>> tr2_AK, te2_AK = train_models_and_calc_scores_for_n_fold_cv(
+    ...     RidgePathLinearRegressor(alpha_list), x_N3, y_N, n_folds=5)
+    >>> np.array_equal(te2_AK, te_AK)
+    True
+    '''
+    A = np.asarray(alpha_list).size
+    train_error_AK = np.zeros((A, n_folds), dtype=np.float32)
+    test_error_AK = np.zeros((A, n_folds), dtype=np.float32)
+    fold_iterator = iterate_train_and_test_row_ids_for_n_fold_cv(
+        x_NF.shape[0], n_folds, random_state)
+    for fold, (train_ids, test_ids) in enumerate(fold_iterator):
+        decomp = calc_ridge_path_decomposition(x_NF[train_ids], y_N[train_ids])
+        train_error_AK[:, fold] = np.sqrt(
+            calc_ridge_path_train_sse(decomp, alpha_list)
+            / max(train_ids.size, 1))
+        w_AF, b_A = calc_ridge_path_weights(decomp, alpha_list)
+        x_TF = np.asarray(x_NF[test_ids], dtype=np.float64)
+        yhat_TA = np.dot(x_TF, w_AF.T) + b_A
+        test_error_AK[:, fold] = np.sqrt(np.mean(
+            np.square(y_N[test_ids][:, None] - yhat_TA), axis=0))
+    return train_error_AK, test_error_AK
+
+
+def _solve_well_conditioned(A_GG, b_G):
+    ''' Solve symmetric system A x = b, refusing if it is ill-conditioned
+
+    Rows and columns are first scaled to give A a unit diagonal, so
+    features on very different scales are not mistaken for collinear ones.
+
+    Returns
+    -------
+    x_G : 1D or 2D numpy array, same shape as b_G
+    '''
+    diag_G = np.diag(A_GG)
+    if not np.all(diag_G > 0):
+        raise np.linalg.LinAlgError(
+            "Closed form CV is singular or ill-conditioned")
+    scale_G = 1.0 / np.sqrt(diag_G)
+    scaled_A_GG = A_GG * scale_G[:, None] * scale_G[None, :]
+    if not np.linalg.cond(scaled_A_GG) <= MAX_CLOSED_FORM_CONDITION:
+        raise np.linalg.LinAlgError(
+            "Closed form CV is singular or ill-conditioned")
+    scale_b = scale_G if np.ndim(b_G) == 1 else scale_G[:, None]
+    return scale_b * np.linalg.solve(scaled_A_GG, scale_b * b_G)
+
+
+def _get_closed_form_alpha(estimator):
+    ''' Get L2 penalty if estimator is a linear regression we can do in closed form
+
+    Returns
+    -------
+    alpha : float, or None if closed form CV does not apply
+    '''
+    if isinstance(estimator, LeastSquaresLinearRegressor):
+        return float(getattr(estimator, 'alpha', 0.0))
+    # Check sklearn's classes only if the estimator came from there,
+    # so sklearn stays an optional dependency
+    if not type(estimator).__module__.startswith('sklearn.linear_model'):
+        return None
+    import sklearn.linear_model
+    if not getattr(estimator, 'fit_intercept', False) \
+            or getattr(estimator, 'positive', False):
+        return None
+    if type(estimator) is sklearn.linear_model.LinearRegression:
+        return 0.0
+    if type(estimator) is sklearn.linear_model.Ridge \
+            and np.ndim(estimator.alpha) == 0:
+        return float(estimator.alpha)
+    return None
+
+
+def _add_bias_column(x_NF):
+    ''' Append a column of ones, as float64 '''
+    x_NF = np.asarray(x_NF, dtype=np.float64)
+    return np.hstack([x_NF, np.ones((x_NF.shape[0], 1))])
+
+
+def _predict_with_bias(x_NF, theta_G):
+    ''' Compute x_NF w + b, where theta_G stacks weights w then bias b '''
+    return np.dot(np.asarray(x_NF, dtype=np.float64), theta_G[:-1]) + theta_G[-1]
+
+
+def _fit_and_score_one_fold(estimator, x_NF, y_N, train_ids, test_ids):
+    ''' Fit estimator on one fold's train set, return train and test RMSE
+    '''
+    # Split data into train and test sets
+    x_train, y_train = x_NF[train_ids], y_N[train_ids]
+    x_test, y_test = x_NF[test_ids], y_N[test_ids]
+
+    # Train the estimator
+    estimator.fit(x_train, y_train)
+
+    # Predict and calculate train/test errors
+    y_train_pred = estimator.predict(x_train)
+    y_test_pred = estimator.predict(x_test)
+
+    # Use calc_root_mean_squared_error for error calculation
+    return (
+        calc_root_mean_squared_error(y_train, y_train_pred),
+        calc_root_mean_squared_error(y_test, y_test_pred))
+
+
+def _train_models_and_calc_scores_with_cache(
+        pipeline, x_NF, y_N, n_folds, random_state, cache):
+    ''' Run n-fold CV of a pipeline, memoizing its transform steps' outputs
+    '''
+    steps = [step for _, step in pipeline.steps]
+    transformers = [
+        step for step in steps[:-1] if step is not None and step != 'passthrough']
+    final_estimator = steps[-1]
+
+    # Leading stateless steps map each row the same way in every fold,
+    # so transform all rows once, then slice each fold from the result
+    x_key = calc_data_fingerprint(x_NF)
+    n_stateless = 0
+    for transformer in transformers:
+        if not _is_stateless_transform(transformer):
+            break
+        x_key = make_transform_key(transformer, x_key)
+        cached = cache.get(x_key)
+        if cached is None:
+            cached = (copy.deepcopy(transformer).fit_transform(x_NF),)
+            cache.put(x_key, cached)
+        x_NF = cached[0]
+        n_stateless += 1
+    y_key = calc_data_fingerprint(y_N)
+
+    train_error_per_fold = np.zeros(n_folds, dtype=np.float32)
+    test_error_per_fold = np.zeros(n_folds, dtype=np.float32)
+    fold_iterator = iterate_train_and_test_row_ids_for_n_fold_cv(
+        x_NF.shape[0], n_folds, random_state)
+    for fold, (train_ids, test_ids) in enumerate(fold_iterator):
+        y_train, y_test = y_N[train_ids], y_N[test_ids]
 
-        # Use calc_root_mean_squared_error for error calculation
-        train_error_per_fold[fold] = calc_root_mean_squared_error(y_train, y_train_pred)
-        test_error_per_fold[fold] = calc_root_mean_squared_error(y_test, y_test_pred)
+        # Steps fit per fold are keyed by the fold's test rows too.
+        # Rows are only gathered if some step is not cached.
+        fold_key = (x_key, y_key, calc_data_fingerprint(test_ids))
+        x_pair = None
+        for transformer in transformers[n_stateless:]:
+            fold_key = make_transform_key(transformer, fold_key)
+            cached = cache.get(fold_key)
+            if cached is None:
+                if x_pair is None:
+                    x_pair = (x_NF[train_ids], x_NF[test_ids])
+                fitted = copy.deepcopy(transformer)
+                cached = (
+                    fitted.fit_transform(x_pair[0], y_train),
+                    fitted.transform(x_pair[1]))
+                cache.put(fold_key, cached)
+            x_pair = cached
+        if x_pair is None:
+            x_pair = (x_NF[train_ids], x_NF[test_ids])
 
+        x_train, x_test = x_pair
+        final_estimator.fit(x_train, y_train)
+        train_error_per_fold[fold] = calc_root_mean_squared_error(
+            y_train, final_estimator.predict(x_train))
+        test_error_per_fold[fold] = calc_root_mean_squared_error(
+            y_test, final_estimator.predict(x_test))
     return train_error_per_fold, test_error_per_fold
 
 
+def _is_pipeline(estimator):
+    ''' Check if estimator is an sklearn Pipeline, without importing sklearn '''
+    return (type(estimator).__module__.startswith('sklearn.pipeline')
+            and hasattr(estimator, 'steps'))
+
+
+def _is_stateless_transform(transformer):
+    ''' Check if transformer maps each row on its own, learning nothing in fit '''
+    cls = type(transformer)
+    return (cls.__module__.startswith('sklearn.preprocessing')
+            and cls.__name__ in _STATELESS_TRANSFORM_NAMES)
+
+
+# sklearn transformers whose output for a row depends only on that row
+_STATELESS_TRANSFORM_NAMES = ('PolynomialFeatures', 'Normalizer', 'Binarizer')
+
+
+def _train_models_and_calc_scores_in_parallel(
+        estimator, x_NF, y_N, n_folds, random_state, n_jobs):
+    ''' Run each fold of n-fold CV in a worker process
+
+    The data and the fold label of each example are shared with workers
+    as memory-mapped files, written once. Each task then only carries the
+    estimator, the fold number and that fold's test ids (about
+    N / n_folds integers).
+
+    Returns
+    -------
+    train_error_per_fold, test_error_per_fold : 1D numpy arrays, size n_folds
+        Same as train_models_and_calc_scores_for_n_fold_cv, in fold order
+    '''
+    shuffled_ids_N, fold_id_N, fold_starts = _make_shuffled_ids_and_folds(
+        x_NF.shape[0], n_folds, random_state)
+    with _share_arrays_in_temp_dir(
+            [('x', x_NF), ('y', y_N), ('fold', fold_id_N)],
+            prefix='cv_') as specs:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, n_folds)) as pool:
+            futures = [
+                pool.submit(
+                    _fit_and_score_one_fold_in_worker,
+                    copy.deepcopy(estimator), specs, fold,
+                    shuffled_ids_N[fold_starts[fold]:fold_starts[fold + 1]])
+                for fold in range(n_folds)]
+            # Collect in submission order, so results stay in fold order
+            errors_K2 = np.asarray([future.result() for future in futures])
+    return (
+        errors_K2[:, 0].astype(np.float32),
+        errors_K2[:, 1].astype(np.float32))
+
+
+def _fit_and_score_one_fold_in_worker(estimator, specs, fold, test_ids):
+    ''' Map the shared data, then fit and score one fold
+    '''
+    x_NF, y_N, fold_id_N = [_open_shared_array(spec) for spec in specs]
+    train_ids = np.flatnonzero(fold_id_N != fold)
+    return _fit_and_score_one_fold(estimator, x_NF, y_N, train_ids, test_ids)
+
+
+@contextlib.contextmanager
+def _share_arrays_in_temp_dir(named_arrays, prefix='shared_'):
+    ''' Share arrays with worker processes, via files in a temporary dir
+
+    The directory, and every file in it, is removed on exit.
+
+    Args
+    ----
+    named_arrays : list of (str, np.array) pairs
+        Each array is shared with _share_array, under its name
+    prefix : str
+        Start of the temporary directory's name
+
+    Yields
+    ------
+    specs : list of tuple
+        One spec per array, in order, to pass to _open_shared_array
+
+    Examples
+    --------
+    >>> with _share_arrays_in_temp_dir([('a', np.arange(3))]) as specs:
+    ...     print(_open_shared_array(specs[0]))
+    ...     print(os.path.exists(specs[0][0]))
+    [0 1 2]
+    True
+    >>> os.path.exists(specs[0][0])
+    False
+    '''
+    # RAM-backed /dev/shm, where available, keeps the files out of disk
+    tmp_dir = tempfile.mkdtemp(
+        prefix=prefix, dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        yield [
+            _share_array(arr, os.path.join(tmp_dir, name + '.npy'))
+            for name, arr in named_arrays]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _share_array(arr, path):
+    ''' Make an array readable from other processes without pickling it
+
+    A np.memmap opened directly on a file (not a slice of one) is
+    described by that file, so workers map it directly. Anything else is
+    written once to path.
+
+    Returns
+    -------
+    spec : tuple
+        Picklable description, to pass to _open_shared_array in a worker
+    '''
+    if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap) \
+            and arr.flags.c_contiguous:
+        return (arr.filename, arr.dtype.str, arr.shape, arr.offset)
+    arr = np.ascontiguousarray(arr)
+    with open(path, 'wb') as f:
+        arr.tofile(f)
+    return (path, arr.dtype.str, arr.shape, 0)
+
+
+def _open_shared_array(spec):
+    ''' Map an array described by _share_array, read-only
+    '''
+    filename, dtype, shape, offset = spec
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+
+def _resolve_n_jobs(n_jobs):
+    ''' Convert an n_jobs argument into a positive number of workers
+
+    Follows the sklearn convention: None means 1, negative values count
+    back from the number of CPU cores (-1 means all cores).
+    '''
+    if n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    return max(1, n_jobs)
+
+
 def make_train_and_test_row_ids_for_n_fold_cv(
         n_examples=0, n_folds=3, random_state=0):
     ''' Divide row ids into train and test sets for n-fold cross validation.
@@ -99,8 +726,10 @@ def make_train_and_test_row_ids_for_n_fold_cv(
         Total number of examples to allocate into train/test sets
     n_folds : int
         Number of folds requested
-    random_state : int or numpy RandomState object
+    random_state : int or numpy RandomState or Generator object
         Pseudorandom number generator (or seed) for reproducibility
+        Any object with a shuffle method works, including the faster
+        np.random.Generator (e.g. np.random.default_rng(seed)).
 
     Returns
     -------
@@ -145,38 +774,118 @@ def make_train_and_test_row_ids_for_n_fold_cv(
     >>> np.sort(np.hstack([tr_ids_per_fold[f] for f in range(n_folds)]))
     array([ 0,  0,  1,  1,  2,  2,  3,  3,  4,  4,  5,  5,  6,  6,  7,  7,  8,
             8,  9,  9, 10, 10])
+
+    # A modern np.random.Generator works too
+    >>> tr_ids_per_fold, te_ids_per_fold = (
+    ...     make_train_and_test_row_ids_for_n_fold_cv(
+    ...         N, n_folds, random_state=np.random.default_rng(0)))
+    >>> np.sort(np.hstack(te_ids_per_fold))
+    array([ 0,  1,  2,  3,  4,  5,  6,  7,  8,  9, 10])
+    '''
+    train_ids_per_fold = []
+    test_ids_per_fold = []
+    for train_ids, test_ids in iterate_train_and_test_row_ids_for_n_fold_cv(
+            n_examples, n_folds, random_state):
+        train_ids_per_fold.append(train_ids)
+        test_ids_per_fold.append(test_ids)
+    return train_ids_per_fold, test_ids_per_fold
+
+
+def iterate_train_and_test_row_ids_for_n_fold_cv(
+        n_examples=0, n_folds=3, random_state=0):
+    ''' Generate train and test row ids for n-fold cross validation, one fold at a time
+
+    Gives the same folds, in the same order, as
+    make_train_and_test_row_ids_for_n_fold_cv. But each fold's train ids
+    are only built when that fold is requested, so just one size-N array
+    of train ids needs to be in memory at a time.
+
+    The shuffle happens right away (not on first iteration), so the
+    random_state is used at the same point as in the list version.
+
+    Args
+    ----
+    Same as make_train_and_test_row_ids_for_n_fold_cv.
+
+    Returns
+    -------
+    fold_iterator : generator of (train_ids, test_ids) tuples, one per fold
+        train_ids in ascending order, test_ids in shuffled order
+
+    Examples
+    --------
+    >>> for tr_ids, te_ids in iterate_train_and_test_row_ids_for_n_fold_cv(
+    ...         7, n_folds=3, random_state=0):
+    ...     print(tr_ids, te_ids)
+    [0 3 4 5] [6 2 1]
+    [1 2 4 5 6] [3 0]
+    [0 1 2 3 6] [5 4]
     '''
-    if hasattr(random_state, 'rand'):
+    shuffled_ids_N, fold_id_N, fold_starts = _make_shuffled_ids_and_folds(
+        n_examples, n_folds, random_state)
+
+    def generate_folds():
+        for fold in range(n_folds):
+            # Test ids are a slice of the shuffled order.
+            # Train ids come from one linear scan of the fold labels,
+            # already sorted, with no set difference needed.
+            test_ids = shuffled_ids_N[fold_starts[fold]:fold_starts[fold + 1]]
+            train_ids = np.flatnonzero(fold_id_N != fold)
+            yield train_ids, test_ids
+    return generate_folds()
+
+
+def make_fold_id_per_example(n_examples=0, n_folds=3, random_state=0):
+    ''' Assign each example to the fold whose test set contains it
+
+    Uses the same shuffle as make_train_and_test_row_ids_for_n_fold_cv,
+    so example n is in the test set of fold fold_id_N[n] there.
+
+    Returns
+    -------
+    fold_id_N : 1D np.array of int, size n_examples
+        Entry n is the fold (0, 1, ... n_folds-1) of example n
+
+    Examples
+    --------
+    >>> make_fold_id_per_example(7, n_folds=3, random_state=0)
+    array([1, 0, 0, 1, 2, 2, 0])
+    '''
+    _, fold_id_N, _ = _make_shuffled_ids_and_folds(
+        n_examples, n_folds, random_state)
+    return fold_id_N
+
+
+def _make_shuffled_ids_and_folds(n_examples, n_folds, random_state):
+    ''' Shuffle row ids and cut them into n_folds nearly equal folds
+
+    The first (n_examples % n_folds) folds get one extra example.
+
+    Returns
+    -------
+    shuffled_ids_N : 1D np.array of int, size N
+    fold_id_N : 1D np.array of int, size N
+        Fold of each row id
+    fold_starts : 1D np.array of int, size n_folds + 1
+        Fold f holds shuffled_ids_N[fold_starts[f]:fold_starts[f+1]]
+    '''
+    if hasattr(random_state, 'shuffle'):
         # Handle case where provided random_state is a random generator
-        # (e.g. has methods rand() and randn())
+        # (legacy RandomState or modern Generator, both can shuffle)
         random_state = random_state # just remind us we use the passed-in value
     else:
         # Handle case where we pass "seed" for a PRNG as an integer
         random_state = np.random.RandomState(int(random_state))
 
-    # TODO obtain a shuffled order of the n_examples
-    all_indices = np.arange(n_examples)
-    random_state.shuffle(all_indices)
+    # Obtain a shuffled order of the n_examples
+    shuffled_ids_N = np.arange(n_examples)
+    random_state.shuffle(shuffled_ids_N)
 
     fold_sizes = np.full(n_folds, n_examples // n_folds)
     fold_sizes[:n_examples % n_folds] += 1
-    
-    
-    current = 0
-    train_ids_per_fold = []
-    test_ids_per_fold = []
-    for fold_size in fold_sizes:
-        # Define test fold
-        test_ids = all_indices[current:current + fold_size]
-        test_ids_per_fold.append(test_ids)
-
-        # Define train fold (everything not in the test fold)
-        train_ids = np.setdiff1d(all_indices, test_ids)
-        train_ids_per_fold.append(train_ids)
-        
-        current += fold_size
-    
-    # TODO establish the row ids that belong to each fold's
-    # train subset and test subset
+    fold_starts = np.hstack([0, np.cumsum(fold_sizes)])
 
-    return train_ids_per_fold, test_ids_per_fold
\ No newline at end of file
+    # One label per example, filled in a single pass
+    fold_id_N = np.empty(n_examples, dtype=np.intp)
+    fold_id_N[shuffled_ids_N] = np.repeat(np.arange(n_folds), fold_sizes)
+    return shuffled_ids_N, fold_id_N, fold_starts
@@ -0,0 +1,313 @@
+'''
+fold_plan.py
+
+Summary
+-------
+Plan every train/test split of repeated and nested cross validation up front.
+
+A FoldPlan holds, for each repeat r and outer fold k, the test rows of that
+outer fold. For nested CV, it also holds the test rows of each inner fold j,
+which splits the outer fold's training rows again. Each of these is one
+"set", numbered s = 0, 1, ... in (repeat, outer, inner) order, where the outer
+set itself comes first with inner == -1.
+
+Only test rows are stored, as int32, so the whole plan costs about
+4 * N * R * K bytes for R repeats of nested K-fold CV, whatever the
+number of inner folds (4 * N * R without inner folds). Train rows are
+the complement, found on demand.
+
+Repeat 0's outer folds are the same as
+cross_validation.make_train_and_test_row_ids_for_n_fold_cv with the same
+random_state, and adding inner folds does not change any outer fold.
+
+Plans can be saved to and loaded from a .npz file, so every machine
+in a job scores the very same splits.
+
+Examples
+--------
+>>> from cross_validation import make_train_and_test_row_ids_for_n_fold_cv
+>>> plan = make_fold_plan(10, n_folds=3, n_repeats=2, n_inner_folds=2)
+>>> len(plan)
+18
+>>> print(plan.keys_S3[:4])
+[[ 0  0 -1]
+ [ 0  0  0]
+ [ 0  0  1]
+ [ 0  1 -1]]
+>>> train_ids, test_ids = plan.get_train_and_test_row_ids(plan.find_set(0, 1))
+>>> tr_list, te_list = make_train_and_test_row_ids_for_n_fold_cv(10, 3, 0)
+>>> np.array_equal(test_ids, te_list[1]), np.array_equal(train_ids, tr_list[1])
+(True, True)
+>>> test_ids.dtype
+dtype('int32')
+
+# Inner folds split the outer fold's train rows
+>>> inner_sets = [plan.get_train_and_test_row_ids(plan.find_set(0, 1, j))
+...               for j in range(2)]
+>>> np.array_equal(
+...     np.sort(np.hstack([te for _, te in inner_sets])), train_ids)
+True
+>>> np.array_equal(
+...     np.sort(np.hstack([inner_sets[0][0], inner_sets[0][1]])), train_ids)
+True
+
+# Saved plans load back identical
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'plan.npz')
+>>> plan.save(path)
+>>> loaded_plan = load_fold_plan(path)
+>>> np.array_equal(loaded_plan.test_ids_L, plan.test_ids_L)
+True
+>>> loaded_plan.n_repeats, loaded_plan.n_folds, loaded_plan.n_inner_folds
+(2, 3, 2)
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cross_validation import (
+    _fit_and_score_one_fold, _make_shuffled_ids_and_folds,
+    _open_shared_array, _resolve_n_jobs, _share_arrays_in_temp_dir)
+
+
+class FoldPlan(object):
+    ''' Test rows of every set of a repeated (and maybe nested) CV plan
+
+    Attributes
+    ----------
+    * self.keys_S3 : 2D np.array of int32, shape (n_sets, 3)
+        Row s is (repeat, outer fold, inner fold) of set s.
+        Inner fold is -1 for an outer set.
+    * self.set_starts_S1 : 1D np.array of int64, size n_sets + 1
+    * self.test_ids_L : 1D np.array of int32
+        Set s tests on test_ids_L[set_starts_S1[s]:set_starts_S1[s + 1]]
+    '''
+
+    def __init__(self, n_examples, n_folds, n_repeats, n_inner_folds,
+                 keys_S3, set_starts_S1, test_ids_L):
+        ''' Constructor from precomputed arrays. See make_fold_plan.
+        '''
+        self.n_examples = int(n_examples)
+        self.n_folds = int(n_folds)
+        self.n_repeats = int(n_repeats)
+        self.n_inner_folds = int(n_inner_folds)
+        self.keys_S3 = keys_S3
+        self.set_starts_S1 = set_starts_S1
+        self.test_ids_L = test_ids_L
+
+    def __len__(self):
+        return self.keys_S3.shape[0]
+
+    def find_set(self, repeat, outer, inner=-1):
+        ''' Get the number of the set with given (repeat, outer, inner) key
+        '''
+        if not (0 <= repeat < self.n_repeats and 0 <= outer < self.n_folds
+                and -1 <= inner < self.n_inner_folds):
+            raise ValueError("No set with key %s" % str((repeat, outer, inner)))
+        return (repeat * self.n_folds + outer) * (1 + self.n_inner_folds) \
+            + inner + 1
+
+    def get_train_and_test_row_ids(self, s):
+        ''' Get train and test row ids of set s
+
+        Returns
+        -------
+        train_ids : 1D np.array of int32, in ascending order
+            For an outer set, all rows not in its test set. For an inner
+            set, its outer set's train rows not in its own test set.
+        test_ids : 1D np.array of int32
+        '''
+        test_ids = self.test_ids_L[
+            self.set_starts_S1[s]:self.set_starts_S1[s + 1]]
+        is_held_out_N = np.zeros(self.n_examples, dtype=bool)
+        is_held_out_N[test_ids] = True
+        if self.keys_S3[s, 2] >= 0:
+            # Outer set comes just before its inner sets
+            outer_s = s - 1 - self.keys_S3[s, 2]
+            is_held_out_N[self.test_ids_L[
+                self.set_starts_S1[outer_s]:self.set_starts_S1[outer_s + 1]]] = True
+        train_ids = np.flatnonzero(~is_held_out_N).astype(np.int32)
+        return train_ids, test_ids
+
+    def save(self, path):
+        ''' Write plan to a .npz file, to be read by load_fold_plan
+        '''
+        np.savez(
+            path, keys_S3=self.keys_S3, set_starts_S1=self.set_starts_S1,
+            test_ids_L=self.test_ids_L,
+            sizes=np.asarray([
+                self.n_examples, self.n_folds, self.n_repeats,
+                self.n_inner_folds]))
+
+
+def load_fold_plan(path):
+    ''' Read a plan written by FoldPlan.save
+
+    Returns
+    -------
+    plan : FoldPlan
+    '''
+    with np.load(path) as npz:
+        return FoldPlan(
+            *[int(size) for size in npz['sizes']],
+            keys_S3=npz['keys_S3'], set_starts_S1=npz['set_starts_S1'],
+            test_ids_L=npz['test_ids_L'])
+
+
+def make_fold_plan(
+        n_examples, n_folds=3, n_repeats=1, n_inner_folds=0, random_state=0):
+    ''' Draw all splits of repeated, optionally nested, n-fold cross validation
+
+    Args
+    ----
+    n_examples : int
+        Total number of examples to split, N. Must be below 2**31.
+    n_folds : int
+        Number of outer folds, K
+    n_repeats : int
+        Number of times outer folds are redrawn, each with a new shuffle, R
+    n_inner_folds : int
+        Number of inner folds per outer fold, J. 0 means no nested CV.
+    random_state : int or numpy RandomState or Generator instance
+        All outer shuffles are drawn first, then all inner ones.
+
+    Returns
+    -------
+    plan : FoldPlan
+    '''
+    if n_examples >= 2**31:
+        raise ValueError("Row ids of a fold plan must fit in int32")
+    if n_inner_folds == 1 or n_inner_folds < 0:
+        raise ValueError("n_inner_folds must be 0, or at least 2")
+    if not hasattr(random_state, 'shuffle'):
+        random_state = np.random.RandomState(int(random_state))
+    J = int(n_inner_folds)
+
+    outer_plans = [
+        _make_shuffled_ids_and_folds(n_examples, n_folds, random_state)
+        for _ in range(n_repeats)]
+    keys = []
+    test_ids_list = []
+    for repeat, (shuffled_ids_N, fold_id_N, fold_starts) in enumerate(
+            outer_plans):
+        for outer in range(n_folds):
+            keys.append((repeat, outer, -1))
+            test_ids_list.append(
+                shuffled_ids_N[fold_starts[outer]:fold_starts[outer + 1]])
+            if J == 0:
+                continue
+            train_ids = np.flatnonzero(fold_id_N != outer)
+            inner_ids_M, _, inner_starts = _make_shuffled_ids_and_folds(
+                train_ids.size, J, random_state)
+            for inner in range(J):
+                keys.append((repeat, outer, inner))
+                test_ids_list.append(train_ids[
+                    inner_ids_M[inner_starts[inner]:inner_starts[inner + 1]]])
+
+    set_starts_S1 = np.zeros(len(keys) + 1, dtype=np.int64)
+    set_starts_S1[1:] = np.cumsum([ids.size for ids in test_ids_list])
+    test_ids_L = np.empty(set_starts_S1[-1], dtype=np.int32)
+    for s, ids in enumerate(test_ids_list):
+        test_ids_L[set_starts_S1[s]:set_starts_S1[s + 1]] = ids
+    return FoldPlan(
+        n_examples, n_folds, n_repeats, J,
+        np.asarray(keys, dtype=np.int32).reshape(-1, 3), set_starts_S1,
+        test_ids_L)
+
+
+def train_models_and_calc_scores_for_fold_plan(
+        estimator, x_NF, y_N, fold_plan, set_ids=None, n_jobs=1):
+    ''' Fit and score an estimator on sets of a fold plan
+
+    Args
+    ----
+    estimator : any regressor object with sklearn-like API
+    x_NF, y_N : see cross_validation.train_models_and_calc_scores_for_n_fold_cv
+    fold_plan : FoldPlan, with fold_plan.n_examples == N
+    set_ids : 1D array-like of int, or None
+        Sets to score. None means every set in the plan.
+    n_jobs : int or None
+        Number of worker processes. Each set fits its own copy of the
+        estimator in a worker, which maps x_NF, y_N and the plan from
+        memory-mapped files. 1 or None means refit the provided estimator
+        for each set in this process.
+
+    Returns
+    -------
+    train_error_S : 1D numpy array, one entry per set in set_ids
+    test_error_S : 1D numpy array, one entry per set in set_ids
+        Root mean squared error of each set's train and test rows
+
+    Examples
+    --------
+    # Nested CV: choose alpha on the inner folds of each outer fold,
+    # then score the choice on that outer fold's unseen test rows
+    >>> import sklearn.linear_model
+    >>> prng = np.random.RandomState(0)
+    >>> x_N3 = prng.rand(90, 3)
+    >>> y_N = np.dot(x_N3, [1., -2., 3.]) + 0.3 * prng.randn(90)
+    >>> plan = make_fold_plan(90, n_folds=3, n_repeats=2, n_inner_folds=4)
+    >>> alpha_list = [0.01, 1.0, 100.0]
+    >>> test_error_AS = np.vstack([
+    ...     train_models_and_calc_scores_for_fold_plan(
+    ...         sklearn.linear_model.Ridge(alpha=alpha), x_N3, y_N, plan)[1]
+    ...     for alpha in alpha_list])
+    >>> is_inner_S = plan.keys_S3[:, 2] >= 0
+    >>> inner_error_ARKJ = test_error_AS[:, is_inner_S].reshape(3, 2, 3, 4)
+    >>> best_a_RK = np.argmin(np.mean(inner_error_ARKJ, axis=3), axis=0)
+    >>> best_a_RK
+    array([[0, 0, 0],
+           [0, 0, 0]])
+    >>> outer_error_ARK = test_error_AS[:, ~is_inner_S].reshape(3, 2, 3)
+    >>> nested_error_RK = np.take_along_axis(
+    ...     outer_error_ARK, best_a_RK[None], axis=0)[0]
+    >>> print(np.round(np.mean(nested_error_RK), 3))
+    0.311
+
+    # Worker processes give the same results, in the same order
+    >>> _, par_test_error_S = train_models_and_calc_scores_for_fold_plan(
+    ...     sklearn.linear_model.Ridge(alpha=1.0), x_N3, y_N, plan, n_jobs=3)
+    >>> np.allclose(par_test_error_S, test_error_AS[1])
+    True
+    '''
+    if fold_plan.n_examples != x_NF.shape[0]:
+        raise ValueError("Fold plan is for %d examples, data has %d" % (
+            fold_plan.n_examples, x_NF.shape[0]))
+    set_ids = np.arange(len(fold_plan)) if set_ids is None \
+        else np.asarray(set_ids, dtype=np.int64).reshape(-1)
+    n_jobs = _resolve_n_jobs(n_jobs)
+    if n_jobs == 1:
+        errors_S2 = np.asarray([
+            _fit_and_score_one_fold(
+                estimator, x_NF, y_N,
+                *fold_plan.get_train_and_test_row_ids(s))
+            for s in set_ids]).reshape(-1, 2)
+    else:
+        with _share_arrays_in_temp_dir(
+                [('x', x_NF), ('y', y_N), ('keys', fold_plan.keys_S3),
+                 ('starts', fold_plan.set_starts_S1),
+                 ('test_ids', fold_plan.test_ids_L)],
+                prefix='plan_') as specs:
+            sizes = (
+                fold_plan.n_examples, fold_plan.n_folds, fold_plan.n_repeats,
+                fold_plan.n_inner_folds)
+            with ProcessPoolExecutor(
+                    max_workers=min(n_jobs, max(set_ids.size, 1))) as pool:
+                errors_S2 = np.asarray(list(pool.map(
+                    _fit_and_score_plan_set_in_worker,
+                    [estimator] * set_ids.size, [specs] * set_ids.size,
+                    [sizes] * set_ids.size, set_ids))).reshape(-1, 2)
+    return (
+        errors_S2[:, 0].astype(np.float32),
+        errors_S2[:, 1].astype(np.float32))
+
+
+def _fit_and_score_plan_set_in_worker(estimator, specs, sizes, s):
+    ''' Map the shared data and plan, then fit and score one set
+    '''
+    x_NF, y_N, keys_S3, set_starts_S1, test_ids_L = [
+        _open_shared_array(spec) for spec in specs]
+    fold_plan = FoldPlan(*sizes, keys_S3, set_starts_S1, test_ids_L)
+    return _fit_and_score_one_fold(
+        estimator, x_NF, y_N, *fold_plan.get_train_and_test_row_ids(s))
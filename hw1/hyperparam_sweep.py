@@ -0,0 +1,399 @@
+'''
+hyperparam_sweep.py
+
+Summary
+-------
+Select hyperparameters by n-fold cross validation over many configurations.
+
+Every configuration is scored on the same folds, which are drawn once.
+Work is split into (configuration, fold) tasks, so a worker pool stays busy
+even when there are fewer folds than workers.
+
+Folds are visited in stages. After each stage, configurations can be dropped
+before they use up all folds:
+* Successive halving (halving_eta): stages end after 1, eta, eta**2, ...
+  folds, and only the best 1/eta of configurations go on to the next stage.
+* Early stopping (stop_ratio): after every fold, a configuration stops if
+  its mean test error is more than stop_ratio times the best mean so far.
+
+With a checkpoint_path, each finished task is appended to a file as one line
+of JSON. Rerunning the same sweep with the same file skips those tasks, so an
+interrupted sweep resumes where it stopped, and makes the same decisions.
+
+Examples
+--------
+>>> import os, tempfile
+>>> import sklearn.linear_model
+>>> from cross_validation import train_models_and_calc_scores_for_n_fold_cv
+>>> prng = np.random.RandomState(0)
+>>> x_N3 = prng.rand(90, 3)
+>>> y_N = np.dot(x_N3, [1., -2., 3.]) + 0.3 * prng.randn(90)
+>>> def make_ridge(alpha, fit_intercept=True):
+...     return sklearn.linear_model.Ridge(
+...         alpha=alpha, fit_intercept=fit_intercept)
+>>> param_list = make_param_grid(
+...     dict(alpha=[0.01, 1.0, 100.0], fit_intercept=[True, False]))
+>>> len(param_list), param_list[1]
+(6, {'alpha': 0.01, 'fit_intercept': False})
+
+# Each configuration gets the same folds as a direct call to the CV function
+>>> result = run_hyperparam_sweep(
+...     make_ridge, param_list, x_N3, y_N, n_folds=5, random_state=0)
+>>> _, te_K = train_models_and_calc_scores_for_n_fold_cv(
+...     make_ridge(**param_list[2]), x_N3, y_N, n_folds=5, random_state=0)
+>>> np.allclose(result['test_error_CK'][2], te_K)
+True
+>>> result['best_params'], result['n_tasks_run']
+({'alpha': 0.01, 'fit_intercept': False}, 30)
+
+# Worker processes give the same results
+>>> par_result = run_hyperparam_sweep(
+...     make_ridge, param_list, x_N3, y_N, n_folds=5, random_state=0, n_jobs=2)
+>>> np.allclose(par_result['test_error_CK'], result['test_error_CK'])
+True
+
+# Successive halving keeps the best half after 1, 2 and 4 folds
+>>> result = run_hyperparam_sweep(
+...     make_ridge, param_list, x_N3, y_N, n_folds=5, random_state=0,
+...     halving_eta=2)
+>>> result['n_folds_done_C']
+array([4, 5, 1, 2, 1, 1])
+>>> result['best_params']
+{'alpha': 0.01, 'fit_intercept': False}
+
+# Early stopping drops configurations with 1.5x the best error after any fold
+>>> result = run_hyperparam_sweep(
+...     make_ridge, param_list, x_N3, y_N, n_folds=5, random_state=0,
+...     stop_ratio=1.5)
+>>> result['n_folds_done_C'], result['n_tasks_run']
+(array([5, 5, 5, 5, 1, 1]), 22)
+
+# An interrupted sweep resumes from its checkpoint
+>>> path = os.path.join(tempfile.mkdtemp(), 'sweep.jsonl')
+>>> result = run_hyperparam_sweep(
+...     make_ridge, param_list, x_N3, y_N, n_folds=5, random_state=0,
+...     checkpoint_path=path)
+>>> with open(path) as f:
+...     lines = f.readlines()
+>>> with open(path, 'w') as f:
+...     _ = f.write(''.join(lines[:11]) + lines[11][:20])
+>>> resumed_result = run_hyperparam_sweep(
+...     make_ridge, param_list, x_N3, y_N, n_folds=5, random_state=0,
+...     checkpoint_path=path)
+>>> resumed_result['n_tasks_run']
+20
+>>> np.array_equal(resumed_result['test_error_CK'], result['test_error_CK'])
+True
+
+# A checkpoint only resumes the sweep that wrote it, on the same data
+>>> try:
+...     _ = run_hyperparam_sweep(
+...         make_ridge, param_list, x_N3, 2.0 * y_N, n_folds=5,
+...         random_state=0, checkpoint_path=path)
+... except ValueError as e:
+...     print(str(e).split(': ')[-1])
+y differs
+'''
+
+import contextlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from cross_validation import (
+    _fit_and_score_one_fold, _fit_and_score_one_fold_in_worker,
+    _make_shuffled_ids_and_folds, _resolve_n_jobs,
+    _share_arrays_in_temp_dir)
+from transform_cache import calc_data_fingerprint
+
+
+def make_param_grid(param_grid):
+    ''' List every combination of hyperparameter values
+
+    Args
+    ----
+    param_grid : dict
+        Maps each hyperparameter name to a list of candidate values
+
+    Returns
+    -------
+    param_list : list of dict
+        One dict per combination. The last name varies fastest.
+
+    Examples
+    --------
+    >>> make_param_grid(dict(degree=[1, 2], alpha=[0.1, 1.0]))
+    [{'degree': 1, 'alpha': 0.1}, {'degree': 1, 'alpha': 1.0}, {'degree': 2, 'alpha': 0.1}, {'degree': 2, 'alpha': 1.0}]
+    '''
+    names = list(param_grid.keys())
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*[param_grid[name] for name in names])]
+
+
+def sample_random_params(param_distributions, n_configs, random_state=0):
+    ''' Draw hyperparameter configurations at random
+
+    Args
+    ----
+    param_distributions : dict
+        Maps each hyperparameter name to either a list of values, picked
+        uniformly, or a distribution with an rvs method (as in scipy.stats)
+    n_configs : int
+        Number of configurations to draw
+    random_state : int or numpy RandomState instance
+
+    Returns
+    -------
+    param_list : list of dict
+
+    Examples
+    --------
+    >>> param_list = sample_random_params(
+    ...     dict(degree=[1, 2, 3], alpha=np.logspace(-3, 3, 7)), 3)
+    >>> [sorted(params) for params in param_list]
+    [['alpha', 'degree'], ['alpha', 'degree'], ['alpha', 'degree']]
+    >>> param_list == sample_random_params(
+    ...     dict(degree=[1, 2, 3], alpha=np.logspace(-3, 3, 7)), 3)
+    True
+    '''
+    if not hasattr(random_state, 'rand'):
+        random_state = np.random.RandomState(int(random_state))
+    param_list = []
+    for _ in range(int(n_configs)):
+        params = dict()
+        for name, values in param_distributions.items():
+            if hasattr(values, 'rvs'):
+                params[name] = values.rvs(random_state=random_state)
+            else:
+                params[name] = values[random_state.randint(len(values))]
+        param_list.append(params)
+    return param_list
+
+
+def run_hyperparam_sweep(
+        make_estimator, param_list, x_NF, y_N, n_folds=3, random_state=0,
+        n_jobs=1, halving_eta=None, stop_ratio=None, checkpoint_path=None):
+    ''' Score each hyperparameter configuration by n-fold cross validation
+
+    Args
+    ----
+    make_estimator : callable
+        make_estimator(**params) returns a new, unfit estimator
+        with sklearn-like fit and predict methods.
+        Estimators are built in this process and sent to workers.
+    param_list : list of dict
+        One dict of keyword arguments for make_estimator per configuration.
+        See make_param_grid and sample_random_params.
+    x_NF, y_N, n_folds, random_state, n_jobs
+        See cross_validation.train_models_and_calc_scores_for_n_fold_cv.
+    halving_eta : int or None
+        If set (at least 2), use successive halving with this factor.
+    stop_ratio : float or None
+        If set, stop configurations whose mean test error exceeds
+        stop_ratio times the best one, over the folds done so far.
+    checkpoint_path : str or None
+        JSON lines file of finished tasks, created if missing.
+        Raises ValueError if it was written by a different sweep
+        (other make_estimator, configurations, x, y or folds).
+
+    Returns
+    -------
+    result : dict, with keys
+        * 'params' : param_list
+        * 'train_error_CK', 'test_error_CK' : 2D np.arrays, n_configs x n_folds
+            RMSE of each configuration on each fold, NaN if not run
+        * 'n_folds_done_C' : 1D np.array of int, size n_configs
+        * 'best_index', 'best_params' : configuration with the lowest mean
+            test error, among those that ran the most folds
+        * 'n_tasks_run' : number of (config, fold) tasks run by this call,
+            not counting those loaded from the checkpoint
+    '''
+    n_jobs = _resolve_n_jobs(n_jobs)
+    C = len(param_list)
+    if C == 0:
+        raise ValueError("Need at least one configuration")
+    if halving_eta is not None and halving_eta < 2:
+        raise ValueError("halving_eta must be at least 2")
+    shuffled_ids_N, fold_id_N, fold_starts = _make_shuffled_ids_and_folds(
+        x_NF.shape[0], n_folds, random_state)
+
+    train_error_CK = np.full((C, n_folds), np.nan)
+    test_error_CK = np.full((C, n_folds), np.nan)
+    header = dict(
+        estimator='%s.%s' % (
+            make_estimator.__module__,
+            getattr(make_estimator, '__qualname__', repr(make_estimator))),
+        x=calc_data_fingerprint(x_NF),
+        y=calc_data_fingerprint(y_N),
+        folds=calc_data_fingerprint(fold_id_N),
+        params=[repr(sorted(params.items())) for params in param_list])
+    checkpoint_file = None
+    if checkpoint_path is not None:
+        checkpoint_file = _open_checkpoint(
+            checkpoint_path, header, train_error_CK, test_error_CK)
+
+    # Stages end after these numbers of folds
+    if halving_eta is not None:
+        stage_stops = []
+        n_done = 1
+        while n_done < n_folds:
+            stage_stops.append(n_done)
+            n_done *= int(halving_eta)
+        stage_stops.append(n_folds)
+    elif stop_ratio is not None:
+        stage_stops = list(range(1, n_folds + 1))
+    else:
+        stage_stops = [n_folds]
+
+    pool = None
+    n_tasks_run = 0
+    with contextlib.ExitStack() as stack:
+        if checkpoint_file is not None:
+            stack.enter_context(checkpoint_file)
+        if n_jobs > 1:
+            specs = stack.enter_context(_share_arrays_in_temp_dir(
+                [('x', x_NF), ('y', y_N), ('fold', fold_id_N)],
+                prefix='sweep_'))
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=n_jobs))
+
+        active_ids = np.arange(C)
+        stage_start = 0
+        for stage_stop in stage_stops:
+            tasks = [
+                (c, fold)
+                for fold in range(stage_start, stage_stop)
+                for c in active_ids if np.isnan(test_error_CK[c, fold])]
+            n_tasks_run += len(tasks)
+            if pool is None:
+                results = _run_tasks_in_this_process(
+                    make_estimator, param_list, tasks, x_NF, y_N,
+                    shuffled_ids_N, fold_id_N, fold_starts)
+            else:
+                results = _run_tasks_in_pool(
+                    pool, specs, make_estimator, param_list, tasks,
+                    shuffled_ids_N, fold_starts)
+            for (c, fold), (train_error, test_error) in results:
+                train_error_CK[c, fold] = train_error
+                test_error_CK[c, fold] = test_error
+                if checkpoint_file is not None:
+                    checkpoint_file.write(json.dumps(dict(
+                        config=int(c), fold=int(fold),
+                        train_error=float(train_error),
+                        test_error=float(test_error))) + '\n')
+                    checkpoint_file.flush()
+
+            stage_start = stage_stop
+            if stage_stop == n_folds:
+                break
+            mean_error_A = np.mean(test_error_CK[active_ids, :stage_stop], axis=1)
+            if stop_ratio is not None:
+                keep_A = mean_error_A <= stop_ratio * np.min(mean_error_A)
+                active_ids, mean_error_A = active_ids[keep_A], mean_error_A[keep_A]
+            if halving_eta is not None:
+                n_keep = int(np.ceil(active_ids.size / float(halving_eta)))
+                # Stable sort, so ties go to the configuration listed first
+                order = np.argsort(mean_error_A, kind='stable')[:n_keep]
+                active_ids = np.sort(active_ids[order])
+
+    n_folds_done_C = np.sum(~np.isnan(test_error_CK), axis=1)
+    is_finalist_C = n_folds_done_C == np.max(n_folds_done_C)
+    mean_error_C = np.full(C, np.inf)
+    mean_error_C[is_finalist_C] = np.mean(
+        test_error_CK[is_finalist_C][:, :np.max(n_folds_done_C)], axis=1)
+    best_index = int(np.argmin(mean_error_C))
+    return dict(
+        params=param_list,
+        train_error_CK=train_error_CK,
+        test_error_CK=test_error_CK,
+        n_folds_done_C=n_folds_done_C,
+        best_index=best_index,
+        best_params=param_list[best_index],
+        n_tasks_run=n_tasks_run)
+
+
+def _run_tasks_in_this_process(
+        make_estimator, param_list, tasks, x_NF, y_N,
+        shuffled_ids_N, fold_id_N, fold_starts):
+    ''' Fit and score (config, fold) tasks one after another
+
+    Tasks come grouped by fold, so each fold's train ids are found once.
+
+    Returns
+    -------
+    results : list of ((config, fold), (train_error, test_error))
+    '''
+    results = []
+    for fold, fold_tasks in itertools.groupby(tasks, key=lambda task: task[1]):
+        test_ids = shuffled_ids_N[fold_starts[fold]:fold_starts[fold + 1]]
+        train_ids = np.flatnonzero(fold_id_N != fold)
+        for c, _ in fold_tasks:
+            results.append(((c, fold), _fit_and_score_one_fold(
+                make_estimator(**param_list[c]),
+                x_NF, y_N, train_ids, test_ids)))
+    return results
+
+
+def _run_tasks_in_pool(
+        pool, specs, make_estimator, param_list, tasks,
+        shuffled_ids_N, fold_starts):
+    ''' Fit and score (config, fold) tasks in worker processes
+
+    Yields
+    ------
+    (config, fold), (train_error, test_error) for each task, as it finishes
+    '''
+    futures = dict()
+    for c, fold in tasks:
+        future = pool.submit(
+            _fit_and_score_one_fold_in_worker,
+            make_estimator(**param_list[c]), specs, fold,
+            shuffled_ids_N[fold_starts[fold]:fold_starts[fold + 1]])
+        futures[future] = (c, fold)
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def _open_checkpoint(path, header, train_error_CK, test_error_CK):
+    ''' Load finished tasks from a checkpoint file, then open it to append
+
+    A last line cut short by an interruption is dropped.
+    Raises ValueError if the file's header differs from header.
+
+    Returns
+    -------
+    checkpoint_file : open file, positioned at the end
+    '''
+    if not os.path.exists(path):
+        checkpoint_file = open(path, 'w')
+        checkpoint_file.write(json.dumps(header) + '\n')
+        checkpoint_file.flush()
+        return checkpoint_file
+
+    n_good_bytes = 0
+    with open(path) as f:
+        lines = f.readlines()
+    if not lines or not lines[0].endswith('\n'):
+        raise ValueError("Checkpoint %s has no header" % path)
+    old_header = json.loads(lines[0])
+    diff_keys = sorted(
+        key for key in set(header) | set(old_header)
+        if old_header.get(key) != header.get(key))
+    if diff_keys:
+        raise ValueError("Checkpoint %s is from a different sweep: %s differs"
+                         % (path, ', '.join(diff_keys)))
+    for line in lines:
+        if not line.endswith('\n'):
+            break
+        if n_good_bytes > 0:
+            task = json.loads(line)
+            train_error_CK[task['config'], task['fold']] = task['train_error']
+            test_error_CK[task['config'], task['fold']] = task['test_error']
+        n_good_bytes += len(line.encode())
+    checkpoint_file = open(path, 'r+')
+    checkpoint_file.truncate(n_good_bytes)
+    checkpoint_file.seek(n_good_bytes)
+    return checkpoint_file
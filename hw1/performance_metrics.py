@@ -37,5 +37,142 @@ def calc_root_mean_squared_error(y_N, yhat_N):
     yhat_N = np.atleast_1d(yhat_N)
     assert y_N.ndim == 1
     assert y_N.shape == yhat_N.shape
-    return np.linalg.norm(y_N - yhat_N)/(y_N.shape[0]**(1/2))
+    accumulator = RootMeanSquaredErrorAccumulator()
+    accumulator.update(y_N, yhat_N)
+    return accumulator.finalize()
+
+
+class RootMeanSquaredErrorAccumulator(object):
+    ''' Compute root mean squared error over data seen in batches
+
+    Memory use does not grow with the number of examples, so predictions
+    can be scored as they stream from disk. Accumulators that saw
+    different parts of the data (e.g. in worker processes) can be merged.
+
+    Each batch is cut into chunks of at most chunk_size examples. Each
+    chunk's sum of squared errors is added to a running total with
+    Neumaier's compensated summation, which carries the roundoff lost by
+    each addition in a second term. So the total stays accurate to a few
+    units of roundoff over billions of examples, where a plain running
+    sum could lose about log10(N) significant digits.
+
+    Attributes
+    ----------
+    * self.n_examples : int
+        Number of examples seen so far
+    * self.sum_sq_err : float
+        Running sum of squared errors, not counting the compensation
+    * self.compensation : float
+        Roundoff lost from sum_sq_err so far, to be added back at the end
+
+    Examples
+    --------
+    >>> prng = np.random.RandomState(0)
+    >>> y_N = prng.randn(1000)
+    >>> yhat_N = y_N + prng.randn(1000)
+    >>> accumulator = RootMeanSquaredErrorAccumulator()
+    >>> for start in range(0, 1000, 300):
+    ...     accumulator.update(y_N[start:start+300], yhat_N[start:start+300])
+    >>> accumulator.n_examples
+    1000
+    >>> np.allclose(
+    ...     accumulator.finalize(), np.sqrt(np.mean(np.square(y_N - yhat_N))))
+    True
+
+    # Partial accumulators from separate workers merge into the same total
+    >>> first = RootMeanSquaredErrorAccumulator(chunk_size=64)
+    >>> second = RootMeanSquaredErrorAccumulator(chunk_size=64)
+    >>> first.update(y_N[:400], yhat_N[:400])
+    >>> second.update(y_N[400:], yhat_N[400:])
+    >>> first.merge(second)
+    >>> np.allclose(first.finalize(), accumulator.finalize())
+    True
+
+    # Compensation keeps tiny errors that a plain float sum would drop
+    >>> accumulator = RootMeanSquaredErrorAccumulator()
+    >>> accumulator.update(np.asarray([1e8]), np.asarray([0.0]))
+    >>> for _ in range(1000):
+    ...     accumulator.update(np.asarray([1.0]), np.asarray([0.0]))
+    >>> print(accumulator.sum_sq_err + accumulator.compensation - 1e16)
+    1000.0
+    >>> print(accumulator.sum_sq_err - 1e16)
+    0.0
+
+    >>> RootMeanSquaredErrorAccumulator().finalize()
+    Traceback (most recent call last):
+    ...
+    ValueError: Need at least one example to compute RMSE
+    '''
+
+    def __init__(self, chunk_size=65536):
+        ''' Constructor of an accumulator that has seen no examples
+
+        Args
+        ----
+        chunk_size : int
+            Largest number of examples whose errors are held in memory
+            at once, as one temporary float64 array
+        '''
+        self.chunk_size = max(1, int(chunk_size))
+        self.n_examples = 0
+        self.sum_sq_err = 0.0
+        self.compensation = 0.0
+
+    def update(self, y_B, yhat_B):
+        ''' Add squared errors of a batch of examples
+
+        Args
+        ----
+        y_B : 1D array, shape (B,)
+            True responses. May be a np.memmap, read one chunk at a time.
+        yhat_B : 1D array, shape (B,)
+            Predicted responses
+
+        Returns
+        -------
+        Nothing.
+        '''
+        B = y_B.shape[0]
+        if yhat_B.shape != y_B.shape:
+            raise ValueError("Shapes differ: %s vs %s" % (
+                y_B.shape, yhat_B.shape))
+        err_C = np.empty(min(B, self.chunk_size), dtype=np.float64)
+        for start in range(0, B, self.chunk_size):
+            stop = min(B, start + self.chunk_size)
+            chunk_err_C = err_C[:stop - start]
+            np.subtract(y_B[start:stop], yhat_B[start:stop], out=chunk_err_C)
+            self._add(float(np.dot(chunk_err_C, chunk_err_C)))
+        self.n_examples += B
+
+    def merge(self, other):
+        ''' Add in everything another accumulator has seen
+
+        Returns
+        -------
+        Nothing.
+        '''
+        self._add(other.sum_sq_err)
+        self._add(other.compensation)
+        self.n_examples += other.n_examples
+
+    def finalize(self):
+        ''' Compute root mean squared error of all examples seen
+
+        Returns
+        -------
+        rmse : scalar float
+        '''
+        if self.n_examples == 0:
+            raise ValueError("Need at least one example to compute RMSE")
+        return np.sqrt(
+            (self.sum_sq_err + self.compensation) / self.n_examples)
+
+    def _add(self, value):
+        ''' Add value to the running sum, with Neumaier compensation '''
+        total = self.sum_sq_err + value
+        if abs(self.sum_sq_err) >= abs(value):
+            self.compensation += (self.sum_sq_err - total) + value
+        else:
+            self.compensation += (value - total) + self.sum_sq_err
+        self.sum_sq_err = total
 
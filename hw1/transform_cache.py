@@ -0,0 +1,180 @@
+'''
+transform_cache.py
+
+Summary
+-------
+Memoize feature transform outputs, so cross validation does not redo them.
+
+A TransformCache maps a key to a tuple of numpy arrays. The key is built
+from the transform's class and parameters plus a fingerprint of its input
+data, so the same transform of the same rows is computed only once, no
+matter how many folds or hyperparameter settings ask for it.
+
+The cache holds at most max_bytes of arrays. When a new entry would go over
+budget, the least recently used entries are dropped first.
+
+Examples
+--------
+>>> import sklearn.preprocessing
+>>> x_N2 = np.arange(6.0).reshape(3, 2)
+>>> poly = sklearn.preprocessing.PolynomialFeatures(degree=2)
+>>> key = make_transform_key(poly, calc_data_fingerprint(x_N2))
+
+>>> cache = TransformCache(max_bytes=1000)
+>>> cache.get(key) is None
+True
+>>> cache.put(key, (poly.fit_transform(x_N2),))
+>>> cache.get(key)[0].shape
+(3, 6)
+>>> cache.n_hits, cache.n_misses
+(1, 1)
+
+# Same class and parameters, same data: same key
+>>> key == make_transform_key(
+...     sklearn.preprocessing.PolynomialFeatures(degree=2),
+...     calc_data_fingerprint(x_N2.copy()))
+True
+>>> key == make_transform_key(
+...     sklearn.preprocessing.PolynomialFeatures(degree=3),
+...     calc_data_fingerprint(x_N2))
+False
+
+# Least recently used entries are evicted to stay within max_bytes
+>>> cache = TransformCache(max_bytes=1000)
+>>> cache.put('a', (np.zeros(50),))
+>>> cache.put('b', (np.zeros(50),))
+>>> len(cache), cache.n_bytes
+(2, 800)
+>>> _ = cache.get('a')
+>>> cache.put('c', (np.zeros(50),))
+>>> sorted(cache.keys())
+['a', 'c']
+'''
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Default memory budget of a TransformCache, in bytes
+DEFAULT_MAX_BYTES = 2**30
+
+
+class TransformCache(object):
+    ''' Least-recently-used store of transformed arrays, bounded in bytes
+
+    Attributes
+    ----------
+    * self.n_bytes : int
+        Total size of all stored arrays
+    * self.n_hits, self.n_misses : int
+        Number of get calls that found / did not find their key
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        ''' Constructor of an empty cache
+
+        Args
+        ----
+        max_bytes : int
+            Memory budget. A single entry larger than this is not stored.
+        '''
+        self.max_bytes = int(max_bytes)
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        ''' Get stored keys, from least to most recently used '''
+        return list(self._entries.keys())
+
+    def get(self, key):
+        ''' Look up stored arrays, marking them as most recently used
+
+        Returns
+        -------
+        arrays : tuple of np.array, or None if key is not stored
+        '''
+        arrays = self._entries.get(key)
+        if arrays is None:
+            self.n_misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.n_hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        ''' Store arrays under key, evicting old entries to stay in budget
+
+        Args
+        ----
+        key : hashable
+        arrays : tuple of np.array
+            Stored as is, so callers must not modify them afterwards.
+
+        Returns
+        -------
+        Nothing.
+        '''
+        arrays = tuple(arrays)
+        size = _calc_n_bytes(arrays)
+        if key in self._entries:
+            self.n_bytes -= _calc_n_bytes(self._entries.pop(key))
+        if size > self.max_bytes:
+            return
+        while self.n_bytes + size > self.max_bytes:
+            _, old_arrays = self._entries.popitem(last=False)
+            self.n_bytes -= _calc_n_bytes(old_arrays)
+        self._entries[key] = arrays
+        self.n_bytes += size
+
+    def clear(self):
+        ''' Drop all entries '''
+        self._entries.clear()
+        self.n_bytes = 0
+
+
+def calc_data_fingerprint(arr):
+    ''' Compute a digest that identifies an array's contents
+
+    Two arrays with equal shape, dtype and values get the same fingerprint,
+    wherever they live in memory.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest of shape, dtype and raw bytes
+    '''
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((arr.shape, arr.dtype.str)).encode())
+    digest.update(arr.view(np.uint8).reshape(-1) if arr.size else b'')
+    return digest.hexdigest()
+
+
+def make_transform_key(transformer, *data_keys):
+    ''' Build a cache key for applying transformer to some data
+
+    Args
+    ----
+    transformer : sklearn-like transformer
+        Identified by its class and its get_params() values
+    data_keys : hashables
+        Identify the input, e.g. a fingerprint and a fold number
+
+    Returns
+    -------
+    key : tuple
+    '''
+    cls = type(transformer)
+    params = sorted(transformer.get_params(deep=False).items())
+    return ('%s.%s' % (cls.__module__, cls.__qualname__), repr(params)) \
+        + tuple(data_keys)
+
+
+def _calc_n_bytes(arrays):
+    return sum(arr.nbytes for arr in arrays)
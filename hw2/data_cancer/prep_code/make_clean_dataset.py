@@ -1,17 +1,38 @@
 """
 Name        Data Type   Meas.   Description
 ----        ---------   -----   -----------
+
+Usage
+-----
+Stratified splitting comes from hw0_split, so hw0 must be importable:
+$ PYTHONPATH=../../../hw0 python make_clean_dataset.py
 """
 
 import pandas as pd
 import numpy as np
-import sklearn.model_selection
-    
+
+from hw0_split import make_train_and_test_row_ids
+
 y_col_names = [
     'cancer',
     ]
 x_col_names = ['age', 'famhistory', 'marker']
 
+
+def stratified_split_df(df, n_test, random_state):
+    ''' Split rows of a DataFrame, keeping the fraction of each outcome class
+
+    Returns
+    -------
+    rest_df : DataFrame with all rows not in test_df
+    test_df : DataFrame with n_test rows
+    '''
+    rest_ids_M, test_ids_N = make_train_and_test_row_ids(
+        df.shape[0], n_test=n_test, random_state=random_state,
+        stratify=df[y_col_names[0]].values)
+    return df.iloc[rest_ids_M], df.iloc[test_ids_N]
+
+
 if __name__ == '__main__':
     n_test = 180
     csv_df = pd.read_csv('../raw_data/dca.csv', delimiter=',')
@@ -20,10 +41,8 @@ if __name__ == '__main__':
     keep_df = csv_df[x_col_names + y_col_names].copy()
 
     ## Scramble all examples then divide into train/validation/test
-    rest_df, test_df  = sklearn.model_selection.train_test_split(
-        keep_df, test_size=n_test, random_state=42, shuffle=True, stratify=keep_df[y_col_names[0]])
-    train_df, valid_df = sklearn.model_selection.train_test_split(
-        rest_df, test_size=n_test, random_state=42, shuffle=True, stratify=rest_df[y_col_names[0]])
+    rest_df, test_df = stratified_split_df(keep_df, n_test, random_state=42)
+    train_df, valid_df = stratified_split_df(rest_df, n_test, random_state=42)
 
     key_var_names = [
         'cancer',
@@ -0,0 +1,288 @@
+'''
+Approximate nearest neighbor search with an inverted file (IVF) index
+
+The index clusters the dataset with k-means (the "coarse quantizer") and
+keeps one inverted list of row ids per cluster. A query only scores the
+rows in the n_probe lists whose centroids are closest to it, trading a
+little recall for a large cut in work. With n_probe equal to n_lists,
+every row is scored and results are exact.
+
+Examples
+--------
+>>> prng = np.random.RandomState(0)
+>>> data_NF = prng.randn(500, 8)
+>>> query_QF = prng.randn(20, 8)
+>>> index = IVFIndex(n_lists=10, n_probe=3, random_state=0)
+>>> index.fit(data_NF)
+>>> neighb_QKF, ids_QK = index.query(query_QF, K=5)
+>>> neighb_QKF.shape, ids_QK.shape
+((20, 5, 8), (20, 5))
+
+# Probing every list gives the exact answer
+>>> _, exact_ids_QK = calc_k_nearest_neighbors(data_NF, query_QF, K=5)
+>>> _, all_ids_QK = index.query(query_QF, K=5, n_probe=10)
+>>> np.array_equal(all_ids_QK, exact_ids_QK)
+True
+
+# The index can be saved to disk and loaded back
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'index.npz')
+>>> index.save(path)
+>>> loaded_index = load_ivf_index(path)
+>>> np.array_equal(loaded_index.query(query_QF, K=5)[1], ids_QK)
+True
+'''
+
+import numpy as np
+
+from utils import calc_k_nearest_neighbors, _calc_closest_ids_for_batch
+
+
+class IVFIndex(object):
+    ''' Inverted file index for approximate k-nearest neighbor search
+
+    Attributes (set by fit)
+    ----------
+    * self.centroids_LF : 2D numpy array, shape (n_lists, n_feats)
+        Coarse quantizer, one k-means centroid per inverted list
+    * self.list_starts_L1 : 1D numpy array of int, size n_lists + 1
+        Rows of list l are entries list_starts_L1[l]:list_starts_L1[l+1]
+        of self.list_ids_N and self.list_data_NF
+    * self.list_ids_N : 1D numpy array of int, size N
+        Original row ids, grouped by list and ascending within each list
+    * self.list_data_NF : 2D numpy array, shape (N, n_feats)
+        Copy of the data rows, in the same order as self.list_ids_N
+    '''
+
+    def __init__(self, n_lists=64, n_probe=8, n_kmeans_iters=20,
+                 max_train_size=50000, random_state=0):
+        ''' Constructor of an index with given settings
+
+        Args
+        ----
+        n_lists : int
+            Number of clusters (inverted lists) in the coarse quantizer
+        n_probe : int
+            Default number of closest lists to scan per query
+        n_kmeans_iters : int
+            Number of Lloyd iterations when fitting the coarse quantizer
+        max_train_size : int
+            Fit k-means on a random subset of at most this many rows
+        random_state : int or numpy RandomState object
+            Pseudorandom number generator (or seed) for reproducibility
+        '''
+        self.n_lists = int(n_lists)
+        self.n_probe = int(n_probe)
+        self.n_kmeans_iters = int(n_kmeans_iters)
+        self.max_train_size = int(max_train_size)
+        self.random_state = random_state
+
+    def fit(self, data_NF):
+        ''' Build the coarse quantizer and the inverted lists
+
+        Args
+        ----
+        data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
+            Each row is a feature vector for one example in dataset
+
+        Returns
+        -------
+        Nothing.
+        '''
+        data_NF = np.asarray(data_NF)
+        N, F = data_NF.shape
+        if hasattr(self.random_state, 'rand'):
+            random_state = self.random_state
+        else:
+            random_state = np.random.RandomState(int(self.random_state))
+        L = min(self.n_lists, N)
+
+        train_ids = np.arange(N)
+        if N > self.max_train_size:
+            train_ids = np.sort(random_state.choice(
+                N, self.max_train_size, replace=False))
+        self.centroids_LF = fit_kmeans_centroids(
+            data_NF[train_ids], L, self.n_kmeans_iters, random_state)
+
+        # Stable sort by list keeps original row order within each list
+        list_N = assign_to_nearest_centroid(data_NF, self.centroids_LF)
+        self.list_ids_N = np.argsort(list_N, kind='stable')
+        self.list_starts_L1 = np.hstack([
+            0, np.cumsum(np.bincount(list_N, minlength=L))])
+        self.list_data_NF = data_NF[self.list_ids_N]
+        self._cache_sqnorms()
+
+    def query(self, query_QF, K=1, n_probe=None):
+        ''' Find approximate k-nearest neighbors of each query
+
+        Rows from the probed lists are ranked by Euclidean distance,
+        breaking ties by original row order, exactly as in
+        utils.calc_k_nearest_neighbors. If the probed lists hold fewer than
+        K rows for some query, that query falls back to exact search.
+
+        Args
+        ----
+        query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
+            Each row is a feature vector whose neighbors we want to find
+        K : int, must satisfy K >= 1 and K <= n_examples aka N
+            Number of neighbors to find per query vector
+        n_probe : int or None
+            Number of closest lists to scan. If None, uses self.n_probe.
+
+        Returns
+        -------
+        neighb_QKF : 3D np.array, (n_queries, n_neighbors, n_feats) == (Q, K, F)
+            Entry q,k is feature vector of k-th nearest neighbor found
+        closest_ids_QK : 2D np.array of int, (n_queries, n_neighbors) == (Q, K)
+            Entry q,k is the row id in the original data of that neighbor
+        '''
+        query_QF = np.asarray(query_QF, dtype=np.float64)
+        Q = query_QF.shape[0]
+        N = self.list_ids_N.shape[0]
+        L = self.centroids_LF.shape[0]
+        K = int(K)
+        if K < 1:
+            raise ValueError("Invalid number of neighbors (K). Too small.")
+        if K > N:
+            raise ValueError("Invalid number of neighbors (K). Too large.")
+        n_probe = self.n_probe if n_probe is None else int(n_probe)
+        n_probe = max(1, min(n_probe, L))
+
+        # Lists to probe for each query, then flip into queries per list
+        cent_dist_QL = (
+            np.sum(np.square(query_QF), axis=1)[:, None]
+            - 2.0 * np.dot(query_QF, self.centroids_LF.T)
+            + self._centroid_sqnorm_L[None, :])
+        if n_probe < L:
+            probe_QP = np.argpartition(cent_dist_QL, n_probe - 1, axis=1)[
+                :, :n_probe]
+        else:
+            probe_QP = np.tile(np.arange(L), (Q, 1))
+
+        best_dist_QK = np.full((Q, K), np.inf)
+        best_ids_QK = np.full((Q, K), N, dtype=np.intp)
+        probe_lists_P = probe_QP.ravel()
+        probe_queries_P = np.repeat(np.arange(Q), n_probe)
+        order_P = np.argsort(probe_lists_P, kind='stable')
+        probe_starts_L1 = np.hstack([
+            0, np.cumsum(np.bincount(probe_lists_P, minlength=L))])
+        for ll in range(L):
+            start, stop = self.list_starts_L1[ll], self.list_starts_L1[ll + 1]
+            if stop == start:
+                continue
+            q_ids = probe_queries_P[
+                order_P[probe_starts_L1[ll]:probe_starts_L1[ll + 1]]]
+            if q_ids.size == 0:
+                continue
+            local_ids_BJ, dist_BJ = _calc_closest_ids_for_batch(
+                np.asarray(self.list_data_NF[start:stop], dtype=np.float64),
+                self._list_sqnorm_N[start:stop],
+                query_QF[q_ids], min(K, stop - start))
+
+            # Merge with running best, ordering by distance then row id
+            all_dist_BL = np.hstack([best_dist_QK[q_ids], dist_BJ])
+            all_ids_BL = np.hstack([
+                best_ids_QK[q_ids], self.list_ids_N[start + local_ids_BJ]])
+            order_BK = np.lexsort((all_ids_BL, all_dist_BL), axis=1)[:, :K]
+            best_dist_QK[q_ids] = np.take_along_axis(
+                all_dist_BL, order_BK, axis=1)
+            best_ids_QK[q_ids] = np.take_along_axis(
+                all_ids_BL, order_BK, axis=1)
+
+        short_Q = np.flatnonzero(best_ids_QK[:, K - 1] == N)
+        if short_Q.size > 0:
+            data_NF = np.empty_like(self.list_data_NF)
+            data_NF[self.list_ids_N] = self.list_data_NF
+            _, best_ids_QK[short_Q] = calc_k_nearest_neighbors(
+                data_NF, query_QF[short_Q], K=K)
+
+        data_pos_QK = self._pos_of_id_N[best_ids_QK]
+        return np.asarray(
+            self.list_data_NF[data_pos_QK], dtype=np.float64), best_ids_QK
+
+    def save(self, path):
+        ''' Write this fitted index to a .npz file at provided path
+        '''
+        np.savez(
+            path,
+            n_probe=self.n_probe,
+            centroids_LF=self.centroids_LF,
+            list_starts_L1=self.list_starts_L1,
+            list_ids_N=self.list_ids_N,
+            list_data_NF=self.list_data_NF)
+
+    def _cache_sqnorms(self):
+        ''' Precompute squared norms of centroids and data rows
+
+        Post-Condition
+        --------------
+        Internal attributes updated:
+        * self._centroid_sqnorm_L, self._list_sqnorm_N, self._pos_of_id_N
+        '''
+        self._centroid_sqnorm_L = np.sum(np.square(self.centroids_LF), axis=1)
+        list_data_NF = np.asarray(self.list_data_NF, dtype=np.float64)
+        self._list_sqnorm_N = np.einsum('nf,nf->n', list_data_NF, list_data_NF)
+        self._pos_of_id_N = np.empty_like(self.list_ids_N)
+        self._pos_of_id_N[self.list_ids_N] = np.arange(self.list_ids_N.size)
+
+
+def load_ivf_index(path):
+    ''' Load an IVFIndex previously written by IVFIndex.save
+
+    Returns
+    -------
+    index : IVFIndex
+        Fitted index, ready for calls to query
+    '''
+    with np.load(path) as arrs:
+        index = IVFIndex(
+            n_lists=arrs['centroids_LF'].shape[0],
+            n_probe=int(arrs['n_probe']))
+        index.centroids_LF = arrs['centroids_LF']
+        index.list_starts_L1 = arrs['list_starts_L1']
+        index.list_ids_N = arrs['list_ids_N']
+        index.list_data_NF = arrs['list_data_NF']
+    index._cache_sqnorms()
+    return index
+
+
+def fit_kmeans_centroids(data_NF, n_clusters, n_iters, random_state):
+    ''' Fit k-means centroids with Lloyd's algorithm
+
+    Initial centroids are distinct random rows. Any cluster that ends up
+    empty is re-seeded at a random row.
+
+    Returns
+    -------
+    centroids_LF : 2D np.array, shape (n_clusters, n_feats)
+    '''
+    data_NF = np.asarray(data_NF, dtype=np.float64)
+    N = data_NF.shape[0]
+    centroids_LF = data_NF[random_state.choice(N, n_clusters, replace=False)]
+    for _ in range(n_iters):
+        assign_N = assign_to_nearest_centroid(data_NF, centroids_LF)
+        counts_L = np.bincount(assign_N, minlength=n_clusters)
+        is_empty_L = counts_L == 0
+        starts_L = np.hstack([0, np.cumsum(counts_L)[:-1]])
+        sums_LF = np.zeros_like(centroids_LF)
+        sums_LF[~is_empty_L] = np.add.reduceat(
+            data_NF[np.argsort(assign_N, kind='stable')],
+            starts_L[~is_empty_L], axis=0)
+        centroids_LF = sums_LF / np.maximum(counts_L, 1)[:, None]
+        centroids_LF[is_empty_L] = data_NF[
+            random_state.choice(N, int(np.sum(is_empty_L)))]
+    return centroids_LF
+
+
+def assign_to_nearest_centroid(data_NF, centroids_LF):
+    ''' Find id of the closest centroid for each row
+
+    Returns
+    -------
+    assign_N : 1D np.array of int, size N
+    '''
+    data_NF = np.asarray(data_NF, dtype=np.float64)
+    dist_NL = (
+        -2.0 * np.dot(data_NF, centroids_LF.T)
+        + np.sum(np.square(centroids_LF), axis=1)[None, :])
+    return np.argmin(dist_NL, axis=1)
@@ -0,0 +1,90 @@
+'''
+ann_index_benchmark.py
+
+Summary
+-------
+Recall@K versus latency of IVFIndex, compared to exact k-NN search,
+on the BERT review embeddings. Use the printed table to choose n_lists
+and n_probe for a good operating point.
+
+Recall@K is the fraction of the exact K nearest neighbors (from
+utils.calc_k_nearest_neighbors) that the index also returns.
+
+Usage
+-----
+$ python ann_index_benchmark.py
+'''
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from ann_index import IVFIndex
+from utils import calc_k_nearest_neighbors
+
+
+def calc_recall_at_k(exact_ids_QK, approx_ids_QK):
+    ''' Compute average fraction of exact neighbors found by approximate search
+
+    Examples
+    --------
+    >>> calc_recall_at_k(np.asarray([[0, 1], [2, 3]]), np.asarray([[1, 0], [2, 5]]))
+    0.75
+    '''
+    Q, K = exact_ids_QK.shape
+    n_found = sum(
+        np.intersect1d(exact_ids_QK[q], approx_ids_QK[q]).size for q in range(Q))
+    return n_found / float(Q * K)
+
+
+def benchmark_recall_vs_latency(
+        data_NF, query_QF, K=10, n_lists_list=(16, 48),
+        n_probe_list=(1, 2, 4, 8, 16), n_repeats=3):
+    ''' Print recall@K and per-query latency for several index settings
+    '''
+    Q = query_QF.shape[0]
+    exact_ids_QK = None
+    elapsed_list = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        _, exact_ids_QK = calc_k_nearest_neighbors(data_NF, query_QF, K=K)
+        elapsed_list.append(time.perf_counter() - start)
+    exact_ms = 1000.0 * min(elapsed_list) / Q
+
+    print("N=%d F=%d Q=%d K=%d" % (data_NF.shape + (Q, K)))
+    print("%10s %8s %12s %14s %10s" % (
+        'n_lists', 'n_probe', 'recall@K', 'ms per query', 'speedup'))
+    print("%10s %8s %12.4f %14.4f %10.2f" % ('exact', '-', 1.0, exact_ms, 1.0))
+    for n_lists in n_lists_list:
+        index = IVFIndex(n_lists=n_lists, random_state=0)
+        start = time.perf_counter()
+        index.fit(data_NF)
+        build_sec = time.perf_counter() - start
+        for n_probe in n_probe_list:
+            if n_probe > n_lists:
+                continue
+            elapsed_list = []
+            for _ in range(n_repeats):
+                start = time.perf_counter()
+                _, ids_QK = index.query(query_QF, K=K, n_probe=n_probe)
+                elapsed_list.append(time.perf_counter() - start)
+            ms = 1000.0 * min(elapsed_list) / Q
+            print("%10d %8d %12.4f %14.4f %10.2f" % (
+                n_lists, n_probe, calc_recall_at_k(exact_ids_QK, ids_QK),
+                ms, exact_ms / ms))
+        print("%10d %8s (build took %.2f sec)" % (n_lists, '', build_sec))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=os.path.join('..', 'data_reviews'))
+    parser.add_argument('--K', type=int, default=10)
+    args = parser.parse_args()
+
+    data_NF = np.load(
+        os.path.join(args.data_dir, 'x_train_BERT_embeddings.npy'))
+    query_QF = np.load(
+        os.path.join(args.data_dir, 'x_test_BERT_embeddings.npy'))
+    benchmark_recall_vs_latency(data_NF, query_QF, K=args.K)
@@ -0,0 +1,277 @@
+'''
+Mutable exact k-nearest neighbor index supporting online insert and delete
+
+New rows are appended to a growable buffer, so adding M rows costs O(M * F)
+(amortized), not a rebuild of everything. Deleted rows are only marked
+dead ("tombstoned") until the next compaction, which squeezes them out in
+one O(N * F) pass. Compaction runs automatically once the dead fraction
+exceeds compact_threshold, and can also be called directly.
+
+Each row gets a stable insertion id when added: 0, 1, 2, ... in order of
+insertion, never reused. Rows are kept in insertion order (compaction
+preserves it), so equally close rows are ranked by insertion id, just as
+utils.calc_k_nearest_neighbors ranks them by row order.
+
+Examples
+--------
+>>> index = IncrementalKNNIndex()
+>>> index.add(np.asarray([[0., 0.], [1., 0.], [2., 0.]]))
+array([0, 1, 2])
+>>> index.add(np.asarray([[1., 0.], [3., 0.]]))
+array([3, 4])
+>>> query_QF = np.asarray([[1.1, 0.]])
+>>> index.query(query_QF, K=3)[1]
+array([[1, 3, 2]])
+
+# Deleted rows are never returned, before or after compaction
+>>> index.remove([1])
+>>> index.query(query_QF, K=3)[1]
+array([[3, 2, 0]])
+>>> index.compact()
+>>> len(index), index.n_dead
+(4, 0)
+>>> neighb_QKF, ids_QK = index.query(query_QF, K=3)
+>>> ids_QK
+array([[3, 2, 0]])
+>>> neighb_QKF[0, 0]
+array([1., 0.])
+
+Regression Test Against Rebuilding From Scratch
+-----------------------------------------------
+>>> prng = np.random.RandomState(0)
+>>> index = IncrementalKNNIndex(compact_threshold=0.3)
+>>> all_NF = np.zeros((0, 3))
+>>> for step in range(20):
+...     all_NF = np.vstack([all_NF, prng.randint(-2, 3, size=(40, 3))])
+...     _ = index.add(all_NF[-40:])
+...     index.remove(prng.choice(index.get_ids(), 15, replace=False))
+...     query_QF = prng.randint(-2, 3, size=(10, 3)).astype(np.float64)
+...     live_ids = index.get_ids()
+...     _, expected_QK = calc_k_nearest_neighbors(
+...         all_NF[live_ids], query_QF, K=8)
+...     assert np.array_equal(index.query(query_QF, K=8)[1], live_ids[expected_QK])
+>>> len(index)
+500
+'''
+
+import numpy as np
+
+from utils import (
+    DEFAULT_BATCH_SIZE, PreparedDataset,
+    calc_k_nearest_neighbors, calc_k_nearest_neighbor_ids)
+
+
+class IncrementalKNNIndex(object):
+    ''' Exact k-NN index over a set of rows that changes over time
+
+    Attributes
+    ----------
+    * self.n_dead : int
+        Number of deleted rows not yet removed by compaction
+    * self.n_added : int
+        Total number of rows ever added; the next insertion id
+    '''
+
+    def __init__(self, metric='euclidean', compact_threshold=0.25,
+                 dtype=None, batch_size=DEFAULT_BATCH_SIZE, n_jobs=1):
+        ''' Constructor of an empty index
+
+        Args
+        ----
+        metric : str
+            Any metric supported by utils.calc_k_nearest_neighbor_ids
+        compact_threshold : float, between 0 and 1
+            Compact when more than this fraction of stored rows are dead.
+            Dead rows never change query results, but until compaction
+            they still take memory and add to each query's scan time.
+        dtype : np.float32, np.float64, or None
+            Precision of stored rows. If None, set by the first added rows
+            (float32 stays float32, anything else is float64).
+        batch_size, n_jobs : int
+            Passed on to utils.calc_k_nearest_neighbor_ids
+        '''
+        self.metric = metric
+        self.compact_threshold = float(compact_threshold)
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.n_dead = 0
+        self.n_added = 0
+        self._n_rows = 0
+        self._data_CF = None
+        self._sqnorm_C = None
+        self._ids_C = np.zeros(0, dtype=np.int64)
+        self._is_alive_C = np.zeros(0, dtype=bool)
+        self._prepared = None
+
+    def __len__(self):
+        ''' Number of live (not deleted) rows '''
+        return self._n_rows - self.n_dead
+
+    def add(self, data_MF):
+        ''' Append rows to the index
+
+        Args
+        ----
+        data_MF : 2D np.array, shape (M, F)
+
+        Returns
+        -------
+        ids_M : 1D np.array of int, size M
+            Insertion id assigned to each new row
+        '''
+        data_MF = np.asarray(data_MF)
+        M, F = data_MF.shape
+        if self._data_CF is None:
+            if self.dtype is None:
+                self.dtype = (
+                    np.float32 if data_MF.dtype == np.float32 else np.float64)
+            self._data_CF = np.zeros((0, F), dtype=self.dtype)
+            self._sqnorm_C = np.zeros(0, dtype=self.dtype)
+        if F != self._data_CF.shape[1]:
+            raise ValueError(
+                "Expected %d features, got %d" % (self._data_CF.shape[1], F))
+
+        # Grow capacity geometrically, so appends cost O(M * F) amortized
+        stop = self._n_rows + M
+        if stop > self._data_CF.shape[0]:
+            C = max(stop, 2 * self._data_CF.shape[0], 16)
+            self._data_CF = _resize_rows(self._data_CF, self._n_rows, C)
+            self._sqnorm_C = _resize_rows(self._sqnorm_C, self._n_rows, C)
+            self._ids_C = _resize_rows(self._ids_C, self._n_rows, C)
+            self._is_alive_C = _resize_rows(self._is_alive_C, self._n_rows, C)
+        new_MF = self._data_CF[self._n_rows:stop]
+        new_MF[:] = data_MF
+        self._sqnorm_C[self._n_rows:stop] = np.einsum(
+            'mf,mf->m', new_MF, new_MF)
+        ids_M = np.arange(self.n_added, self.n_added + M, dtype=np.int64)
+        self._ids_C[self._n_rows:stop] = ids_M
+        self._is_alive_C[self._n_rows:stop] = True
+        self._n_rows = stop
+        self.n_added += M
+        self._prepared = None
+        return ids_M
+
+    def remove(self, ids):
+        ''' Delete rows by insertion id
+
+        Rows are tombstoned, then compacted away once more than
+        compact_threshold of stored rows are dead.
+
+        Args
+        ----
+        ids : 1D array-like of int
+            Insertion ids of live rows
+
+        Returns
+        -------
+        Nothing.
+        '''
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        rows = self._find_rows(ids)
+        if not np.all(self._is_alive_C[rows]):
+            raise KeyError("Rows already deleted: %s" % (
+                ids[~self._is_alive_C[rows]]))
+        self._is_alive_C[rows] = False
+        self.n_dead += ids.size
+        if self.n_dead > self.compact_threshold * self._n_rows:
+            self.compact()
+
+    def compact(self):
+        ''' Squeeze out deleted rows, keeping live rows in insertion order
+
+        Returns
+        -------
+        Nothing.
+        '''
+        if self.n_dead == 0:
+            return
+        keep = np.flatnonzero(self._is_alive_C[:self._n_rows])
+        M = keep.size
+        self._data_CF[:M] = self._data_CF[keep]
+        self._sqnorm_C[:M] = self._sqnorm_C[keep]
+        self._ids_C[:M] = self._ids_C[keep]
+        self._is_alive_C[:M] = True
+        self._is_alive_C[M:] = False
+        self._n_rows = M
+        self.n_dead = 0
+        self._prepared = None
+
+    def get_ids(self):
+        ''' Get insertion ids of all live rows, in ascending order '''
+        rows = self._is_alive_C[:self._n_rows]
+        return self._ids_C[:self._n_rows][rows]
+
+    def get_rows(self, ids):
+        ''' Get feature vectors of rows by insertion id
+
+        Returns
+        -------
+        data_MF : 2D np.array, shape (M, F)
+        '''
+        return self._data_CF[self._find_rows(np.asarray(ids, dtype=np.int64))]
+
+    def query(self, query_QF, K=1, return_distance=False):
+        ''' Find k-nearest live neighbors of each query
+
+        Dead rows are scored as infinitely far before the top K are
+        chosen, so queries cost the same as with no dead rows stored
+        (apart from scanning them).
+
+        Args
+        ----
+        query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
+        K : int, must satisfy K >= 1 and K <= len(self)
+        return_distance : bool
+            If True, also return distance to each neighbor.
+
+        Returns
+        -------
+        neighb_QKF : 3D np.array, (n_queries, n_neighbors, n_feats) == (Q, K, F)
+            Entry q,k is feature vector of k-th nearest neighbor of the q-th query
+        closest_ids_QK : 2D np.array of int, (n_queries, n_neighbors) == (Q, K)
+            Entry q,k is the insertion id of that neighbor.
+            If two vectors are equally close, then we break ties by taking
+            the one inserted first.
+        dist_QK : 2D np.array, (n_queries, n_neighbors) == (Q, K)
+            Only returned if return_distance is True.
+        '''
+        K = int(K)
+        if K > len(self):
+            raise ValueError("Invalid number of neighbors (K). Too large.")
+        if self._prepared is None:
+            # Views of the buffers; row norms are reused, not recomputed
+            self._prepared = PreparedDataset(
+                self._data_CF[:self._n_rows],
+                sqnorm_N=self._sqnorm_C[:self._n_rows])
+        rows_QK, dist_QK = calc_k_nearest_neighbor_ids(
+            self._prepared, query_QF, K=K,
+            batch_size=self.batch_size, metric=self.metric,
+            n_jobs=self.n_jobs, return_distance=True,
+            exclude_N=(
+                ~self._is_alive_C[:self._n_rows] if self.n_dead > 0 else None))
+        neighb_QKF = self._data_CF[rows_QK]
+        if return_distance:
+            return neighb_QKF, self._ids_C[rows_QK], dist_QK
+        return neighb_QKF, self._ids_C[rows_QK]
+
+    def _find_rows(self, ids):
+        ''' Find buffer rows holding provided insertion ids
+
+        Stored ids ascend with row position, so this is a binary search.
+        '''
+        stored_ids = self._ids_C[:self._n_rows]
+        rows = np.searchsorted(stored_ids, ids)
+        rows = np.minimum(rows, max(self._n_rows - 1, 0))
+        is_found = (rows < self._n_rows) & (stored_ids[rows] == ids)
+        if self._n_rows == 0 or not np.all(is_found):
+            raise KeyError("Unknown ids: %s" % (
+                ids if self._n_rows == 0 else ids[~is_found]))
+        return rows
+
+
+def _resize_rows(arr, n_rows, capacity):
+    ''' Copy first n_rows of array into a new array with capacity rows '''
+    new_arr = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+    new_arr[:n_rows] = arr[:n_rows]
+    return new_arr
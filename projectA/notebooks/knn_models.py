@@ -0,0 +1,234 @@
+'''
+k-nearest neighbor classifier and regressor with sklearn-like API
+
+Both models look up only the ids (and distances) of each query's
+neighbors via utils.calc_k_nearest_neighbor_ids, then vote or average
+directly from the stored training labels. No (Q, K, F) array of
+neighbor feature vectors is ever built.
+
+Examples
+--------
+>>> x_tr_NF = np.asarray([[0., 0.], [0., 1.], [1., 0.], [5., 5.], [5., 6.]])
+>>> y_tr_N = np.asarray([0, 0, 1, 1, 1])
+>>> clf = KNNClassifier(K=3)
+>>> clf.fit(x_tr_NF, y_tr_N)
+>>> x_te_QF = np.asarray([[0.1, 0.1], [4., 4.]])
+>>> clf.predict(x_te_QF)
+array([0, 1])
+>>> print(np.round(clf.predict_proba(x_te_QF), 3))
+[[0.667 0.333]
+ [0.333 0.667]]
+
+>>> regr = KNNRegressor(K=2)
+>>> regr.fit(x_tr_NF, np.asarray([1., 2., 3., 4., 6.]))
+>>> print(regr.predict(x_te_QF))
+[1.5 5. ]
+
+# Distance weighting: an exact match takes all the weight
+>>> regr = KNNRegressor(K=2, weights='distance')
+>>> regr.fit(x_tr_NF, np.asarray([1., 2., 3., 4., 6.]))
+>>> print(regr.predict(np.asarray([[0., 1.]])))
+[2.]
+
+# Cosine distance to a scaled copy of a training row is zero, not negative
+>>> x_NF = np.random.RandomState(0).randn(200, 5)
+>>> clf = KNNClassifier(K=3, metric='cosine', weights='distance')
+>>> clf.fit(x_NF, np.arange(200) % 2)
+>>> np.array_equal(clf.predict(3.0 * x_NF[:50]), np.arange(50) % 2)
+True
+'''
+
+import numpy as np
+
+from utils import PreparedDataset, calc_k_nearest_neighbor_ids
+
+
+class KNNClassifier(object):
+    ''' Predicts the label most common among each query's K nearest neighbors
+
+    Attributes (set by fit)
+    ----------
+    * self.classes_C : 1D numpy array, size n_classes
+        Sorted unique labels seen in training
+    * self.prepared : utils.PreparedDataset
+        Training features, with cached row norms
+    '''
+
+    def __init__(self, K=5, metric='euclidean', weights='uniform',
+                 batch_size=256, n_jobs=1):
+        ''' Constructor of a k-NN classifier
+
+        Args
+        ----
+        K : int
+            Number of neighbors that vote
+        metric : str
+            Any metric supported by utils.calc_k_nearest_neighbor_ids
+        weights : str, 'uniform' or 'distance'
+            If 'distance', each vote counts 1 / distance.
+            Exact matches (distance zero) then take all the weight.
+            Not allowed with metric 'inner_product', whose "distance" is
+            a negated similarity (often negative), not a dissimilarity.
+        batch_size, n_jobs : int
+            Passed on to utils.calc_k_nearest_neighbor_ids
+        '''
+        _check_weights_for_metric(weights, metric)
+        self.K = int(K)
+        self.metric = metric
+        self.weights = weights
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def fit(self, x_NF, y_N):
+        ''' Store training data
+
+        Args
+        ----
+        x_NF : 2D numpy array, shape (n_examples, n_features) = (N, F)
+        y_N : 1D numpy array, shape (n_examples,) = (N,)
+            Discrete labels, any sortable type
+
+        Returns
+        -------
+        Nothing.
+        '''
+        self.prepared = PreparedDataset(x_NF)
+        self.classes_C, self._y_ids_N = np.unique(y_N, return_inverse=True)
+
+    def predict_proba(self, x_QF):
+        ''' Compute fraction of (weighted) neighbor votes for each class
+
+        Returns
+        -------
+        proba_QC : 2D numpy array, shape (n_queries, n_classes)
+            Columns follow the order of self.classes_C. Rows sum to one.
+        '''
+        ids_QK, dist_QK = calc_k_nearest_neighbor_ids(
+            self.prepared, x_QF, K=self.K, metric=self.metric,
+            batch_size=self.batch_size, n_jobs=self.n_jobs,
+            return_distance=True)
+        weight_QK = calc_neighbor_weights(dist_QK, self.weights)
+        C = self.classes_C.size
+        votes_QC = np.zeros((ids_QK.shape[0], C))
+        label_QK = self._y_ids_N[ids_QK]
+        for c in range(C):
+            votes_QC[:, c] = np.sum(weight_QK * (label_QK == c), axis=1)
+        return votes_QC / np.sum(votes_QC, axis=1, keepdims=True)
+
+    def predict(self, x_QF):
+        ''' Predict the label with the most (weighted) neighbor votes
+
+        Ties between classes go to the class that sorts first.
+
+        Returns
+        -------
+        yhat_Q : 1D numpy array, size n_queries
+        '''
+        return self.classes_C[np.argmax(self.predict_proba(x_QF), axis=1)]
+
+
+class KNNRegressor(object):
+    ''' Predicts the (weighted) mean response of each query's K nearest neighbors
+
+    Attributes (set by fit)
+    ----------
+    * self.y_N : 1D numpy array, size N
+        Training responses
+    * self.prepared : utils.PreparedDataset
+        Training features, with cached row norms
+    '''
+
+    def __init__(self, K=5, metric='euclidean', weights='uniform',
+                 batch_size=256, n_jobs=1):
+        ''' Constructor of a k-NN regressor
+
+        Args
+        ----
+        See KNNClassifier.
+        '''
+        _check_weights_for_metric(weights, metric)
+        self.K = int(K)
+        self.metric = metric
+        self.weights = weights
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def fit(self, x_NF, y_N):
+        ''' Store training data
+
+        Returns
+        -------
+        Nothing.
+        '''
+        self.prepared = PreparedDataset(x_NF)
+        self.y_N = np.asarray(y_N, dtype=np.float64)
+
+    def predict(self, x_QF):
+        ''' Predict the (weighted) average neighbor response
+
+        Returns
+        -------
+        yhat_Q : 1D numpy array, size n_queries
+        '''
+        ids_QK, dist_QK = calc_k_nearest_neighbor_ids(
+            self.prepared, x_QF, K=self.K, metric=self.metric,
+            batch_size=self.batch_size, n_jobs=self.n_jobs,
+            return_distance=True)
+        weight_QK = calc_neighbor_weights(dist_QK, self.weights)
+        return (
+            np.sum(weight_QK * self.y_N[ids_QK], axis=1)
+            / np.sum(weight_QK, axis=1))
+
+
+def _check_weights_for_metric(weights, metric):
+    ''' Raise ValueError unless weights make sense for the metric
+
+    Examples
+    --------
+    >>> KNNRegressor(weights='distance', metric='inner_product')
+    Traceback (most recent call last):
+    ...
+    ValueError: weights='distance' needs a non-negative distance, but metric 'inner_product' gives negated similarities. Use weights='uniform', or metric='cosine'.
+    '''
+    if weights == 'distance' and metric == 'inner_product':
+        raise ValueError(
+            "weights='distance' needs a non-negative distance, but metric"
+            " '%s' gives negated similarities. Use weights='uniform',"
+            " or metric='cosine'." % metric)
+
+
+def calc_neighbor_weights(dist_QK, weights='uniform'):
+    ''' Compute how much each neighbor counts toward a prediction
+
+    Args
+    ----
+    dist_QK : 2D numpy array, shape (Q, K)
+        Distance from each query to each of its neighbors.
+        Must be non-negative if weights is 'distance'.
+    weights : str, 'uniform' or 'distance'
+
+    Returns
+    -------
+    weight_QK : 2D numpy array, shape (Q, K)
+        All ones if 'uniform'. Otherwise 1 / distance, except that for any
+        query with an exact match, its exact matches get weight one and all
+        other neighbors weight zero.
+
+    Examples
+    --------
+    >>> print(calc_neighbor_weights(np.asarray([[1., 4.], [0., 2.]]), 'distance'))
+    [[1.   0.25]
+     [1.   0.  ]]
+    '''
+    if weights == 'uniform':
+        return np.ones_like(dist_QK, dtype=np.float64)
+    elif weights != 'distance':
+        raise ValueError("Unrecognized weights: %s" % weights)
+    if np.any(dist_QK < 0):
+        raise ValueError("weights='distance' needs non-negative distances")
+    is_exact_QK = dist_QK <= 0
+    has_exact_Q = np.any(is_exact_QK, axis=1)
+    with np.errstate(divide='ignore'):
+        weight_QK = 1.0 / np.asarray(dist_QK, dtype=np.float64)
+    weight_QK[has_exact_Q] = is_exact_QK[has_exact_Q]
+    return weight_QK
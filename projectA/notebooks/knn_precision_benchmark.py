@@ -0,0 +1,90 @@
+'''
+knn_precision_benchmark.py
+
+Summary
+-------
+Throughput and recall@K of k-NN search at reduced precision on the BERT
+review embeddings, compared to a float64 baseline.
+
+Each metric is benchmarked separately, since int8 candidates are scored
+differently for Euclidean and similarity metrics.
+
+Modes compared:
+* float64 : data upcast to float64 (the old behavior)
+* float32 : data kept in its on-disk float32 precision
+* int8    : scalar-quantized codes, with n_rerank candidates re-ranked
+
+Usage
+-----
+$ python knn_precision_benchmark.py
+$ python knn_precision_benchmark.py --metrics inner_product
+'''
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from ann_index_benchmark import calc_recall_at_k
+from utils import PreparedDataset, calc_k_nearest_neighbors
+
+
+def time_search(prepared, query_QF, K, n_repeats=3, **kwargs):
+    ''' Run search n_repeats times, return fastest time and the found ids
+    '''
+    elapsed_list = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        _, ids_QK = calc_k_nearest_neighbors(prepared, query_QF, K=K, **kwargs)
+        elapsed_list.append(time.perf_counter() - start)
+    return min(elapsed_list), ids_QK
+
+
+def benchmark_precision(data_NF, query_QF, K=10, metric='euclidean',
+                        rerank_factors=(1, 2, 4, 8)):
+    ''' Print queries per second and recall@K for each precision mode
+    '''
+    Q = query_QF.shape[0]
+    prepared64 = PreparedDataset(data_NF, dtype=np.float64)
+    prepared32 = PreparedDataset(data_NF, dtype=np.float32)
+    # Build the int8 codes up front so their one-time cost is not timed
+    prepared32.get_int8_codes(unit=(metric == 'cosine'))
+
+    base_sec, base_ids_QK = time_search(prepared64, query_QF, K, metric=metric)
+    print("N=%d F=%d Q=%d K=%d metric=%s" % (data_NF.shape + (Q, K, metric)))
+    print("%-18s %12s %12s %10s %14s" % (
+        'mode', 'queries/s', 'speedup', 'recall@K', 'data (MB)'))
+    rows = [('float64', prepared64.data_NF.nbytes,
+             (base_sec, base_ids_QK))]
+    rows.append(('float32', prepared32.data_NF.nbytes,
+                 time_search(prepared32, query_QF, K, metric=metric)))
+    codes_nbytes = prepared32.get_int8_codes(
+        unit=(metric == 'cosine')).codes_NF.nbytes
+    for factor in rerank_factors:
+        rows.append((
+            'int8 rerank=%dK' % factor, codes_nbytes,
+            time_search(prepared32, query_QF, K, metric=metric,
+                        quantize='int8', n_rerank=factor * K)))
+    for name, nbytes, (elapsed_sec, ids_QK) in rows:
+        print("%-18s %12.1f %12.2f %10.4f %14.1f" % (
+            name, Q / elapsed_sec, base_sec / elapsed_sec,
+            calc_recall_at_k(base_ids_QK, ids_QK), nbytes / 2**20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=os.path.join('..', 'data_reviews'))
+    parser.add_argument('--K', type=int, default=10)
+    parser.add_argument(
+        '--metrics', nargs='+',
+        default=['euclidean', 'inner_product', 'cosine'])
+    args = parser.parse_args()
+
+    data_NF = np.load(
+        os.path.join(args.data_dir, 'x_train_BERT_embeddings.npy'))
+    query_QF = np.load(
+        os.path.join(args.data_dir, 'x_test_BERT_embeddings.npy'))
+    for metric in args.metrics:
+        benchmark_precision(data_NF, query_QF, K=args.K, metric=metric)
+        print("")
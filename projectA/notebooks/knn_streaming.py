@@ -0,0 +1,218 @@
+'''
+Streaming k-nearest neighbor search over data too large to fit in RAM
+
+The data (typically a .npy file opened with np.load(..., mmap_mode='r'))
+is read once, front to back, in chunks of chunk_size rows. Each chunk is
+searched with the same batch routine as utils.calc_k_nearest_neighbor_ids,
+and its best rows are merged into a running top-K per query. Only one
+chunk of data is in memory at a time.
+
+Results match utils.calc_k_nearest_neighbor_ids exactly for Euclidean
+metrics, including breaking ties between equally close rows by row order.
+
+Time spent reading chunks and time spent computing are tracked separately,
+so we can tell whether a search is disk-bound or compute-bound.
+
+Examples
+--------
+>>> import tempfile
+>>> from utils import calc_k_nearest_neighbor_ids
+>>> prng = np.random.RandomState(0)
+>>> data_NF = prng.randint(-2, 3, size=(500, 4)).astype(np.float32)
+>>> query_QF = prng.randint(-2, 3, size=(30, 4)).astype(np.float32)
+>>> path = os.path.join(tempfile.mkdtemp(), 'data.npy')
+>>> np.save(path, data_NF)
+
+# Opening the file as a memory map reads nothing up front
+>>> mmap_NF = open_memmap_data(path)
+>>> type(mmap_NF).__name__
+'memmap'
+>>> ids_QK, dist_QK, stats = calc_k_nearest_neighbor_ids_streaming(
+...     mmap_NF, query_QF, K=7, chunk_size=64, batch_size=8,
+...     return_distance=True, return_stats=True)
+>>> expected_ids_QK, expected_dist_QK = calc_k_nearest_neighbor_ids(
+...     data_NF, query_QF, K=7, return_distance=True)
+>>> np.array_equal(ids_QK, expected_ids_QK)
+True
+>>> np.array_equal(dist_QK, expected_dist_QK)
+True
+>>> stats['n_chunks'], stats['bytes_read'] == data_NF.nbytes
+(8, True)
+
+# A path can be passed directly
+>>> ids_QK = calc_k_nearest_neighbor_ids_streaming(path, query_QF, K=7)
+>>> np.array_equal(ids_QK, expected_ids_QK)
+True
+'''
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from utils import (
+    DEFAULT_BATCH_SIZE, METRIC_NAMES,
+    _calc_closest_ids_for_batch, _safe_norm)
+
+# Default number of data rows read from disk at once
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def open_memmap_data(path):
+    ''' Open a .npy file of data rows as a read-only memory map
+
+    Returns
+    -------
+    data_NF : 2D np.memmap, shape (N, F)
+        Rows are only read from disk when accessed
+    '''
+    return np.load(path, mmap_mode='r')
+
+
+def calc_k_nearest_neighbor_ids_streaming(
+        data_NF, query_QF, K=1, chunk_size=DEFAULT_CHUNK_SIZE,
+        batch_size=DEFAULT_BATCH_SIZE, metric='euclidean',
+        return_distance=False, return_stats=False):
+    ''' Compute row ids of k-nearest neighbors in one sequential pass over data
+
+        Each chunk of data rows is copied into memory once, then scored
+        against every batch of queries. Each chunk's best K rows for a query
+        are merged with that query's running best K by sorting on
+        (distance, row id), so ties keep row order across chunks too.
+
+        Args
+        ----
+        data_NF : 2D np.array or np.memmap, shape (N, F), or str path to .npy
+            Each row is a feature vector for one example in dataset.
+            A path is opened with open_memmap_data.
+            float32 data stays float32; anything else is computed as float64.
+        query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
+            Each row is a feature vector whose neighbors we want to find
+        K : int, must satisfy K >= 1 and K <= n_examples aka N
+            Number of neighbors to find per query vector
+        chunk_size : int
+            Number of data rows read from disk at once.
+            Memory use grows like chunk_size * (F + batch_size).
+        batch_size : int
+            Number of queries scored together against one chunk
+        metric : str, one of utils.METRIC_NAMES
+        return_distance : bool
+            If True, also return the distance to each neighbor,
+            with the same meaning as in utils.calc_k_nearest_neighbor_ids.
+        return_stats : bool
+            If True, also return a dict of I/O and compute statistics.
+
+        Returns
+        -------
+        closest_ids_QK : 2D np.array of int, (n_queries, n_neighbors) == (Q, K)
+            Entry q,k is the row id in data_NF of the k-th nearest neighbor
+            of the q-th query.
+        dist_QK : 2D np.array, (n_queries, n_neighbors) == (Q, K)
+            Only returned if return_distance is True.
+        stats : dict
+            Only returned if return_stats is True. Keys:
+            * 'n_chunks' : number of chunks read
+            * 'bytes_read' : total bytes of data read
+            * 'read_sec' : time spent reading chunks into memory
+            * 'compute_sec' : time spent scoring and merging
+            * 'read_mb_per_sec' : bytes_read / read_sec, in MB (2**20 bytes)
+    '''
+    if isinstance(data_NF, str):
+        data_NF = open_memmap_data(data_NF)
+
+    # Unpack to get number of examples (N), features (F), and queries (Q)
+    N, F = data_NF.shape
+    Q, F2 = query_QF.shape
+    assert F == F2
+
+    K = int(K)
+    if K < 1:
+        raise ValueError("Invalid number of neighbors (K). Too small.")
+    if K > N:
+        raise ValueError("Invalid number of neighbors (K). Too large.")
+    if metric not in METRIC_NAMES:
+        raise ValueError("Unrecognized metric: %s" % metric)
+    dtype = np.float32 if data_NF.dtype == np.float32 else np.float64
+    chunk_size = max(1, int(chunk_size))
+    batch_size = max(1, int(batch_size))
+
+    query_QF = np.asarray(query_QF, dtype=dtype)
+    if metric == 'cosine':
+        query_QF = query_QF / _safe_norm(
+            np.einsum('qf,qf->q', query_QF, query_QF))[:, None]
+
+    best_ids_QK = np.zeros((Q, 0), dtype=np.intp)
+    best_dist_QK = np.zeros((Q, 0), dtype=dtype)
+    stats = dict(n_chunks=0, bytes_read=0, read_sec=0.0, compute_sec=0.0)
+    for start in range(0, N, chunk_size):
+        stop = min(N, start + chunk_size)
+
+        # Copying the slice forces the memory-mapped pages to be read
+        read_start = time.perf_counter()
+        chunk_TF = np.array(data_NF[start:stop], dtype=dtype)
+        stats['read_sec'] += time.perf_counter() - read_start
+        stats['n_chunks'] += 1
+        stats['bytes_read'] += (stop - start) * F * data_NF.dtype.itemsize
+
+        compute_start = time.perf_counter()
+        sqnorm_T = np.einsum('tf,tf->t', chunk_TF, chunk_TF)
+        if metric == 'cosine':
+            chunk_TF = chunk_TF / _safe_norm(sqnorm_T)[:, None]
+        chunk_K = min(K, stop - start)
+        new_ids_QK = np.zeros((Q, chunk_K), dtype=np.intp)
+        new_dist_QK = np.zeros((Q, chunk_K), dtype=dtype)
+        for q_start in range(0, Q, batch_size):
+            q_stop = min(Q, q_start + batch_size)
+            ids_BK, dist_BK = _calc_closest_ids_for_batch(
+                chunk_TF, sqnorm_T, query_QF[q_start:q_stop], chunk_K,
+                metric=metric)
+            new_ids_QK[q_start:q_stop] = start + ids_BK
+            new_dist_QK[q_start:q_stop] = dist_BK
+
+        # Merge into the running top-K, breaking distance ties by row id
+        all_ids_QL = np.hstack([best_ids_QK, new_ids_QK])
+        all_dist_QL = np.hstack([best_dist_QK, new_dist_QK])
+        order_QK = np.lexsort((all_ids_QL, all_dist_QL), axis=1)[:, :K]
+        best_ids_QK = np.take_along_axis(all_ids_QL, order_QK, axis=1)
+        best_dist_QK = np.take_along_axis(all_dist_QL, order_QK, axis=1)
+        stats['compute_sec'] += time.perf_counter() - compute_start
+
+    stats['read_mb_per_sec'] = (
+        stats['bytes_read'] / 2**20 / max(stats['read_sec'], 1e-12))
+
+    result = [best_ids_QK]
+    if return_distance:
+        if metric == 'euclidean':
+            best_dist_QK = np.sqrt(best_dist_QK)
+        elif metric == 'cosine':
+            best_dist_QK = 1.0 + best_dist_QK
+        result.append(best_dist_QK)
+    if return_stats:
+        result.append(stats)
+    return result[0] if len(result) == 1 else tuple(result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=os.path.join('..', 'data_reviews'))
+    parser.add_argument('--K', type=int, default=10)
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--metric', default='euclidean')
+    args = parser.parse_args()
+
+    data_NF = open_memmap_data(
+        os.path.join(args.data_dir, 'x_train_BERT_embeddings.npy'))
+    query_QF = np.load(
+        os.path.join(args.data_dir, 'x_test_BERT_embeddings.npy'))
+    _, stats = calc_k_nearest_neighbor_ids_streaming(
+        data_NF, query_QF, K=args.K, chunk_size=args.chunk_size,
+        metric=args.metric, return_stats=True)
+    print("N=%d F=%d Q=%d K=%d chunk_size=%d" % (
+        data_NF.shape + (query_QF.shape[0], args.K, args.chunk_size)))
+    print("read    %8.3f sec  %10.1f MB/s  (%d chunks, %.1f MB)" % (
+        stats['read_sec'], stats['read_mb_per_sec'], stats['n_chunks'],
+        stats['bytes_read'] / 2**20))
+    print("compute %8.3f sec" % stats['compute_sec'])
+    print("bound by %s" % (
+        'disk' if stats['read_sec'] > stats['compute_sec'] else 'compute'))
@@ -1,17 +1,241 @@
+'''
+Utilities for k-nearest neighbor search over review embeddings
+
+Regression Test Against Stable Argsort
+--------------------------------------
+# Points on a small integer grid, with many duplicates, give many exact ties
+>>> prng = np.random.RandomState(42)
+>>> data_NF = prng.randint(-2, 3, size=(300, 3)).astype(np.float64)
+>>> query_QF = prng.randint(-2, 3, size=(40, 3)).astype(np.float64)
+>>> dist_QN = np.sum(np.square(data_NF[None] - query_QF[:, None]), axis=2)
+>>> for K in [1, 7, 50, 300]:
+...     expected_QK = np.argsort(dist_QN, axis=1, kind='stable')[:, :K]
+...     for batch_size, n_jobs in [(1, 1), (7, 1), (1000, 1), (7, 3)]:
+...         neighb_QKF, ids_QK = calc_k_nearest_neighbors(
+...             data_NF, query_QF, K=K, batch_size=batch_size, n_jobs=n_jobs)
+...         assert np.array_equal(ids_QK, expected_QK), (K, batch_size)
+...         assert np.array_equal(neighb_QKF, data_NF[expected_QK]), K
+
+Example Test Other Metrics
+--------------------------
+# BERT embeddings are often compared by cosine similarity
+>>> mdata_NF = np.asarray([[10., 0.], [1., 1.], [0.5, 0.]])
+>>> mquery_QF = np.asarray([[1., 0.]])
+>>> for metric in METRIC_NAMES:
+...     print(metric, calc_k_nearest_neighbors(
+...         mdata_NF, mquery_QF, K=3, metric=metric)[1])
+euclidean [[2 1 0]]
+sqeuclidean [[2 1 0]]
+cosine [[0 2 1]]
+inner_product [[0 1 2]]
+
+# Preparing the dataset once caches row norms and unit-length rows
+>>> prepared = PreparedDataset(mdata_NF)
+>>> neighb_QKF, ids_QK = calc_k_nearest_neighbors(
+...     prepared, -mquery_QF, K=2, metric='cosine')
+>>> ids_QK
+array([[1, 0]])
+>>> neighb_QKF
+array([[[ 1.,  1.],
+        [10.,  0.]]])
+
+Example Test Reduced Precision
+------------------------------
+# float32 data stays float32, halving memory traffic versus float64
+>>> data32_NF = prng.randn(500, 16).astype(np.float32)
+>>> query32_QF = prng.randn(20, 16).astype(np.float32)
+>>> neighb_QKF, ids_QK = calc_k_nearest_neighbors(data32_NF, query32_QF, K=5)
+>>> neighb_QKF.dtype
+dtype('float32')
+>>> dist32_QN = np.sum(np.square(data32_NF[None] - query32_QF[:, None]), axis=2)
+>>> np.array_equal(ids_QK, np.argsort(dist32_QN, axis=1, kind='stable')[:, :5])
+True
+
+# int8 codes find candidates, which are re-ranked in full precision
+>>> _, ids8_QK = calc_k_nearest_neighbors(
+...     data32_NF, query32_QF, K=5, quantize='int8', n_rerank=50)
+>>> bool(np.mean(ids8_QK == ids_QK) > 0.9)
+True
+
+# Similarity metrics too, even for data far from the origin
+>>> offset32_NF = data32_NF + np.float32(5.0)
+>>> for metric in ['inner_product', 'cosine']:
+...     _, exact_QK = calc_k_nearest_neighbors(
+...         offset32_NF, query32_QF, K=5, metric=metric)
+...     _, ids8_QK = calc_k_nearest_neighbors(
+...         offset32_NF, query32_QF, K=5, metric=metric,
+...         quantize='int8', n_rerank=20)
+...     print(metric, bool(np.mean(ids8_QK == exact_QK) > 0.9))
+inner_product True
+cosine True
+
+Example Test Ids and Distances Only
+-----------------------------------
+# Skip gathering a (Q, K, F) array when only ids and distances are needed
+>>> ids_QK, dist_QK = calc_k_nearest_neighbor_ids(
+...     mdata_NF, mquery_QF, K=2, return_distance=True)
+>>> ids_QK
+array([[2, 1]])
+>>> print(dist_QK)
+[[0.5 1. ]]
+
+Compatibility With List Output
+-----------------------------
+# Older code expects one id array per query in a Python list
+>>> _, ids_per_query = calc_k_nearest_neighbors(
+...     data_NF, query_QF[:2], K=3, return_ids_as_list=True)
+>>> type(ids_per_query).__name__, len(ids_per_query)
+('list', 2)
+>>> ids_per_query[0]
+array([ 85, 228, 269])
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+# Default number of queries scored together by one matrix product
+DEFAULT_BATCH_SIZE = 256
+
+# Supported ways to measure how close a data row is to a query
+METRIC_NAMES = ('euclidean', 'sqeuclidean', 'cosine', 'inner_product')
+
+# Number of data rows scanned at once when searching quantized codes
+QUANTIZED_CHUNK_SIZE = 8192
+
+# Largest (queries x candidates x features) array built when re-scoring
+RESCORE_MAX_BYTES = 64 * 2**20
+
+
+class PreparedDataset(object):
+    ''' Dataset wrapped with per-row quantities that k-NN search reuses
+
+    Pass an instance in place of data_NF to calc_k_nearest_neighbors.
+    Squared row norms (and, for cosine, unit-length rows) cost O(N * F)
+    to compute; a prepared dataset pays that once for many query batches.
+
+    Attributes
+    ----------
+    * self.data_NF : 2D numpy array, shape (N, F)
+        The data, as float32 or float64
+    * self.sqnorm_N : 1D numpy array, size N
+        Squared Euclidean norm of each row
+    '''
+
+    def __init__(self, data_NF, dtype=None, sqnorm_N=None):
+        ''' Wrap provided data
+
+        Args
+        ----
+        data_NF : 2D np.array, shape (N, F)
+        dtype : np.float32, np.float64, or None
+            Precision used for all distance computations.
+            If None, float32 data stays float32, anything else is float64.
+        sqnorm_N : 1D np.array, size N, or None
+            Squared row norms, if already known (for example, kept up to
+            date by a caller that appends rows). Computed if None.
+        '''
+        data_NF = np.asarray(data_NF)
+        if dtype is None:
+            dtype = np.float32 if data_NF.dtype == np.float32 else np.float64
+        self.data_NF = np.asarray(data_NF, dtype=dtype)
+        if sqnorm_N is None:
+            sqnorm_N = np.einsum('nf,nf->n', self.data_NF, self.data_NF)
+        self.sqnorm_N = np.asarray(sqnorm_N, dtype=dtype)
+        self._unit_data_NF = None
+        self._int8_codes_by_key = dict()
+
+    def get_unit_data_NF(self):
+        ''' Get copy of data with each row scaled to unit length
+
+        Rows of all zeros stay all zeros. Computed on first call only.
+        '''
+        if self._unit_data_NF is None:
+            self._unit_data_NF = self.data_NF / _safe_norm(self.sqnorm_N)[:, None]
+        return self._unit_data_NF
+
+    def get_int8_codes(self, unit=False):
+        ''' Get scalar-quantized copy of the data. Computed on first call only.
+
+        Args
+        ----
+        unit : bool
+            If True, quantize the unit-length rows instead (for cosine)
+
+        Returns
+        -------
+        codes : Int8Codes
+        '''
+        if unit not in self._int8_codes_by_key:
+            self._int8_codes_by_key[unit] = Int8Codes(
+                self.get_unit_data_NF() if unit else self.data_NF)
+        return self._int8_codes_by_key[unit]
+
+
+class Int8Codes(object):
+    ''' Scalar quantization of each feature onto 256 evenly spaced levels
+
+    Row n is approximated by center_F + step_F * codes_NF[n], with
+    codes_NF stored as int8, a quarter of the size of float32.
+
+    Attributes
+    ----------
+    * self.codes_NF : 2D numpy array of int8, shape (N, F)
+    * self.center_F : 1D numpy array of float32, size F
+    * self.step_F : 1D numpy array of float32, size F
+    * self.code_sqnorm_N : 1D numpy array of float32, size N
+        Squared norm of step_F * codes_NF[n] for each row n
+
+    Examples
+    --------
+    >>> data_NF = np.asarray([[0., 10.], [5., 20.], [1., 12.]])
+    >>> codes = Int8Codes(data_NF)
+    >>> codes.codes_NF[:2]
+    array([[-128, -128],
+           [ 127,  127]], dtype=int8)
+
+    # Reconstruction is within half a step of the original
+    >>> approx_NF = codes.center_F + codes.step_F * codes.codes_NF
+    >>> bool(np.all(np.abs(approx_NF - data_NF) <= 0.5001 * codes.step_F))
+    True
+    '''
+
+    def __init__(self, data_NF):
+        lo_F = np.min(data_NF, axis=0).astype(np.float32)
+        hi_F = np.max(data_NF, axis=0).astype(np.float32)
+        self.step_F = np.maximum(hi_F - lo_F, np.finfo(np.float32).tiny) / 255
+        self.center_F = lo_F + 128 * self.step_F
+        levels_NF = np.rint((data_NF - lo_F) / self.step_F)
+        self.codes_NF = (np.clip(levels_NF, 0, 255) - 128).astype(np.int8)
+        scaled_NF = self.step_F * self.codes_NF.astype(np.float32)
+        self.code_sqnorm_N = np.einsum('nf,nf->n', scaled_NF, scaled_NF)
 
-def calc_k_nearest_neighbors(data_NF, query_QF, K=1):
-    ''' Compute and return k-nearest neighbors under Euclidean distance
+
+def calc_k_nearest_neighbors(
+        data_NF, query_QF, K=1,
+        batch_size=DEFAULT_BATCH_SIZE, return_ids_as_list=False,
+        metric='euclidean', quantize=None, n_rerank=None, n_jobs=1):
+    ''' Compute and return k-nearest neighbors under a chosen metric
+
+        Gathers the neighbor feature vectors found by
+        calc_k_nearest_neighbor_ids. When only ids are needed (for example,
+        to look up labels), call that function instead and skip building
+        the (Q, K, F) array.
 
         Args
         ----
         data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
             Each row is a feature vector for one example in dataset
+            May also be a PreparedDataset wrapping such an array.
         query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
             Each row is a feature vector whose neighbors we want to find
         K : int, must satisfy K >= 1 and K <= n_examples aka N
             Number of neighbors to find per query vector
+        return_ids_as_list : bool
+            If True, return ids as a list of Q 1D arrays (the old format).
+        batch_size, metric, quantize, n_rerank, n_jobs
+            See calc_k_nearest_neighbor_ids.
 
         Returns
         -------
@@ -19,9 +243,93 @@ def calc_k_nearest_neighbors(data_NF, query_QF, K=1):
             Entry q,k is feature vector of k-th nearest neighbor of the q-th query
             If two vectors are equally close, then we break ties by taking the one
             appearing first in row order in the original data_NF array
+        closest_ids_QK : 2D np.array of int, (n_queries, n_neighbors) == (Q, K)
+            Entry q,k is the row id in data_NF of the k-th nearest neighbor
+            of the q-th query. A list of Q arrays if return_ids_as_list=True.
+    '''
+    if not isinstance(data_NF, PreparedDataset):
+        data_NF = PreparedDataset(data_NF)
+    closest_ids_QK = calc_k_nearest_neighbor_ids(
+        data_NF, query_QF, K=K, batch_size=batch_size, metric=metric,
+        quantize=quantize, n_rerank=n_rerank, n_jobs=n_jobs)
+    neighbors_QKF = data_NF.data_NF[closest_ids_QK]
+    if return_ids_as_list:
+        return neighbors_QKF, list(closest_ids_QK)
+    return neighbors_QKF, closest_ids_QK
+
+
+def calc_k_nearest_neighbor_ids(
+        data_NF, query_QF, K=1, batch_size=DEFAULT_BATCH_SIZE,
+        metric='euclidean', quantize=None, n_rerank=None, n_jobs=1,
+        return_distance=False, exclude_N=None):
+    ''' Compute row ids (and optionally distances) of k-nearest neighbors
+
+        Queries are handled in batches. For each batch, squared distances to
+        all N examples come from one matrix product via the expansion
+        ||a||^2 - 2 a.b + ||b||^2. Examples whose expanded distance is within
+        a roundoff bound of the K-th best are re-scored with the direct
+        formula sum_f (a_f - b_f)^2, so the ranking (including ties) is the
+        same as a stable argsort of direct distances.
+
+        The similarity metrics ('cosine' and 'inner_product') rank examples
+        by the computed dot product itself, so ties mean equal computed values.
+
+        Computation uses the precision of the data: float32 data stays float32
+        (wrap in PreparedDataset(data_NF, dtype=np.float64) to force float64).
+        With quantize='int8', an int8 copy of the data is scanned to find
+        n_rerank candidates per query, which are then ranked in full precision.
+        This is approximate: true neighbors may be missed if they fall outside
+        the candidates.
+
+        Args
+        ----
+        data_NF : 2D np.array, shape = (n_examples, n_feats) == (N, F)
+            Each row is a feature vector for one example in dataset
+            May also be a PreparedDataset wrapping such an array.
+        query_QF : 2D np.array, shape = (n_queries, n_feats) == (Q, F)
+            Each row is a feature vector whose neighbors we want to find
+        K : int, must satisfy K >= 1 and K <= n_examples aka N
+            Number of neighbors to find per query vector
+        batch_size : int
+            Number of queries to process at once.
+            Memory use grows like batch_size * N.
+        metric : str, one of METRIC_NAMES
+            'euclidean' and 'sqeuclidean' rank by distance (same order).
+            'cosine' ranks by cosine distance 1 - a.b / (||a|| ||b||).
+            'inner_product' ranks by largest dot product a.b first.
+        quantize : None or 'int8'
+            If 'int8', find candidates using scalar-quantized data.
+        n_rerank : int or None
+            Number of candidates to re-rank per query when quantize='int8'.
+            Defaults to 4 * K. Larger values trade speed for recall.
+        n_jobs : int or None
+            Number of threads to spread query batches over.
+            None or 1 means no threading, -1 means one thread per CPU core.
+        return_distance : bool
+            If True, also return the distance to each neighbor.
+        exclude_N : 1D np.array of bool, size N, or None
+            If provided, rows where True are never returned, as if they
+            were infinitely far from every query. K must not exceed the
+            number of rows left.
+
+        Returns
+        -------
+        closest_ids_QK : 2D np.array of int, (n_queries, n_neighbors) == (Q, K)
+            Entry q,k is the row id in data_NF of the k-th nearest neighbor
+            of the q-th query. If two vectors are equally close, then we break
+            ties by taking the one appearing first in row order in data_NF.
+        dist_QK : 2D np.array, (n_queries, n_neighbors) == (Q, K)
+            Only returned if return_distance is True.
+            Entry q,k is distance from query q to its k-th nearest neighbor:
+            Euclidean or squared Euclidean distance, cosine distance, or the
+            negated dot product for 'inner_product' (so smaller is closer).
     '''
+    if not isinstance(data_NF, PreparedDataset):
+        data_NF = PreparedDataset(data_NF)
+    prepared = data_NF
+
     # Unpack to get number of examples (N), features (F), and queries (Q)
-    N, F = data_NF.shape
+    N, F = prepared.data_NF.shape
     Q, F2 = query_QF.shape
     assert F == F2
 
@@ -30,25 +338,303 @@ def calc_k_nearest_neighbors(data_NF, query_QF, K=1):
         raise ValueError("Invalid number of neighbors (K). Too small.")
     if K > N:
         raise ValueError("Invalid number of neighbors (K). Too large.")
+    if exclude_N is not None:
+        exclude_N = np.asarray(exclude_N, dtype=bool)
+        if K > N - np.count_nonzero(exclude_N):
+            raise ValueError("Invalid number of neighbors (K). Too large.")
+    if metric not in METRIC_NAMES:
+        raise ValueError("Unrecognized metric: %s" % metric)
+    if quantize not in (None, 'int8'):
+        raise ValueError("Unrecognized quantize option: %s" % quantize)
+    dtype = prepared.data_NF.dtype
+    n_jobs = _resolve_n_jobs(n_jobs)
+    batch_size = max(1, min(int(batch_size), -(-Q // n_jobs)))
+
+    # Build any shared caches once, before threads start
+    if metric == 'cosine':
+        scan_data_NF = prepared.get_unit_data_NF()
+    else:
+        scan_data_NF = prepared.data_NF
+    if quantize == 'int8':
+        prepared.get_int8_codes(unit=(metric == 'cosine'))
+
+    closest_ids_QK = np.zeros((Q, K), dtype=np.intp)
+    dist_QK = np.zeros((Q, K), dtype=dtype)
+
+    def fill_batch(q_start):
+        q_stop = min(Q, q_start + batch_size)
+        query_BF = np.asarray(query_QF[q_start:q_stop], dtype=dtype)
+        if metric == 'cosine':
+            query_BF = query_BF / _safe_norm(
+                np.einsum('bf,bf->b', query_BF, query_BF))[:, None]
+        if quantize == 'int8':
+            ids_BK, dist_BK = _calc_closest_ids_for_batch_int8(
+                prepared.get_int8_codes(unit=(metric == 'cosine')),
+                scan_data_NF, query_BF, K, metric, n_rerank,
+                exclude_N=exclude_N)
+        else:
+            ids_BK, dist_BK = _calc_closest_ids_for_batch(
+                scan_data_NF, prepared.sqnorm_N, query_BF, K, metric=metric,
+                exclude_N=exclude_N)
+        closest_ids_QK[q_start:q_stop] = ids_BK
+        dist_QK[q_start:q_stop] = dist_BK
+
+    if n_jobs == 1:
+        for q_start in range(0, Q, batch_size):
+            fill_batch(q_start)
+    else:
+        # Each batch writes its own rows of closest_ids_QK, so order is kept
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(fill_batch, range(0, Q, batch_size)))
+
+    if not return_distance:
+        return closest_ids_QK
+    if metric == 'euclidean':
+        dist_QK = np.sqrt(dist_QK)
+    elif metric == 'cosine':
+        # Rounding can leave a same-direction match just below zero
+        dist_QK = np.maximum(1.0 + dist_QK, 0.0)
+    return closest_ids_QK, dist_QK
+
+
+def _calc_closest_ids_for_batch(
+        data_NF, sqnorm_N, query_BF, K, metric='euclidean', exclude_N=None):
+    ''' Find ids of K nearest examples for each query in one batch
+
+    For 'cosine', caller must pass unit-length data and query rows,
+    which are then ranked the same way as 'inner_product'.
+    Rows where exclude_N is True (if provided) are scored as +inf.
+
+    Returns
+    -------
+    closest_ids_BK : 2D np.array of int, shape (B, K)
+    dist_BK : 2D np.array, shape (B, K)
+        Direct squared Euclidean distance to each of the K neighbors,
+        or the negated dot product for similarity metrics
+    '''
+    N, F = data_NF.shape
+    if metric in ('cosine', 'inner_product'):
+        neg_sim_BN = -np.dot(query_BF, data_NF.T)
+        if exclude_N is not None:
+            neg_sim_BN[:, exclude_N] = np.inf
+        closest_ids_BK = argsort_smallest_k(neg_sim_BN, K)
+        return (
+            closest_ids_BK,
+            np.take_along_axis(neg_sim_BN, closest_ids_BK, axis=1))
+
+    sqnorm_B = np.einsum('bf,bf->b', query_BF, query_BF)
+    approx_dist_BN = (
+        sqnorm_B[:, None] - 2.0 * np.dot(query_BF, data_NF.T)
+        + sqnorm_N[None, :])
+    if exclude_N is not None:
+        approx_dist_BN[:, exclude_N] = np.inf
+
+    # Any example that could be among the K closest by direct distance
+    # must be within twice the roundoff bound of the K-th expanded distance
+    tol_B = 4.0 * (F + 4) * np.finfo(data_NF.dtype).eps * (
+        sqnorm_B + sqnorm_N.max())
+    if K < N:
+        kth_B = np.partition(approx_dist_BN, K - 1, axis=1)[:, K - 1]
+        is_cand_BN = approx_dist_BN <= (kth_B + 2.0 * tol_B)[:, None]
+        M = int(np.max(np.sum(is_cand_BN, axis=1)))
+    else:
+        M = N
+    if M < N:
+        cand_ids_BM = np.sort(
+            np.argpartition(approx_dist_BN, M - 1, axis=1)[:, :M], axis=1)
+    else:
+        cand_ids_BM = np.tile(np.arange(N), (query_BF.shape[0], 1))
+
+    # Re-score candidates directly; ids are ascending so ties keep row order
+    dist_BM = _rescore_candidates(data_NF, query_BF, cand_ids_BM, True)
+    order_BK = argsort_smallest_k(dist_BM, K)
+    return (
+        np.take_along_axis(cand_ids_BM, order_BK, axis=1),
+        np.take_along_axis(dist_BM, order_BK, axis=1))
+
+
+def _calc_closest_ids_for_batch_int8(
+        codes, data_NF, query_BF, K, metric, n_rerank=None, exclude_N=None):
+    ''' Find ids of K nearest examples using int8 codes plus re-ranking
+
+    Codes are scanned in chunks of QUANTIZED_CHUNK_SIZE rows, each cast to
+    float32 just before its matrix product, keeping the n_rerank best
+    candidates per query. Candidates are then ranked by the same full
+    precision rules as _calc_closest_ids_for_batch.
 
-    # We'll fill the neighbors array one query at a time
-    neighbors_QKF = np.zeros((Q, K, F))
-    closest_ids_per_query = []
-    for q in range(Q):
-        # Compute squared euclidean distance from query to N data vectors
-        # Only relative distance needed, so squared euclidean works
-        # as well as euclidean
-        dist_N = np.sum(np.square(data_NF - query_QF[q:q+1]), axis=1)
-
-        # Get the K example ids that have the smallest distance
-        # Remember, argsort defaults to ascending order (lowest to highest)
-        # Stable sort is the way to make sure the order of neighbors
-        # in data breaks is preserved in the result
-        closest_ids_by_distance_K = np.argsort(dist_N, kind='stable')[:K]
-
-        # Fill the neighbors array with the K closest data vectors
-        neighbors_QKF[q, :, :] = data_NF[closest_ids_by_distance_K]
-        closest_ids_per_query.append(closest_ids_by_distance_K)
-        
-    
-    return neighbors_QKF, closest_ids_per_query
\ No newline at end of file
+    Returns
+    -------
+    closest_ids_BK : 2D np.array of int, shape (B, K)
+    dist_BK : 2D np.array, shape (B, K)
+        Same meaning as in _calc_closest_ids_for_batch
+    '''
+    N, F = data_NF.shape
+    R = min(N, max(K, 4 * K if n_rerank is None else int(n_rerank)))
+    is_euclidean = metric in ('euclidean', 'sqeuclidean')
+
+    # Fold the quantization center and step into the query, so each chunk
+    # only needs a cast and one matrix product. Row n is reconstructed as
+    # center_F + step_F * code_n, so a dot product with query q is
+    # q . center_F + (q * step_F) . code_n, and a squared distance is
+    # |q - center_F|^2 - 2 ((q - center_F) * step_F) . code_n + |step_F * code_n|^2
+    query32_BF = np.asarray(query_BF, dtype=np.float32)
+    if is_euclidean:
+        shifted_BF = query32_BF - codes.center_F
+        scaled_BF = shifted_BF * codes.step_F
+        offset_B = np.einsum('bf,bf->b', shifted_BF, shifted_BF)
+    else:
+        scaled_BF = query32_BF * codes.step_F
+        offset_B = np.dot(query32_BF, codes.center_F)
+
+    cand_dist_BR = np.zeros((query_BF.shape[0], 0), dtype=np.float32)
+    cand_ids_BR = np.zeros((query_BF.shape[0], 0), dtype=np.intp)
+    for start in range(0, N, QUANTIZED_CHUNK_SIZE):
+        stop = min(N, start + QUANTIZED_CHUNK_SIZE)
+        prod_BT = np.dot(scaled_BF, codes.codes_NF[start:stop].T.astype(np.float32))
+        if is_euclidean:
+            dist_BT = (
+                offset_B[:, None] - 2.0 * prod_BT
+                + codes.code_sqnorm_N[None, start:stop])
+        else:
+            dist_BT = -(offset_B[:, None] + prod_BT)
+        if exclude_N is not None:
+            dist_BT[:, exclude_N[start:stop]] = np.inf
+        all_dist_BL = np.hstack([cand_dist_BR, dist_BT])
+        all_ids_BL = np.hstack([
+            cand_ids_BR, np.tile(np.arange(start, stop), (dist_BT.shape[0], 1))])
+        if all_dist_BL.shape[1] > R:
+            keep_BR = np.argpartition(all_dist_BL, R - 1, axis=1)[:, :R]
+            all_dist_BL = np.take_along_axis(all_dist_BL, keep_BR, axis=1)
+            all_ids_BL = np.take_along_axis(all_ids_BL, keep_BR, axis=1)
+        cand_dist_BR, cand_ids_BR = all_dist_BL, all_ids_BL
+
+    # Ascending candidate ids make the final stable sort keep row order
+    cand_ids_BR = np.sort(cand_ids_BR, axis=1)
+    dist_BR = _rescore_candidates(data_NF, query_BF, cand_ids_BR, is_euclidean)
+    if exclude_N is not None:
+        # Excluded rows can only be candidates if too few rows are left
+        dist_BR[exclude_N[cand_ids_BR]] = np.inf
+    order_BK = argsort_smallest_k(dist_BR, K)
+    return (
+        np.take_along_axis(cand_ids_BR, order_BK, axis=1),
+        np.take_along_axis(dist_BR, order_BK, axis=1))
+
+
+def _rescore_candidates(
+        data_NF, query_BF, ids_BM, is_euclidean, max_bytes=RESCORE_MAX_BYTES):
+    ''' Score each query against its own candidate rows, in full precision
+
+    Works through blocks of queries and candidates, so the gathered
+    rows never take more than about max_bytes, however many candidates
+    there are (up to all N, with K near N or many ties).
+
+    Returns
+    -------
+    dist_BM : 2D np.array, shape (B, M)
+        Entry b,m is sum_f (query_BF[b,f] - data_NF[ids_BM[b,m],f])^2
+        if is_euclidean, else the negated dot product of the two
+
+    Examples
+    --------
+    # Tiny blocks give exactly the same scores as one big block
+    >>> prng = np.random.RandomState(0)
+    >>> data_NF = prng.randn(50, 4)
+    >>> query_BF = prng.randn(3, 4)
+    >>> ids_BM = np.tile(np.arange(50), (3, 1))
+    >>> for is_euclidean in [True, False]:
+    ...     print(np.array_equal(
+    ...         _rescore_candidates(data_NF, query_BF, ids_BM, is_euclidean,
+    ...                             max_bytes=100),
+    ...         _rescore_candidates(data_NF, query_BF, ids_BM, is_euclidean)))
+    True
+    True
+    '''
+    B, M = ids_BM.shape
+    F = data_NF.shape[1]
+    row_bytes = F * data_NF.dtype.itemsize + 1
+    m_chunk = int(max(1, min(M, max_bytes // row_bytes)))
+    b_chunk = int(max(1, max_bytes // (row_bytes * m_chunk)))
+    dist_BM = np.zeros((B, M), dtype=data_NF.dtype)
+    for b_start in range(0, B, b_chunk):
+        b_stop = min(B, b_start + b_chunk)
+        query_CF = query_BF[b_start:b_stop]
+        for m_start in range(0, M, m_chunk):
+            m_stop = min(M, m_start + m_chunk)
+            cand_CMF = data_NF[ids_BM[b_start:b_stop, m_start:m_stop]]
+            if is_euclidean:
+                cand_CMF -= query_CF[:, None, :]
+                dist_BM[b_start:b_stop, m_start:m_stop] = np.sum(
+                    np.square(cand_CMF, out=cand_CMF), axis=2)
+            else:
+                dist_BM[b_start:b_stop, m_start:m_stop] = -np.einsum(
+                    'cmf,cf->cm', cand_CMF, query_CF)
+    return dist_BM
+
+
+def argsort_smallest_k(dist_BN, K):
+    ''' Find ids of the K smallest entries, in the same order as a stable argsort
+
+    Uses a linear-time partition to find the K-th smallest value, then
+    only sorts the entries at or below it. Taking *all* entries equal to
+    that value (not just the ones the partition happened to pick) keeps
+    the row-order tie-breaking of np.argsort(dist_BN, kind='stable').
+
+    Args
+    ----
+    dist_BN : 1D np.array, shape (N,), or 2D np.array, shape (B, N)
+        Distance of each of N examples (for each of B queries, if 2D)
+    K : int, must satisfy 1 <= K <= N
+
+    Returns
+    -------
+    ids_BK : 1D np.array of int, shape (K,), or 2D, shape (B, K)
+        Equal to np.argsort(dist_BN, axis=-1, kind='stable')[..., :K]
+
+    Examples
+    --------
+    >>> argsort_smallest_k(np.asarray([3., 1., 2., 1., 1., 0.]), 3)
+    array([5, 1, 3])
+    >>> argsort_smallest_k(np.asarray([[3., 1., 1.], [0., 2., 0.]]), 2)
+    array([[1, 2],
+           [0, 2]])
+    '''
+    if dist_BN.ndim == 1:
+        return argsort_smallest_k(dist_BN[np.newaxis, :], K)[0]
+    N = dist_BN.shape[1]
+    if K < N:
+        kth_B = np.partition(dist_BN, K - 1, axis=1)[:, K - 1]
+        M = int(np.max(np.sum(dist_BN <= kth_B[:, None], axis=1)))
+    else:
+        M = N
+    if M >= N:
+        return np.argsort(dist_BN, axis=1, kind='stable')[:, :K]
+    # Sorting ids first makes the stable sort below break ties by row order
+    cand_ids_BM = np.sort(
+        np.argpartition(dist_BN, M - 1, axis=1)[:, :M], axis=1)
+    cand_dist_BM = np.take_along_axis(dist_BN, cand_ids_BM, axis=1)
+    order_BK = np.argsort(cand_dist_BM, axis=1, kind='stable')[:, :K]
+    return np.take_along_axis(cand_ids_BM, order_BK, axis=1)
+
+
+def _resolve_n_jobs(n_jobs):
+    ''' Convert an n_jobs argument into a positive number of workers
+
+    Follows the sklearn convention: None means 1, negative values count
+    back from the number of CPU cores (-1 means all cores).
+    '''
+    if n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    return max(1, n_jobs)
+
+
+def _safe_norm(sqnorm_N):
+    ''' Compute norms from squared norms, replacing zeros by one
+
+    Dividing by the result leaves all-zero rows unchanged.
+    '''
+    norm_N = np.sqrt(sqnorm_N)
+    norm_N[norm_N == 0] = 1.0
+    return norm_N